@@ -1,99 +1,283 @@
+import csv
+import io
+import tempfile
+from typing import Optional
+
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ContextTypes, CommandHandler, CallbackQueryHandler
-from sqlalchemy import func
-from datetime import datetime, timedelta
+from sqlalchemy import or_, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from datetime import datetime
 
+from cache import inbound_cache
+from catalog import TARIFFS_VERSION, bump_version, tariff_catalog
 from config import settings
-from database import get_db
-from models import User, Subscription, Payment, Tariff
+from database import with_session
+from broadcast import start_broadcast
+from models import Broadcast, User, Payment, Tariff
+from utils import format_traffic
+import stats
 
 def is_admin(user_id: int) -> bool:
     """Проверка, является ли пользователь администратором"""
     return user_id in settings.ADMIN_IDS
 
-async def admin_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+@with_session
+async def admin_stats(update: Update, context: ContextTypes.DEFAULT_TYPE, db: AsyncSession):
     """Показывает статистику бота"""
     if not is_admin(update.effective_user.id):
         return
     
-    db = next(get_db())
+    # Счетчики и дневные бакеты обновляются по событиям, здесь только чтение
+    counters = await stats.get_counters(db)
+    daily = await stats.get_daily(db, settings.STATS_DAYS_SHOWN)
     
-    # Получаем статистику
-    total_users = await db.query(func.count(User.id)).scalar()
-    active_subscriptions = await db.query(func.count(Subscription.id)).filter(
-        Subscription.is_active == True
-    ).scalar()
-    total_payments = await db.query(func.count(Payment.id)).scalar()
-    total_revenue = await db.query(func.sum(Payment.amount)).filter(
-        Payment.status == "completed"
-    ).scalar() or 0
+    cache_stats = inbound_cache.stats()
+    lines = [
+        "📊 Статистика бота:",
+        "",
+        f"👥 Всего пользователей: {int(counters['users'])}",
+        f"✅ Активных подписок: {int(counters['active_subscriptions'])}",
+        f"💰 Всего платежей: {int(counters['payments'])}",
+        f"💵 Общая выручка: {counters['revenue']}₽",
+        f"📶 Трафик активных подписок: {format_traffic(counters['traffic'])}",
+        f"🗄 Кэш статусов: {cache_stats['hits']} попаданий, "
+        f"{cache_stats['stale_hits']} устаревших, {cache_stats['misses']} промахов",
+    ]
+    if daily:
+        lines += ["", f"📅 За последние {settings.STATS_DAYS_SHOWN} дней (выручка / новые / подписки / отток):"]
+        for bucket in daily:
+            lines.append(
+                f"{bucket.day.strftime('%d.%m')}: {bucket.revenue}₽ / {bucket.new_users} / "
+                f"{bucket.new_subscriptions} / {bucket.churned}"
+            )
     
-    await update.message.reply_text(
-        f"📊 Статистика бота:\n\n"
-        f"👥 Всего пользователей: {total_users}\n"
-        f"✅ Активных подписок: {active_subscriptions}\n"
-        f"💰 Всего платежей: {total_payments}\n"
-        f"💵 Общая выручка: {total_revenue}₽"
-    )
+    await update.message.reply_text("\n".join(lines))
 
-async def admin_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Показывает список пользователей"""
+USERS_PAGE_SIZE = 10
+CSV_CHUNK_SIZE = 64 * 1024
+# Telegram принимает от бота документы до 50 МБ, а InputFile читает файл
+# в память целиком, поэтому большая выгрузка делится на несколько файлов
+CSV_DOCUMENT_MAX_SIZE = 45 * 1024 * 1024
+USERS_CSV_HEADER = ["telegram_id", "username", "created_at", "is_active", "is_admin"]
+
+def users_filter(search: Optional[str]):
+    """Условие поиска по username или telegram_id"""
+    if not search:
+        return None
+    conditions = [User.username.ilike(f"%{search.lstrip('@')}%")]
+    if search.isdigit():
+        conditions.append(User.telegram_id == int(search))
+    return or_(*conditions)
+
+async def fetch_users_page(
+    db: AsyncSession,
+    search: Optional[str],
+    after_id: int = 0,
+    before_id: Optional[int] = None
+):
+    """Одна страница пользователей с keyset-пагинацией по User.id"""
+    query = select(User.id, User.telegram_id, User.username, User.created_at, User.is_active)
+    condition = users_filter(search)
+    if condition is not None:
+        query = query.where(condition)
+    
+    if before_id is not None:
+        rows = (await db.execute(
+            query.where(User.id < before_id).order_by(User.id.desc()).limit(USERS_PAGE_SIZE + 1)
+        )).all()
+        has_prev = len(rows) > USERS_PAGE_SIZE
+        return list(reversed(rows[:USERS_PAGE_SIZE])), has_prev, True
+    
+    rows = (await db.execute(
+        query.where(User.id > after_id).order_by(User.id).limit(USERS_PAGE_SIZE + 1)
+    )).all()
+    has_next = len(rows) > USERS_PAGE_SIZE
+    return rows[:USERS_PAGE_SIZE], after_id > 0, has_next
+
+def render_users_page(rows, has_prev: bool, has_next: bool, search: Optional[str]):
+    """Текст и кнопки навигации для страницы пользователей"""
+    title = f"👥 Пользователи по запросу «{search}»:" if search else "👥 Список пользователей:"
+    lines = [title, ""]
+    for row in rows:
+        lines.append(f"ID: {row.telegram_id}")
+        lines.append(f"Username: @{row.username or 'Нет'}")
+        lines.append(f"Дата регистрации: {row.created_at.strftime('%d.%m.%Y')}")
+        lines.append(f"Активен: {'Да' if row.is_active else 'Нет'}")
+        lines.append("-------------------")
+    
+    buttons = []
+    if has_prev:
+        buttons.append(InlineKeyboardButton("⬅️ Назад", callback_data=f"admin_users_prev_{rows[0].id}"))
+    if has_next:
+        buttons.append(InlineKeyboardButton("Вперед ➡️", callback_data=f"admin_users_next_{rows[-1].id}"))
+    reply_markup = InlineKeyboardMarkup([buttons]) if buttons else None
+    return "\n".join(lines), reply_markup
+
+@with_session
+async def admin_users(update: Update, context: ContextTypes.DEFAULT_TYPE, db: AsyncSession):
+    """Показывает список пользователей постранично
+
+    /admin_users [username или telegram_id] - поиск пользователей.
+    """
     if not is_admin(update.effective_user.id):
         return
     
-    db = next(get_db())
-    users = await db.query(User).all()
+    search = " ".join(context.args).strip() if context.args else None
+    context.user_data["admin_users_search"] = search
+    rows, has_prev, has_next = await fetch_users_page(db, search)
     
-    if not users:
+    if not rows:
         await update.message.reply_text("Пользователей не найдено.")
         return
     
-    message = "👥 Список пользователей:\n\n"
-    for user in users:
-        message += f"ID: {user.telegram_id}\n"
-        message += f"Username: @{user.username or 'Нет'}\n"
-        message += f"Дата регистрации: {user.created_at.strftime('%d.%m.%Y')}\n"
-        message += f"Активен: {'Да' if user.is_active else 'Нет'}\n"
-        message += "-------------------\n"
+    text, reply_markup = render_users_page(rows, has_prev, has_next, search)
+    await update.message.reply_text(text, reply_markup=reply_markup)
+
+@with_session
+async def admin_users_page(update: Update, context: ContextTypes.DEFAULT_TYPE, db: AsyncSession):
+    """Переход на следующую или предыдущую страницу пользователей"""
+    query = update.callback_query
+    await query.answer()
+    if not is_admin(query.from_user.id):
+        return
     
-    await update.message.reply_text(message)
+    _, _, direction, boundary_id = query.data.split('_')
+    search = context.user_data.get("admin_users_search")
+    if direction == "next":
+        rows, has_prev, has_next = await fetch_users_page(db, search, after_id=int(boundary_id))
+    else:
+        rows, has_prev, has_next = await fetch_users_page(db, search, before_id=int(boundary_id))
+        if not rows:
+            rows, has_prev, has_next = await fetch_users_page(db, search)
+    
+    if not rows:
+        await query.edit_message_text("Пользователей не найдено.")
+        return
+    
+    text, reply_markup = render_users_page(rows, has_prev, has_next, search)
+    await query.edit_message_text(text, reply_markup=reply_markup)
 
-async def admin_tariffs(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def iter_users_csv(db: AsyncSession):
+    """Построчная выгрузка пользователей в CSV кусками по CSV_CHUNK_SIZE байт"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(USERS_CSV_HEADER)
+    
+    result = await db.stream(
+        select(User.telegram_id, User.username, User.created_at, User.is_active, User.is_admin)
+        .order_by(User.id)
+        .execution_options(yield_per=1000)
+    )
+    async for row in result:
+        writer.writerow([
+            row.telegram_id,
+            row.username or "",
+            row.created_at.isoformat() if row.created_at else "",
+            int(bool(row.is_active)),
+            int(bool(row.is_admin))
+        ])
+        if buffer.tell() >= CSV_CHUNK_SIZE:
+            yield buffer.getvalue().encode()
+            buffer.seek(0)
+            buffer.truncate()
+    
+    yield buffer.getvalue().encode()
+
+@with_session
+async def admin_users_csv(update: Update, context: ContextTypes.DEFAULT_TYPE, db: AsyncSession):
+    """Выгрузка всех пользователей в CSV-файл"""
+    if not is_admin(update.effective_user.id):
+        return
+    
+    name = f"users_{datetime.utcnow().strftime('%Y%m%d_%H%M')}"
+    header = io.StringIO()
+    csv.writer(header).writerow(USERS_CSV_HEADER)
+    header = header.getvalue().encode()
+    part = 1
+    
+    async def send(document, filename: str):
+        document.seek(0)
+        await update.message.reply_document(document=document, filename=filename)
+        document.close()
+    
+    # Небольшая выгрузка остается в памяти, большая уходит во временный файл;
+    # куски заканчиваются на границе строки, каждая часть - со своим заголовком
+    document = tempfile.SpooledTemporaryFile(max_size=1024 * 1024)
+    try:
+        async for chunk in iter_users_csv(db):
+            if document.tell() + len(chunk) > CSV_DOCUMENT_MAX_SIZE:
+                await send(document, f"{name}_part{part}.csv")
+                part += 1
+                document = tempfile.SpooledTemporaryFile(max_size=1024 * 1024)
+                document.write(header)
+            document.write(chunk)
+        await send(document, f"{name}_part{part}.csv" if part > 1 else f"{name}.csv")
+    finally:
+        document.close()
+
+@with_session
+async def admin_tariffs(update: Update, context: ContextTypes.DEFAULT_TYPE, db: AsyncSession):
     """Управление тарифами"""
     if not is_admin(update.effective_user.id):
         return
     
-    db = next(get_db())
-    tariffs = await db.query(Tariff).all()
+    tariffs = (await db.scalars(select(Tariff).order_by(Tariff.id))).all()
     
     if not tariffs:
         await update.message.reply_text("Тарифов не найдено.")
         return
     
+    await update.message.reply_text(
+        "📋 Управление тарифами:",
+        reply_markup=tariffs_keyboard(tariffs)
+    )
+
+def tariffs_keyboard(tariffs) -> InlineKeyboardMarkup:
+    """Клавиатура управления тарифами"""
     keyboard = []
     for tariff in tariffs:
         keyboard.append([
             InlineKeyboardButton(
-                f"{tariff.name} - {tariff.price}₽",
+                f"{'✅' if tariff.is_active else '🚫'} {tariff.name} - {tariff.price}₽",
                 callback_data=f"admin_tariff_{tariff.id}"
             )
         ])
     
     keyboard.append([InlineKeyboardButton("➕ Добавить тариф", callback_data="admin_add_tariff")])
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    return InlineKeyboardMarkup(keyboard)
+
+@with_session
+async def admin_tariff_toggle(update: Update, context: ContextTypes.DEFAULT_TYPE, db: AsyncSession):
+    """Включение и отключение тарифа"""
+    query = update.callback_query
+    if not is_admin(query.from_user.id):
+        await query.answer()
+        return
     
-    await update.message.reply_text(
-        "📋 Управление тарифами:",
-        reply_markup=reply_markup
-    )
+    tariff = await db.get(Tariff, int(query.data.split('_')[2]))
+    if not tariff:
+        await query.answer("Тариф не найден")
+        return
+    
+    tariff.is_active = not tariff.is_active
+    await bump_version(db, TARIFFS_VERSION)
+    await db.commit()
+    tariff_catalog.invalidate()
+    
+    await query.answer("Тариф включен" if tariff.is_active else "Тариф отключен")
+    tariffs = (await db.scalars(select(Tariff).order_by(Tariff.id))).all()
+    await query.edit_message_reply_markup(reply_markup=tariffs_keyboard(tariffs))
 
-async def admin_payments(update: Update, context: ContextTypes.DEFAULT_TYPE):
+@with_session
+async def admin_payments(update: Update, context: ContextTypes.DEFAULT_TYPE, db: AsyncSession):
     """Показывает список платежей"""
     if not is_admin(update.effective_user.id):
         return
     
-    db = next(get_db())
-    payments = await db.query(Payment).order_by(Payment.created_at.desc()).limit(10).all()
+    payments = (await db.scalars(
+        select(Payment).order_by(Payment.created_at.desc()).limit(10)
+    )).all()
     
     if not payments:
         await update.message.reply_text("Платежей не найдено.")
@@ -109,9 +293,39 @@ async def admin_payments(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     await update.message.reply_text(message)
 
+@with_session
+async def admin_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE, db: AsyncSession):
+    """Рассылка сообщения всем активным пользователям
+
+    /admin_broadcast <текст сообщения>
+    """
+    if not is_admin(update.effective_user.id):
+        return
+    
+    # Берем текст целиком, с переносами строк
+    parts = update.message.text.split(maxsplit=1)
+    if len(parts) < 2 or not parts[1].strip():
+        await update.message.reply_text("Использование: /admin_broadcast <текст сообщения>")
+        return
+    
+    progress = await update.message.reply_text("📣 Рассылка запускается...")
+    broadcast = Broadcast(
+        text=parts[1],
+        admin_chat_id=progress.chat_id,
+        progress_message_id=progress.message_id
+    )
+    db.add(broadcast)
+    await db.commit()
+    
+    start_broadcast(context.bot, broadcast.id)
+
 def setup_admin_handlers(application):
     """Добавляет обработчики админ-команд"""
     application.add_handler(CommandHandler("admin_stats", admin_stats))
     application.add_handler(CommandHandler("admin_users", admin_users))
+    application.add_handler(CallbackQueryHandler(admin_users_page, pattern=r"^admin_users_(next|prev)_\d+$"))
+    application.add_handler(CommandHandler("admin_users_csv", admin_users_csv))
     application.add_handler(CommandHandler("admin_tariffs", admin_tariffs))
-    application.add_handler(CommandHandler("admin_payments", admin_payments)) 
\ No newline at end of file
+    application.add_handler(CallbackQueryHandler(admin_tariff_toggle, pattern=r"^admin_tariff_\d+$"))
+    application.add_handler(CommandHandler("admin_payments", admin_payments))
+    application.add_handler(CommandHandler("admin_broadcast", admin_broadcast)) 
\ No newline at end of file
@@ -0,0 +1,151 @@
+"""Нагрузочный тест: параллельная повторная доставка вебхука об оплате.
+
+Для каждого счета одновременно отправляется несколько одинаковых
+вебхуков, затем очередь выдачи ключей разбирается воркером; в конце
+проверяется, что на каждый счет создана ровно одна подписка и ровно
+один ключ в панели.
+
+Запуск из корня проекта (сервер вебхуков поднимается в этом же процессе):
+    python -m benchmarks.duplicate_webhooks --bills 50 --duplicates 20
+
+Проверка нескольких воркеров uvicorn: запустите
+    uvicorn webhooks:create_app --factory --workers 4 --port 8000
+с той же DATABASE_URL и передайте --url http://127.0.0.1:8000.
+"""
+import argparse
+import asyncio
+import hashlib
+import hmac
+import json
+import os
+import random
+import time
+import uuid
+
+from aiohttp import ClientSession
+
+from benchmarks.stubs import PanelStub
+
+async def start_webhook_server(port: int):
+    """Сервер вебхуков в текущем процессе"""
+    import uvicorn
+    from webhooks import app
+
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    task = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.05)
+    return server, task
+
+async def seed(bills: int):
+    """Создание пользователей с одним неоплаченным счетом у каждого"""
+    from database import async_session, init_db
+    from models import Payment, User
+
+    await init_db()
+    base = random.randint(10 ** 9, 2 * 10 ** 9)
+    user_ids, payment_ids = [], []
+    async with async_session() as db:
+        for i in range(bills):
+            user = User(telegram_id=base + i, username=f"dup_{base + i}")
+            db.add(user)
+            await db.flush()
+            payment_id = f"vpn_dup_{uuid.uuid4().hex}"
+            db.add(Payment(
+                user_id=user.id, amount=100.0, currency="RUB",
+                payment_id=payment_id, status="pending"
+            ))
+            user_ids.append(user.id)
+            payment_ids.append(payment_id)
+        await db.commit()
+    return user_ids, payment_ids
+
+async def fire(url: str, token: str, payment_ids, duplicates: int):
+    """Параллельная отправка одинаковых вебхуков"""
+    async with ClientSession() as session:
+
+        async def send(body: bytes):
+            signature = hmac.new(token.encode(), body, hashlib.sha1).hexdigest()
+            async with session.post(
+                f"{url}/webhook/payment/success",
+                data=body,
+                headers={"X-Payment-Sha1-Hash": signature, "Content-Type": "application/json"}
+            ) as response:
+                return response.status
+
+        requests = []
+        for payment_id in payment_ids:
+            body = json.dumps({"billId": payment_id, "status": {"value": "PAID"}}).encode()
+            requests.extend(send(body) for _ in range(duplicates))
+        random.shuffle(requests)
+        return await asyncio.gather(*requests)
+
+async def main(args):
+    url = args.url
+    os.environ["PANEL_URL"] = f"http://127.0.0.1:{args.panel_port}"
+    os.environ["PANEL_NODES"] = "[]"
+
+    panel = await PanelStub(args.panel_port, args.panel_delay).start()
+
+    from sqlalchemy import func, select
+
+    from config import settings
+    from database import async_session
+    from models import Subscription
+    from outbox import OutboxWorker
+    from panel_pool import PanelPool
+
+    server = task = None
+    if not url:
+        server, task = await start_webhook_server(args.port)
+        url = f"http://127.0.0.1:{args.port}"
+
+    user_ids, payment_ids = await seed(args.bills)
+
+    started = time.perf_counter()
+    statuses = await fire(url, settings.PAYMENT_TOKEN, payment_ids, args.duplicates)
+    elapsed = time.perf_counter() - started
+
+    # Разбираем очередь выдачи ключей
+    panel_pool = PanelPool()
+    worker = OutboxWorker(panel_pool)
+    drain_started = time.perf_counter()
+    while await worker.drain_once():
+        pass
+    drain_elapsed = time.perf_counter() - drain_started
+    await panel_pool.close()
+
+    async with async_session() as db:
+        rows = (await db.execute(
+            select(Subscription.user_id, func.count(Subscription.id))
+            .where(Subscription.user_id.in_(user_ids))
+            .group_by(Subscription.user_id)
+        )).all()
+    per_user = dict(rows)
+    wrong = {user_id: per_user.get(user_id, 0) for user_id in user_ids if per_user.get(user_id, 0) != 1}
+
+    total = len(statuses)
+    print(f"{total} requests ({args.bills} bills x {args.duplicates}) in {elapsed:.2f}s, {total / elapsed:.0f} req/s")
+    print(f"Outbox drained in {drain_elapsed:.2f}s")
+    print(f"HTTP statuses: { {code: statuses.count(code) for code in set(statuses)} }")
+    print(f"Panel inbounds created: {panel.created} (expected {args.bills})")
+    if wrong:
+        print(f"FAIL: {len(wrong)} bills without exactly one subscription: {list(wrong.items())[:10]}")
+    else:
+        print("OK: exactly one subscription per bill")
+
+    if server is not None:
+        server.should_exit = True
+        await task
+    await panel.stop()
+    return 1 if wrong or panel.created != args.bills else 0
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Параллельные дубликаты вебхука об оплате")
+    parser.add_argument("--bills", type=int, default=50)
+    parser.add_argument("--duplicates", type=int, default=20)
+    parser.add_argument("--url", help="адрес уже запущенного сервера вебхуков")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--panel-port", type=int, default=9100)
+    parser.add_argument("--panel-delay", type=float, default=0.2, help="задержка заглушки панели, с")
+    raise SystemExit(asyncio.run(main(parser.parse_args())))
@@ -0,0 +1,76 @@
+"""Размещение ключей по пулу панелей и переключение при отказе узла.
+
+Поднимает несколько заглушек панели 3x-ui (часть из них может быть
+выключена), создает ключи через PanelPool и печатает, сколько ключей
+попало на каждый узел и сколько заняло создание.
+
+Запуск из корня проекта:
+    python -m benchmarks.panel_nodes --nodes 3 --keys 300
+    python -m benchmarks.panel_nodes --nodes 3 --keys 300 --down 1 --delay 0.02
+"""
+import argparse
+import asyncio
+import json
+import os
+import time
+
+from benchmarks.stubs import PanelStub
+
+async def main(args):
+    nodes = [
+        {"name": f"node-{i}", "url": f"http://127.0.0.1:{args.port + i}", "username": "u", "password": "p"}
+        for i in range(args.nodes)
+    ]
+    os.environ["PANEL_NODES"] = json.dumps(nodes)
+    os.environ.setdefault("DATABASE_URL", args.database_url)
+
+    stubs = {}
+    for i, node in enumerate(nodes):
+        if i not in args.down:
+            stubs[node["name"]] = await PanelStub(args.port + i, args.delay).start()
+
+    from database import init_db
+    from panel_pool import PanelPool
+
+    await init_db()
+    panel_pool = PanelPool()
+    await panel_pool.start()
+    await panel_pool.check_health()
+    # Выключенный узел считается недоступным после PANEL_NODE_MAX_FAILURES
+    # ошибок подряд; до этого ключи с него переключаются на соседний узел
+    semaphore = asyncio.Semaphore(args.concurrency)
+    failed = 0
+
+    async def create(i: int):
+        nonlocal failed
+        async with semaphore:
+            try:
+                _, response = await panel_pool.create_inbound(f"bench_{i}", 30)
+                if not response.get("success"):
+                    failed += 1
+            except Exception:
+                failed += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(create(i) for i in range(args.keys)))
+    elapsed = time.perf_counter() - started
+
+    print(f"{args.keys} keys in {elapsed:.2f}s ({args.keys / elapsed:.0f} keys/s), failed: {failed}")
+    for node in panel_pool.status():
+        created = stubs[node["name"]].created if node["name"] in stubs else 0
+        print(f"  {node['name']}: {'up' if node['healthy'] else 'DOWN'}, created {created}")
+
+    await panel_pool.close()
+    for stub in stubs.values():
+        await stub.stop()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Бенчмарк пула панелей")
+    parser.add_argument("--nodes", type=int, default=3)
+    parser.add_argument("--keys", type=int, default=300)
+    parser.add_argument("--down", type=int, nargs="*", default=[], help="номера выключенных узлов")
+    parser.add_argument("--delay", type=float, default=0.01, help="задержка создания ключа в заглушке")
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--port", type=int, default=9300)
+    parser.add_argument("--database-url", default="sqlite+aiosqlite:///bench.db")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,100 @@
+"""Проверка повторов запросов к QIWI на заглушке, отвечающей ошибками.
+
+Каждый сценарий задает заглушке коды ошибок и сверяет, сколько запросов
+до нее дошло, сколько повторов и сколько времени задержек насчитал
+PaymentSystem, и печатает задержку вызова:
+    create_429     - создание счета повторяется после 429
+    create_503     - создание счета после 503 не повторяется (счет мог
+                     быть выставлен)
+    check_503      - проверка статуса повторяется после 503
+    create_connect - создание счета повторяется, если соединение не
+                     установлено
+
+Запуск из корня проекта:
+    python -m benchmarks.payment_retries
+    python -m benchmarks.payment_retries --base-delay 0.2 --max-retries 5
+"""
+import argparse
+import asyncio
+import os
+import time
+
+from benchmarks.stubs import QiwiStub
+
+async def main(args) -> int:
+    qiwi = await QiwiStub(args.qiwi_port).start()
+    os.environ.update({
+        "PAYMENT_API_URL": qiwi.url,
+        "PAYMENT_RETRY_BASE_DELAY": str(args.base_delay),
+        "PAYMENT_MAX_RETRIES": str(args.max_retries)
+    })
+    os.environ.setdefault("BOT_TOKEN", "1:bench")
+    os.environ.setdefault("PAYMENT_TOKEN", "bench")
+    os.environ.setdefault("PAYMENT_WEBHOOK_URL", "http://127.0.0.1/webhook")
+
+    from payment import PaymentSystem
+
+    retries = args.max_retries
+    # Худшая суммарная задержка до n-го повтора (full jitter: до base * 2^i)
+    max_backoff = lambda n: sum(args.base_delay * (2 ** i) for i in range(n))
+
+    async def create(payments: PaymentSystem, i: int):
+        return await payments.create_payment(100.0, "RUB", f"bench_{i}")
+
+    async def check(payments: PaymentSystem, i: int):
+        await payments.create_payment(100.0, "RUB", f"bench_{i}")
+        qiwi.fail_next(503, 503)
+        return await payments.check_payment(f"bench_{i}")
+
+    # Сценарий: ошибки заглушки, вызов, операция, ожидаемые запросы к заглушке и повторы
+    scenarios = {
+        "create_429": ((429, 429), create, "create_payment", "create_bill", min(retries, 2) + 1, min(retries, 2)),
+        "create_503": ((503,), create, "create_payment", "create_bill", 1, 0),
+        "check_503": ((), check, "check_payment", "get_bill", min(retries, 2) + 1, min(retries, 2)),
+        "create_connect": ((), create, "create_payment", "create_bill", 0, retries)
+    }
+
+    failed = False
+    for i, (name, (statuses, call, operation, method, expected_requests, expected_retries)) in enumerate(scenarios.items()):
+        payments = PaymentSystem()
+        if name == "create_connect":
+            # Порт, на котором никто не слушает
+            payments.base_url = f"http://127.0.0.1:{args.closed_port}"
+        qiwi.requests.clear()
+        qiwi.fail_next(*statuses)
+
+        started = time.perf_counter()
+        try:
+            await call(payments, i)
+            outcome = "ok"
+        except Exception as e:
+            outcome = type(e).__name__
+        elapsed = time.perf_counter() - started
+        await payments.close()
+
+        stat = payments.stats.get(operation, {})
+        requests = qiwi.requests[method]
+        ok = (
+            requests == expected_requests
+            and stat.get("retries", 0) == expected_retries
+            and stat.get("backoff_time", 0.0) <= max_backoff(expected_retries)
+        )
+        failed = failed or not ok
+        print(
+            f"{name:15} {'PASS' if ok else 'FAIL'} {outcome}, requests={requests} "
+            f"(expected {expected_requests}), retries={stat.get('retries', 0)} (expected {expected_retries}), "
+            f"backoff={stat.get('backoff_time', 0.0) * 1000:.0f}ms, attempts={stat.get('count', 0)} "
+            f"errors={stat.get('errors', 0)} max_attempt={stat.get('max_time', 0.0) * 1000:.1f}ms, "
+            f"call={elapsed * 1000:.0f}ms"
+        )
+
+    await qiwi.stop()
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Проверка повторов запросов к QIWI")
+    parser.add_argument("--base-delay", type=float, default=0.05)
+    parser.add_argument("--max-retries", type=int, default=3)
+    parser.add_argument("--qiwi-port", type=int, default=9220)
+    parser.add_argument("--closed-port", type=int, default=9221)
+    raise SystemExit(asyncio.run(main(parser.parse_args())))
@@ -0,0 +1,185 @@
+"""Холодный старт точек входа: время импорта и время до первого ответа.
+
+Профиль импорта (python -X importtime) показывает, сколько занимает
+import bot и import webhooks и какие пакеты вносят основной вклад.
+
+Замер старта запускает точку входа отдельным процессом на заглушках
+Telegram и панели и считает время от запуска процесса:
+    payments - uvicorn webhooks:create_app без бота, до первого ответа
+               на платежный вебхук
+    webhook  - то же с ботом в режиме вебхука, плюс до первого ответа
+               бота на обновление
+    polling  - python bot.py, до первого ответа бота на обновление из
+               getUpdates
+
+Запуск из корня проекта:
+    python -m benchmarks.startup --profile bot --profile webhooks
+    python -m benchmarks.startup --modes payments,webhook,polling --runs 5
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import subprocess
+import sys
+import time
+from collections import defaultdict
+from typing import Dict, List, Optional
+
+from aiohttp import ClientConnectionError, ClientSession
+
+from benchmarks.stubs import PanelStub, TelegramStub
+from benchmarks.telegram_updates import make_update
+
+def import_profile(module: str, top: int):
+    """Время импорта модуля и самые тяжелые пакеты"""
+    baseline = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "pass"], capture_output=True, text=True
+    )
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"], capture_output=True, text=True
+    )
+    if result.returncode != 0:
+        print(result.stderr.splitlines()[-1] if result.stderr else f"import {module} failed")
+        return
+
+    def parse(stderr: str) -> Dict[str, int]:
+        """Собственное время импорта (мкс) по корневым пакетам"""
+        packages: Dict[str, int] = defaultdict(int)
+        for line in stderr.splitlines():
+            if not line.startswith("import time:") or "imported package" in line:
+                continue
+            self_us, _, name = line[len("import time:"):].split("|")
+            packages[name.strip().split(".")[0]] += int(self_us)
+        return packages
+
+    interpreter = parse(baseline.stderr)
+    packages = {
+        name: us - interpreter.get(name, 0)
+        for name, us in parse(result.stderr).items() if us > interpreter.get(name, 0)
+    }
+    total = sum(packages.values())
+    print(f"import {module}: {total / 1000:.0f}ms (without interpreter startup)")
+    for name, us in sorted(packages.items(), key=lambda item: item[1], reverse=True)[:top]:
+        print(f"  {name:30} {us / 1000:8.1f}ms {us / total:6.1%}")
+
+class Child:
+    """Точка входа в отдельном процессе"""
+
+    def __init__(self, args: List[str], env: Dict[str, str]):
+        self.args = args
+        self.env = env
+        self.process: Optional[asyncio.subprocess.Process] = None
+
+    async def start(self) -> float:
+        started = time.perf_counter()
+        self.process = await asyncio.create_subprocess_exec(
+            sys.executable, *self.args,
+            env={**os.environ, **self.env},
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.DEVNULL
+        )
+        return started
+
+    async def stop(self):
+        if self.process is not None and self.process.returncode is None:
+            self.process.terminate()
+            await self.process.wait()
+
+async def first_response(session: ClientSession, url: str, timeout: float, **kwargs) -> int:
+    """Повтор запроса, пока сервер не начнет принимать соединения"""
+    deadline = time.perf_counter() + timeout
+    while True:
+        try:
+            async with session.post(url, **kwargs) as response:
+                await response.read()
+                return response.status
+        except ClientConnectionError:
+            if time.perf_counter() > deadline:
+                raise
+            await asyncio.sleep(0.01)
+
+async def measure(mode: str, run: int, args, telegram: TelegramStub, session: ClientSession) -> Dict[str, float]:
+    """Один холодный старт; результат в секундах от запуска процесса"""
+    base_url = f"http://127.0.0.1:{args.port}"
+    env = {"BOT_MODE": "polling" if mode == "payments" else mode}
+    update = make_update(400000 + run, "/start")
+    chat_id = update["message"]["chat"]["id"]
+    result = {}
+
+    if mode == "polling":
+        child = Child(["bot.py"], env)
+        # Обновление ждет бота в getUpdates с самого запуска
+        telegram.push_update(update)
+    else:
+        child = Child([
+            "-m", "uvicorn", "webhooks:create_app", "--factory",
+            "--host", "127.0.0.1", "--port", str(args.port), "--log-level", "warning"
+        ], env)
+
+    started = await child.start()
+    try:
+        if mode != "polling":
+            await first_response(
+                session, f"{base_url}/webhook/payment/success", args.timeout,
+                data=b"{}", headers={"X-Payment-Sha1-Hash": "0" * 40}
+            )
+            result["first_webhook"] = time.perf_counter() - started
+        if mode == "webhook":
+            await first_response(
+                session, f"{base_url}{args.webhook_path}", args.timeout,
+                json=update, headers=TelegramStub.WEBHOOK_HEADERS
+            )
+        if mode != "payments":
+            await telegram.reply(chat_id, args.timeout)
+            result["first_update"] = time.perf_counter() - started
+    finally:
+        await child.stop()
+    return result
+
+async def main(args):
+    telegram = await TelegramStub(args.telegram_port).start()
+    panel = await PanelStub(args.panel_port).start()
+    os.environ["TELEGRAM_API_URL"] = telegram.api_url
+    os.environ["PANEL_URL"] = panel.url
+    os.environ["PANEL_NODES"] = "[]"
+    os.environ.pop("BOT_WEBHOOK_URL", None)
+    os.environ["BOT_WEBHOOK_SECRET"] = TelegramStub.WEBHOOK_SECRET
+
+    from config import settings
+    from database import init_db
+
+    await init_db()
+    args.webhook_path = settings.BOT_WEBHOOK_PATH
+
+    async with ClientSession() as session:
+        for mode in args.modes.split(","):
+            samples: Dict[str, List[float]] = defaultdict(list)
+            for run in range(args.runs):
+                for name, value in (await measure(mode, run, args, telegram, session)).items():
+                    samples[name].append(value)
+            for name, values in samples.items():
+                print(
+                    f"{mode:9} {name:14} median={statistics.median(values) * 1000:.0f}ms "
+                    f"min={min(values) * 1000:.0f}ms max={max(values) * 1000:.0f}ms ({len(values)} runs)"
+                )
+
+    await panel.stop()
+    await telegram.stop()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Бенчмарк холодного старта бота и сервера вебхуков")
+    parser.add_argument("--profile", action="append", default=[], help="модуль для профиля импорта")
+    parser.add_argument("--top", type=int, default=15)
+    parser.add_argument("--modes", default="payments,webhook,polling")
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--port", type=int, default=8768)
+    parser.add_argument("--telegram-port", type=int, default=9210)
+    parser.add_argument("--panel-port", type=int, default=9211)
+    parser.add_argument("--timeout", type=float, default=60.0)
+    args = parser.parse_args()
+    if args.profile:
+        for module in args.profile:
+            import_profile(module, args.top)
+    else:
+        asyncio.run(main(args))
@@ -0,0 +1,244 @@
+"""Заглушки внешних сервисов для бенчмарков: Telegram Bot API, панель 3x-ui и QIWI.
+
+Каждая заглушка - aiohttp-приложение на локальном порту в том же
+процессе, что и бенчмарк.
+"""
+import asyncio
+import json
+import time
+from collections import defaultdict
+from typing import Any, Dict, List, Optional
+
+from aiohttp import web
+
+class StubServer:
+    def __init__(self, port: int):
+        self.port = port
+        self._runner: Optional[web.AppRunner] = None
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.port}"
+
+    def setup_routes(self, app: web.Application):
+        raise NotImplementedError
+
+    async def start(self) -> "StubServer":
+        app = web.Application()
+        self.setup_routes(app)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, "127.0.0.1", self.port).start()
+        return self
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+async def _request_data(request: web.Request) -> Dict[str, Any]:
+    """Параметры метода: Bot API принимает и JSON, и формы"""
+    if request.content_type == "application/json":
+        return await request.json()
+    return dict(await request.post())
+
+class TelegramStub(StubServer):
+    """Bot API: отвечает на любые методы, складывает ответы бота по чатам"""
+
+    REPLY_METHODS = ("sendMessage", "editMessageText", "sendPhoto", "sendDocument")
+    # Значение для BOT_WEBHOOK_SECRET; Telegram присылает его в каждом вебхуке
+    WEBHOOK_SECRET = "bench-secret"
+    WEBHOOK_HEADERS = {"X-Telegram-Bot-Api-Secret-Token": WEBHOOK_SECRET}
+
+    def __init__(self, port: int):
+        super().__init__(port)
+        self.sent = 0
+        self.replies: Dict[int, asyncio.Queue] = defaultdict(asyncio.Queue)
+        self._sent_changed = asyncio.Condition()
+        # Обновления для бота в режиме polling
+        self.updates: List[Dict[str, Any]] = []
+        self._updates_added = asyncio.Event()
+
+    @property
+    def api_url(self) -> str:
+        """Значение для TELEGRAM_API_URL"""
+        return f"{self.url}/bot"
+
+    async def reply(self, chat_id: int, timeout: float = 10.0) -> Dict[str, Any]:
+        """Следующий ответ бота в чат"""
+        return await asyncio.wait_for(self.replies[chat_id].get(), timeout)
+
+    async def wait_sent(self, count: int, timeout: float):
+        """Ожидание, пока бот отправит count сообщений"""
+        async with self._sent_changed:
+            await asyncio.wait_for(self._sent_changed.wait_for(lambda: self.sent >= count), timeout)
+
+    def push_update(self, update: Dict[str, Any]):
+        """Обновление, которое бот получит через getUpdates"""
+        self.updates.append(update)
+        self._updates_added.set()
+
+    async def get_updates(self, data: Dict[str, Any]) -> List[Dict[str, Any]]:
+        offset = int(data.get("offset") or 0)
+        self.updates = [update for update in self.updates if update["update_id"] >= offset]
+        if not self.updates:
+            # Короткий long polling, чтобы бот не крутился в пустом цикле
+            self._updates_added.clear()
+            try:
+                await asyncio.wait_for(self._updates_added.wait(), min(float(data.get("timeout") or 0), 1.0))
+            except asyncio.TimeoutError:
+                pass
+        return list(self.updates)
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        if method == "getUpdates":
+            result = await self.get_updates(await _request_data(request))
+        elif method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+        elif method in self.REPLY_METHODS:
+            data = await _request_data(request)
+            chat_id = int(data.get("chat_id", 0))
+            if isinstance(data.get("reply_markup"), str):
+                data["reply_markup"] = json.loads(data["reply_markup"])
+            self.sent += 1
+            data["method"] = method
+            data["message_id"] = self.sent
+            data["received_at"] = time.perf_counter()
+            self.replies[chat_id].put_nowait(data)
+            async with self._sent_changed:
+                self._sent_changed.notify_all()
+            result = {
+                "message_id": self.sent,
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "text": data.get("text", "")
+            }
+            if method == "sendPhoto":
+                result["photo"] = [{
+                    "file_id": f"photo_{self.sent}", "file_unique_id": f"u{self.sent}",
+                    "width": 300, "height": 300
+                }]
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    def setup_routes(self, app: web.Application):
+        app.router.add_post("/bot{token}/{method}", self.handle)
+
+class PanelStub(StubServer):
+    """Панель 3x-ui: хранит созданные ключи в памяти"""
+
+    def __init__(self, port: int, delay: float = 0.0):
+        super().__init__(port)
+        self.delay = delay
+        self.created = 0
+        self.inbounds: Dict[int, Dict[str, Any]] = {}
+
+    async def login(self, request):
+        return web.json_response({"success": True, "token": "stub-token"})
+
+    async def list_inbounds(self, request):
+        page = int(request.query.get("page", 1))
+        limit = int(request.query.get("limit", 500))
+        items = list(self.inbounds.values())[(page - 1) * limit:page * limit]
+        return web.json_response({"success": True, "obj": items})
+
+    async def create_inbound(self, request):
+        await asyncio.sleep(self.delay)
+        self.created += 1
+        inbound = {"id": self.created, "port": 20000 + self.created, "up": 0, "down": 0, "enable": True}
+        self.inbounds[self.created] = inbound
+        return web.json_response({"success": True, "obj": inbound})
+
+    async def get_inbound(self, request):
+        await asyncio.sleep(self.delay)
+        inbound = self.inbounds.get(int(request.match_info["id"]))
+        if inbound is None:
+            return web.json_response({"success": False, "msg": "not found"})
+        return web.json_response({"success": True, "obj": inbound})
+
+    async def update_inbound(self, request):
+        inbound = self.inbounds.get(int(request.match_info["id"]))
+        if inbound is None:
+            return web.json_response({"success": False, "msg": "not found"})
+        inbound.update(await request.json())
+        return web.json_response({"success": True, "obj": inbound})
+
+    async def delete_inbound(self, request):
+        found = self.inbounds.pop(int(request.match_info["id"]), None) is not None
+        return web.json_response({"success": found})
+
+    def setup_routes(self, app: web.Application):
+        app.router.add_post("/api/auth/login", self.login)
+        app.router.add_get("/api/inbounds", self.list_inbounds)
+        app.router.add_post("/api/inbounds", self.create_inbound)
+        app.router.add_get("/api/inbounds/{id}", self.get_inbound)
+        app.router.add_put("/api/inbounds/{id}", self.update_inbound)
+        app.router.add_delete("/api/inbounds/{id}", self.delete_inbound)
+
+class QiwiStub(StubServer):
+    """API счетов QIWI: счета живут в памяти, оплата отмечается через pay()
+
+    fail_next() задает коды ошибок (429, 503), которыми ответят следующие
+    запросы; requests считает запросы по методам.
+    """
+
+    def __init__(self, port: int, delay: float = 0.0):
+        super().__init__(port)
+        self.delay = delay
+        self.bills: Dict[str, Dict[str, Any]] = {}
+        self.requests: Dict[str, int] = defaultdict(int)
+        self._failures: List[int] = []
+
+    def fail_next(self, *statuses: int):
+        self._failures.extend(statuses)
+
+    def _failure(self, method: str) -> Optional[web.Response]:
+        self.requests[method] += 1
+        if not self._failures:
+            return None
+        status = self._failures.pop(0)
+        return web.json_response({"errorCode": f"stub.error.{status}"}, status=status)
+
+    def pay(self, bill_id: str):
+        self.bills[bill_id]["status"] = {"value": "PAID"}
+
+    def bill_id_from_url(self, pay_url: str) -> str:
+        return pay_url.rsplit("/", 1)[-1]
+
+    async def create_bill(self, request):
+        await asyncio.sleep(self.delay)
+        failure = self._failure("create_bill")
+        if failure is not None:
+            return failure
+        data = await request.json()
+        bill_id = data["customer"]["account"]
+        self.bills[bill_id] = {
+            "billId": bill_id,
+            "amount": data["amount"],
+            "status": {"value": "WAITING"},
+            "payUrl": f"{self.url}/pay/{bill_id}"
+        }
+        return web.json_response(self.bills[bill_id])
+
+    async def get_bill(self, request):
+        failure = self._failure("get_bill")
+        if failure is not None:
+            return failure
+        bill = self.bills.get(request.match_info["bill_id"])
+        if bill is None:
+            return web.json_response({"errorCode": "bill.not.found"}, status=404)
+        return web.json_response(bill)
+
+    async def reject_bill(self, request):
+        bill = self.bills.get(request.match_info["bill_id"])
+        if bill is None:
+            return web.json_response({"errorCode": "bill.not.found"}, status=404)
+        bill["status"] = {"value": "REJECTED"}
+        return web.json_response(bill)
+
+    def setup_routes(self, app: web.Application):
+        app.router.add_post("/bills", self.create_bill)
+        app.router.add_get("/bills/{bill_id}", self.get_bill)
+        app.router.add_post("/bills/{bill_id}/reject", self.reject_bill)
@@ -0,0 +1,94 @@
+"""Пропускная способность бота в режиме вебхука.
+
+Поднимает заглушку Telegram Bot API и сервер вебхуков в этом же
+процессе, отправляет синтетические обновления на /telegram/webhook и
+ждет, пока бот ответит на каждое. Время считается от первого POST до
+последнего ответа бота, то есть end to end.
+
+Запуск из корня проекта:
+    python -m benchmarks.telegram_updates --updates 2000 --command /help
+    python -m benchmarks.telegram_updates --updates 500 --command /start --concurrent-updates 64
+"""
+import argparse
+import asyncio
+import os
+import time
+
+from aiohttp import ClientSession
+
+from benchmarks.stubs import TelegramStub
+
+def make_update(update_id: int, command: str) -> dict:
+    user_id = 100000 + update_id
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "Bench"},
+            "text": command,
+            "entities": [{"type": "bot_command", "offset": 0, "length": len(command)}]
+        }
+    }
+
+async def main(args):
+    telegram = await TelegramStub(args.telegram_port).start()
+    os.environ["TELEGRAM_API_URL"] = telegram.api_url
+    os.environ["BOT_MODE"] = "webhook"
+    os.environ["BOT_CONCURRENT_UPDATES"] = str(args.concurrent_updates)
+    os.environ.pop("BOT_WEBHOOK_URL", None)
+    os.environ["BOT_WEBHOOK_SECRET"] = TelegramStub.WEBHOOK_SECRET
+
+    import uvicorn
+    from database import init_db
+    from webhooks import app
+
+    await init_db()
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=args.port, log_level="warning"))
+    server_task = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.05)
+
+    url = f"http://127.0.0.1:{args.port}/telegram/webhook"
+    semaphore = asyncio.Semaphore(args.connections)
+    post_latencies = []
+
+    async with ClientSession() as session:
+
+        async def post(update_id: int):
+            async with semaphore:
+                started = time.perf_counter()
+                async with session.post(
+                    url, json=make_update(update_id, args.command), headers=TelegramStub.WEBHOOK_HEADERS
+                ) as response:
+                    await response.read()
+                post_latencies.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(post(i) for i in range(1, args.updates + 1)))
+        accepted = time.perf_counter() - started
+        await telegram.wait_sent(args.updates, timeout=args.timeout)
+        elapsed = time.perf_counter() - started
+
+    post_latencies.sort()
+    p = lambda q: post_latencies[min(len(post_latencies) - 1, int(len(post_latencies) * q))] * 1000
+    print(f"{args.updates} x {args.command}, concurrent_updates={args.concurrent_updates}")
+    print(f"Webhook accepted all updates in {accepted:.2f}s ({args.updates / accepted:.0f} req/s)")
+    print(f"Webhook POST latency p50={p(0.5):.1f}ms p95={p(0.95):.1f}ms p99={p(0.99):.1f}ms")
+    print(f"End to end: {elapsed:.2f}s, {args.updates / elapsed:.0f} updates/s")
+
+    server.should_exit = True
+    await server_task
+    await telegram.stop()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Бенчмарк обработки обновлений через вебхук")
+    parser.add_argument("--updates", type=int, default=2000)
+    parser.add_argument("--command", default="/help")
+    parser.add_argument("--concurrent-updates", type=int, default=32)
+    parser.add_argument("--connections", type=int, default=50)
+    parser.add_argument("--port", type=int, default=8766)
+    parser.add_argument("--telegram-port", type=int, default=9200)
+    parser.add_argument("--timeout", type=float, default=120.0)
+    asyncio.run(main(parser.parse_args()))
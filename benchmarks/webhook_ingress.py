@@ -0,0 +1,106 @@
+"""Пропускная способность приема вебхуков об оплате на одном воркере.
+
+Сервер вебхуков поднимается в этом же процессе; каждый сценарий
+отправляет --requests запросов и печатает req/s, задержки и коды ответа:
+    forged   - неверная подпись (отклоняется до чтения базы)
+    oversize - тело больше PAYMENT_WEBHOOK_MAX_BODY_SIZE
+    replay   - повтор уже обработанного вебхука (ответ из кэша подписей)
+    fresh    - новые оплаты (полная обработка с записью в базу)
+
+Запуск из корня проекта:
+    python -m benchmarks.webhook_ingress --requests 5000
+    python -m benchmarks.webhook_ingress --scenarios forged,replay --connections 100
+"""
+import argparse
+import asyncio
+import hashlib
+import hmac
+import json
+import os
+import time
+
+from aiohttp import ClientSession
+
+from benchmarks.duplicate_webhooks import seed, start_webhook_server
+
+def signed(token: str, payload: dict):
+    body = json.dumps(payload).encode()
+    return body, hmac.new(token.encode(), body, hashlib.sha1).hexdigest()
+
+async def run_scenario(session: ClientSession, url: str, requests, connections: int) -> dict:
+    """Отправка запросов (тело, подпись) и сводка по ним"""
+    semaphore = asyncio.Semaphore(connections)
+    latencies = []
+    statuses = {}
+
+    async def send(body: bytes, signature: str):
+        async with semaphore:
+            started = time.perf_counter()
+            async with session.post(
+                url,
+                data=body,
+                headers={"X-Payment-Sha1-Hash": signature, "Content-Type": "application/json"}
+            ) as response:
+                await response.read()
+            latencies.append(time.perf_counter() - started)
+            statuses[response.status] = statuses.get(response.status, 0) + 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(send(body, signature) for body, signature in requests))
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    p = lambda q: latencies[min(len(latencies) - 1, int(len(latencies) * q))] * 1000
+    return {
+        "requests": len(latencies),
+        "rps": len(latencies) / elapsed,
+        "p50": p(0.5),
+        "p99": p(0.99),
+        "statuses": statuses
+    }
+
+async def main(args):
+    os.environ["PANEL_NODES"] = "[]"
+    from config import settings
+    import ingress
+
+    server, task = await start_webhook_server(args.port)
+    url = f"http://127.0.0.1:{args.port}/webhook/payment/success"
+    token = settings.PAYMENT_TOKEN
+    scenarios = args.scenarios.split(",")
+
+    _, payment_ids = await seed(args.requests if "fresh" in scenarios else 1)
+    replay = signed(token, {"billId": payment_ids[0], "status": {"value": "PAID"}})
+    oversize_body = b'{"billId": "' + b"x" * (settings.PAYMENT_WEBHOOK_MAX_BODY_SIZE + 1) + b'"}'
+
+    generators = {
+        "forged": lambda i: (json.dumps({"billId": f"forged_{i}"}).encode(), "0" * 40),
+        "oversize": lambda i: (oversize_body, "0" * 40),
+        "replay": lambda i: replay,
+        "fresh": lambda i: signed(token, {"billId": payment_ids[i], "status": {"value": "PAID"}})
+    }
+
+    print(f"JSON parser: {ingress.JSON_PARSER}")
+    async with ClientSession() as session:
+        if "replay" in scenarios:
+            # Первая доставка обрабатывается полностью, дальше - повторы
+            await run_scenario(session, url, [replay], 1)
+        for name in scenarios:
+            result = await run_scenario(
+                session, url, [generators[name](i) for i in range(args.requests)], args.connections
+            )
+            print(
+                f"{name:9} {result['requests']} requests, {result['rps']:.0f} req/s, "
+                f"p50={result['p50']:.1f}ms p99={result['p99']:.1f}ms, statuses {result['statuses']}"
+            )
+
+    server.should_exit = True
+    await task
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Бенчмарк приема вебхуков об оплате")
+    parser.add_argument("--requests", type=int, default=5000)
+    parser.add_argument("--connections", type=int, default=50)
+    parser.add_argument("--scenarios", default="forged,oversize,replay,fresh")
+    parser.add_argument("--port", type=int, default=8767)
+    asyncio.run(main(parser.parse_args()))
@@ -13,11 +13,27 @@ from telegram.ext import (
     filters
 )
 
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from admin import setup_admin_handlers
+from cache import inbound_cache
+from catalog import tariff_catalog
 from config import settings
-from database import get_db
-from models import User, Subscription, Payment, Tariff
-from panel_api import PanelAPI
+from database import with_session
+from models import User, Subscription, Payment
+from panel_pool import PanelPool, panel_health_job
 from payment import PaymentSystem
+from traffic_sync import traffic_sync_job
+from expiry import expiry_sweep_job
+from payment_reconcile import payment_reconcile_job
+from outbox import OutboxWorker
+from broadcast import resume_broadcasts, stop_broadcasts
+from persistence import SqlPersistence, is_primary_worker
+from qr import send_qr
+from throttle import throttled
+import metrics
+import stats
 
 # Настройка логирования
 logging.basicConfig(
@@ -29,17 +45,13 @@ logger = logging.getLogger(__name__)
 # Состояния для ConversationHandler
 CHOOSING_TARIFF, CONFIRMING_PAYMENT = range(2)
 
-# Инициализация API и платежной системы
-panel_api = PanelAPI()
-payment_system = PaymentSystem()
-
-async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+@with_session
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE, db: AsyncSession):
     """Обработчик команды /start"""
     user = update.effective_user
-    db = next(get_db())
     
     # Проверяем, существует ли пользователь
-    db_user = await db.query(User).filter(User.telegram_id == user.id).first()
+    db_user = await db.scalar(select(User).where(User.telegram_id == user.id))
     if not db_user:
         # Создаем нового пользователя
         db_user = User(
@@ -47,6 +59,11 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
             username=user.username
         )
         db.add(db_user)
+        await stats.on_user_registered(db)
+        await db.commit()
+    elif not db_user.is_active:
+        # Пользователь снова написал боту после блокировки: рассылки ему снова доходят
+        db_user.is_active = True
         await db.commit()
     
     await update.message.reply_text(
@@ -57,28 +74,16 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "/help - Показать это сообщение"
     )
 
+@throttled
 async def buy(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /buy"""
-    db = next(get_db())
+    # Клавиатура с тарифами собирается заранее в каталоге
+    reply_markup = await tariff_catalog.get_keyboard()
     
-    # Получаем доступные тарифы
-    tariffs = await db.query(Tariff).filter(Tariff.is_active == True).all()
-    
-    if not tariffs:
+    if reply_markup is None:
         await update.message.reply_text("К сожалению, сейчас нет доступных тарифов.")
         return
     
-    # Создаем клавиатуру с тарифами
-    keyboard = []
-    for tariff in tariffs:
-        keyboard.append([
-            InlineKeyboardButton(
-                f"{tariff.name} - {tariff.price}₽",
-                callback_data=f"tariff_{tariff.id}"
-            )
-        ])
-    
-    reply_markup = InlineKeyboardMarkup(keyboard)
     await update.message.reply_text(
         "Выберите тарифный план:",
         reply_markup=reply_markup
@@ -86,44 +91,73 @@ async def buy(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     return CHOOSING_TARIFF
 
-async def tariff_chosen(update: Update, context: ContextTypes.DEFAULT_TYPE):
+@throttled
+@with_session
+async def tariff_chosen(update: Update, context: ContextTypes.DEFAULT_TYPE, db: AsyncSession):
     """Обработчик выбора тарифа"""
     query = update.callback_query
     await query.answer()
     
     tariff_id = int(query.data.split('_')[1])
-    db = next(get_db())
-    tariff = await db.query(Tariff).filter(Tariff.id == tariff_id).first()
+    tariff = await tariff_catalog.get(tariff_id)
     
     if not tariff:
         await query.edit_message_text("Ошибка: тариф не найден.")
         return ConversationHandler.END
     
-    # Создаем платеж
-    payment_id = f"vpn_{query.from_user.id}_{datetime.now().timestamp()}"
-    payment = await payment_system.create_payment(
-        amount=tariff.price,
-        currency="RUB",
-        payment_id=payment_id
-    )
-    
-    if not payment.get("payUrl"):
-        await query.edit_message_text("Ошибка при создании платежа. Попробуйте позже.")
+    user_id = await db.scalar(select(User.id).where(User.telegram_id == query.from_user.id))
+    if user_id is None:
+        await query.edit_message_text("Пожалуйста, начните с команды /start")
         return ConversationHandler.END
     
-    # Сохраняем информацию о платеже
-    db_payment = Payment(
-        user_id=query.from_user.id,
-        amount=tariff.price,
-        currency="RUB",
-        payment_id=payment_id,
-        status="pending"
+    # Неоплаченный счет на этот же тариф отдаем повторно, пока он не истек
+    fresh_since = datetime.utcnow() - timedelta(
+        seconds=settings.PAYMENT_BILL_LIFETIME - settings.PAYMENT_BILL_MIN_REMAINING
     )
-    db.add(db_payment)
-    await db.commit()
+    pay_url = await db.scalar(
+        select(Payment.pay_url)
+        .where(
+            Payment.user_id == user_id,
+            Payment.tariff_id == tariff.id,
+            Payment.status == "pending",
+            Payment.amount == tariff.price,
+            Payment.pay_url.isnot(None),
+            Payment.created_at >= fresh_since
+        )
+        .order_by(Payment.created_at.desc())
+        .limit(1)
+    )
+    
+    if pay_url is None:
+        # Создаем платеж
+        payment_id = f"vpn_{query.from_user.id}_{datetime.now().timestamp()}"
+        payment = await context.bot_data["payment_system"].create_payment(
+            amount=tariff.price,
+            currency="RUB",
+            payment_id=payment_id
+        )
+        
+        if not payment.get("payUrl"):
+            await query.edit_message_text("Ошибка при создании платежа. Попробуйте позже.")
+            return ConversationHandler.END
+        pay_url = payment["payUrl"]
+        
+        # Сохраняем информацию о платеже
+        db_payment = Payment(
+            user_id=user_id,
+            tariff_id=tariff.id,
+            amount=tariff.price,
+            currency="RUB",
+            payment_id=payment_id,
+            pay_url=pay_url,
+            status="pending"
+        )
+        db.add(db_payment)
+        await stats.on_payment_created(db)
+        await db.commit()
     
     # Создаем клавиатуру с кнопкой оплаты
-    keyboard = [[InlineKeyboardButton("Оплатить", url=payment["payUrl"])]]
+    keyboard = [[InlineKeyboardButton("Оплатить", url=pay_url)]]
     reply_markup = InlineKeyboardMarkup(keyboard)
     
     await query.edit_message_text(
@@ -136,41 +170,121 @@ async def tariff_chosen(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     return CONFIRMING_PAYMENT
 
-async def status(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def load_traffic(panel_pool: PanelPool, node: Optional[str], vpn_key: str) -> Optional[dict]:
+    """Загрузка счетчиков трафика ключа из панели его узла"""
+    inbound = await panel_pool.get_inbound(node, vpn_key)
+    if not inbound.get("success"):
+        return None
+    return {"up": inbound["obj"]["up"], "down": inbound["obj"]["down"]}
+
+async def get_active_subscription(db: AsyncSession, telegram_id: int) -> Optional[Subscription]:
+    """Активная подписка пользователя одним запросом"""
+    return await db.scalar(
+        select(Subscription)
+        .join(User, Subscription.user_id == User.id)
+        .where(User.telegram_id == telegram_id, Subscription.is_active == True)
+        .limit(1)
+    )
+
+SHOW_KEY_MARKUP = InlineKeyboardMarkup([[InlineKeyboardButton("🔑 Показать ключ", callback_data="show_key")]])
+
+@throttled
+@with_session
+async def status(update: Update, context: ContextTypes.DEFAULT_TYPE, db: AsyncSession):
     """Обработчик команды /status"""
-    db = next(get_db())
-    user = await db.query(User).filter(User.telegram_id == update.effective_user.id).first()
-    
-    if not user:
-        await update.message.reply_text("Пожалуйста, начните с команды /start")
-        return
+    telegram_id = update.effective_user.id
     
-    # Получаем активную подписку
-    subscription = await db.query(Subscription).filter(
-        Subscription.user_id == user.id,
-        Subscription.is_active == True
-    ).first()
+    subscription = await get_active_subscription(db, telegram_id)
     
     if not subscription:
+        user_id = await db.scalar(select(User.id).where(User.telegram_id == telegram_id))
+        if user_id is None:
+            await update.message.reply_text("Пожалуйста, начните с команды /start")
+            return
         await update.message.reply_text(
             "У вас нет активной подписки.\n"
             "Используйте команду /buy для покупки."
         )
         return
     
-    # Получаем информацию о ключе
-    inbound = await panel_api.get_inbound(subscription.vpn_key)
+    # Счетчики, синхронизированные фоновой задачей, читаем прямо из базы
+    synced_at = subscription.traffic_synced_at
+    if synced_at and datetime.utcnow() - synced_at < timedelta(seconds=2 * settings.TRAFFIC_SYNC_INTERVAL):
+        await update.message.reply_text(
+            f"Статус вашей подписки:\n"
+            f"Действует до: {subscription.end_date.strftime('%d.%m.%Y')}\n"
+            f"Трафик: ↑{subscription.up_traffic}MB ↓{subscription.down_traffic}MB",
+            reply_markup=SHOW_KEY_MARKUP
+        )
+        return
     
-    if not inbound.get("success"):
+    # Иначе получаем информацию о ключе (из кэша, если она свежая)
+    try:
+        traffic = await inbound_cache.get_or_load(
+            (subscription.node, subscription.vpn_key),
+            lambda: load_traffic(context.bot_data["panel_pool"], subscription.node, subscription.vpn_key)
+        )
+    except Exception:
+        logger.warning("Failed to load traffic for %s", subscription.vpn_key, exc_info=True)
+        traffic = None
+    
+    # Узел недоступен: отдаем последние синхронизированные счетчики
+    if traffic is None and synced_at:
+        traffic = {"up": subscription.up_traffic, "down": subscription.down_traffic}
+    
+    if traffic is None:
         await update.message.reply_text("Ошибка при получении информации о ключе.")
         return
     
     await update.message.reply_text(
         f"Статус вашей подписки:\n"
         f"Действует до: {subscription.end_date.strftime('%d.%m.%Y')}\n"
-        f"Трафик: ↑{inbound['obj']['up']}MB ↓{inbound['obj']['down']}MB"
+        f"Трафик: ↑{traffic['up']}MB ↓{traffic['down']}MB",
+        reply_markup=SHOW_KEY_MARKUP
     )
 
+async def ensure_vpn_config(
+    panel_pool: PanelPool,
+    db: AsyncSession,
+    subscription: Subscription,
+    telegram_id: int
+) -> Optional[str]:
+    """Конфигурация ключа; для старых подписок собирается по данным панели"""
+    if subscription.vpn_config:
+        return subscription.vpn_config
+    inbound = await panel_pool.get_inbound(subscription.node, subscription.vpn_key)
+    if not inbound.get("success"):
+        return None
+    subscription.vpn_config = panel_pool.vpn_config(subscription.node, inbound["obj"], f"user_{telegram_id}")
+    await db.commit()
+    return subscription.vpn_config
+
+@throttled
+@with_session
+async def show_key(update: Update, context: ContextTypes.DEFAULT_TYPE, db: AsyncSession):
+    """Отправка конфигурации ключа с QR-кодом"""
+    query = update.callback_query
+    await query.answer()
+    
+    subscription = await get_active_subscription(db, query.from_user.id)
+    if not subscription:
+        await query.message.reply_text(
+            "У вас нет активной подписки.\n"
+            "Используйте команду /buy для покупки."
+        )
+        return
+    
+    try:
+        config = await ensure_vpn_config(context.bot_data["panel_pool"], db, subscription, query.from_user.id)
+    except Exception:
+        logger.warning("Failed to build config for %s", subscription.vpn_key, exc_info=True)
+        config = None
+    if config is None:
+        await query.message.reply_text("Ошибка при получении информации о ключе.")
+        return
+    
+    await send_qr(context.bot, db, query.message.chat_id, config)
+
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /help"""
     await update.message.reply_text(
@@ -181,14 +295,62 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "/help - Показать это сообщение"
     )
 
-def main():
-    """Запуск бота"""
-    application = Application.builder().token(settings.BOT_TOKEN).build()
+async def on_startup(application: Application):
+    """Открытие общих HTTP-клиентов и запуск воркеров при старте бота"""
+    panel_pool = application.bot_data["panel_pool"]
+    payment_system = application.bot_data["payment_system"]
+    await panel_pool.start()
+    await panel_pool.check_health()
+    await payment_system.start()
+    await tariff_catalog.load()
+    
+    outbox_worker = OutboxWorker(panel_pool, application.bot)
+    outbox_worker.start()
+    application.bot_data["outbox_worker"] = outbox_worker
+    
+    # Незавершенные рассылки продолжает только один воркер, иначе
+    # пользователи получили бы сообщение от каждого
+    if is_primary_worker():
+        await resume_broadcasts(application.bot)
+    
+    # В режиме вебхука /metrics отдает webhooks.py
+    if settings.BOT_MODE != "webhook" and settings.METRICS_PORT:
+        application.bot_data["metrics_server"] = await metrics.start_metrics_server(settings.METRICS_PORT)
+
+async def on_shutdown(application: Application):
+    """Остановка воркеров и закрытие HTTP-клиентов при остановке бота"""
+    await stop_broadcasts()
+    await application.bot_data["outbox_worker"].stop()
+    await application.bot_data["panel_pool"].close()
+    await application.bot_data["payment_system"].close()
+    if "metrics_server" in application.bot_data:
+        await application.bot_data.pop("metrics_server").cleanup()
+
+def build_application() -> Application:
+    """Создание приложения бота со всеми обработчиками и задачами"""
+    application = (
+        Application.builder()
+        .token(settings.BOT_TOKEN)
+        .base_url(settings.TELEGRAM_API_URL)
+        .concurrent_updates(settings.BOT_CONCURRENT_UPDATES)
+        .persistence(SqlPersistence())
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+        .build()
+    )
+    
+    # Клиенты создаются вместе с приложением, а не при импорте модуля;
+    # соединения открываются в on_startup
+    panel_pool = PanelPool()
+    payment_system = PaymentSystem()
+    application.bot_data["panel_pool"] = panel_pool
+    application.bot_data["payment_system"] = payment_system
     
     # Добавляем обработчики команд
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("help", help_command))
     application.add_handler(CommandHandler("status", status))
+    application.add_handler(CallbackQueryHandler(show_key, pattern="^show_key$"))
     
     # Добавляем ConversationHandler для процесса покупки
     conv_handler = ConversationHandler(
@@ -201,12 +363,97 @@ def main():
                 CallbackQueryHandler(tariff_chosen, pattern="^tariff_")
             ]
         },
-        fallbacks=[CommandHandler("cancel", lambda u, c: ConversationHandler.END)]
+        fallbacks=[CommandHandler("cancel", lambda u, c: ConversationHandler.END)],
+        name="purchase",
+        persistent=True
     )
     application.add_handler(conv_handler)
+    setup_admin_handlers(application)
+    metrics.instrument_handlers(application)
+    
+    # Проверка узлов панели и их нагрузки для размещения новых ключей
+    # (состояние узлов у каждого воркера свое)
+    application.job_queue.run_repeating(
+        panel_health_job,
+        interval=settings.PANEL_HEALTH_INTERVAL,
+        first=settings.PANEL_HEALTH_INTERVAL,
+        data=panel_pool
+    )
+    
+    # Задачи ниже работают со всей базой, а не с чатами воркера,
+    # поэтому при нескольких воркерах их запускает только первый
+    if not is_primary_worker():
+        return application
+    
+    # Фоновая синхронизация трафика из панели
+    application.job_queue.run_repeating(
+        traffic_sync_job,
+        interval=settings.TRAFFIC_SYNC_INTERVAL,
+        first=10,
+        data=panel_pool
+    )
+    
+    # Сверка счетчиков статистики с исходными таблицами
+    application.job_queue.run_repeating(
+        stats.reconcile_stats_job,
+        interval=settings.STATS_RECONCILE_INTERVAL,
+        first=60
+    )
+    
+    # Сверка зависших платежей, если вебхук об оплате потерялся
+    application.job_queue.run_repeating(
+        payment_reconcile_job,
+        interval=settings.PAYMENT_RECONCILE_INTERVAL,
+        first=90,
+        data=payment_system
+    )
+    
+    # Отключение истекших подписок
+    application.job_queue.run_repeating(
+        expiry_sweep_job,
+        interval=settings.EXPIRY_SWEEP_INTERVAL,
+        first=30,
+        data=panel_pool
+    )
+    
+    return application
+
+async def start_webhook_application() -> Application:
+    """Запуск бота внутри ASGI-приложения (режим вебхука)
+
+    Повторяет последовательность run_polling/run_webhook, но обновления
+    в очередь кладет обработчик /telegram/webhook из webhooks.py.
+    """
+    application = build_application()
+    await application.initialize()
+    await application.post_init(application)
+    await application.start()
+    
+    if settings.BOT_WEBHOOK_URL:
+        await application.bot.set_webhook(
+            url=f"{settings.BOT_WEBHOOK_URL}{settings.BOT_WEBHOOK_PATH}",
+            secret_token=settings.BOT_WEBHOOK_SECRET,
+            max_connections=settings.BOT_WEBHOOK_MAX_CONNECTIONS,
+            allowed_updates=Update.ALL_TYPES
+        )
+    return application
+
+async def stop_webhook_application(application: Application):
+    """Остановка бота, запущенного start_webhook_application"""
+    await application.stop()
+    await application.shutdown()
+    await application.post_shutdown(application)
+
+def main():
+    """Запуск бота"""
+    if settings.BOT_MODE == "webhook":
+        # Бот обслуживается тем же ASGI-приложением, что и платежные вебхуки
+        import uvicorn
+        uvicorn.run("webhooks:create_app", factory=True, host=settings.WEBHOOK_HOST, port=settings.WEBHOOK_PORT)
+        return
     
-    # Запускаем бота
-    application.run_polling()
+    # Режим long polling для разработки
+    build_application().run_polling()
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file
@@ -0,0 +1,178 @@
+import asyncio
+import logging
+import time
+from datetime import datetime, timedelta
+from typing import Dict, Set
+
+from sqlalchemy import select, update
+from telegram import Bot
+from telegram.error import BadRequest, Forbidden, RetryAfter, TelegramError
+
+from config import settings
+from database import async_session
+from models import Broadcast, User
+from throttle import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+class PerChatLimiter:
+    """Не больше одного сообщения в чат за interval секунд"""
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._next_allowed: Dict[int, float] = {}
+
+    async def wait(self, chat_id: int):
+        now = time.monotonic()
+        # Слот резервируется до ожидания, чтобы параллельные отправки в один чат не совпали
+        slot = max(now, self._next_allowed.get(chat_id, 0.0))
+        self._next_allowed[chat_id] = slot + self.interval
+        # Не даем словарю расти бесконечно
+        if len(self._next_allowed) > 10000:
+            self._next_allowed = {k: v for k, v in self._next_allowed.items() if v > now}
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+# Общие на процесс лимиты Telegram
+global_bucket = TokenBucket(settings.BROADCAST_RATE)
+chat_limiter = PerChatLimiter(settings.BROADCAST_PER_CHAT_INTERVAL)
+
+_tasks: Set[asyncio.Task] = set()
+
+def _retry_after_seconds(error: RetryAfter) -> float:
+    retry_after = error.retry_after
+    if isinstance(retry_after, timedelta):
+        return retry_after.total_seconds()
+    return float(retry_after)
+
+async def send_with_limits(bot: Bot, chat_id: int, text: str) -> str:
+    """Отправка одного сообщения: sent, blocked или failed"""
+    for _ in range(3):
+        await global_bucket.acquire()
+        await chat_limiter.wait(chat_id)
+        try:
+            await bot.send_message(chat_id=chat_id, text=text)
+            return "sent"
+        except RetryAfter as e:
+            delay = _retry_after_seconds(e)
+            logger.warning("Flood limit hit, pausing broadcast for %.0fs", delay)
+            global_bucket.pause(delay)
+        except Forbidden:
+            return "blocked"
+        except BadRequest as e:
+            if "chat not found" in str(e).lower():
+                return "blocked"
+            return "failed"
+        except TelegramError:
+            logger.exception("Failed to send broadcast to %s", chat_id)
+            return "failed"
+    return "failed"
+
+def _progress_text(broadcast: Broadcast, rate: float) -> str:
+    status = {"running": "⏳ идет", "done": "✅ завершена"}.get(broadcast.status, broadcast.status)
+    return (
+        f"📣 Рассылка #{broadcast.id}: {status}\n\n"
+        f"Отправлено: {broadcast.sent}\n"
+        f"Заблокировали бота: {broadcast.blocked}\n"
+        f"Ошибок: {broadcast.failed}\n"
+        f"Скорость: {rate:.1f} сообщ/с"
+    )
+
+async def _update_progress(bot: Bot, broadcast: Broadcast, rate: float):
+    if not broadcast.progress_message_id:
+        return
+    try:
+        await bot.edit_message_text(
+            chat_id=broadcast.admin_chat_id,
+            message_id=broadcast.progress_message_id,
+            text=_progress_text(broadcast, rate)
+        )
+    except TelegramError:
+        logger.debug("Failed to update broadcast progress", exc_info=True)
+
+async def run_broadcast(bot: Bot, broadcast_id: int):
+    """Рассылка по активным пользователям с сохранением прогресса
+
+    Курсор (последний обработанный User.id) сохраняется после каждой
+    пачки, поэтому после перезапуска рассылка продолжается с места
+    остановки; повторно может уйти не больше одной пачки.
+    """
+    semaphore = asyncio.Semaphore(settings.BROADCAST_CONCURRENCY)
+    started = time.monotonic()
+    sent_at_start = None
+    last_progress = 0.0
+
+    async def deliver(telegram_id: int, text: str) -> str:
+        async with semaphore:
+            return await send_with_limits(bot, telegram_id, text)
+
+    while True:
+        async with async_session() as db:
+            broadcast = await db.get(Broadcast, broadcast_id)
+            if broadcast is None or broadcast.status != "running":
+                return
+            if sent_at_start is None:
+                sent_at_start = broadcast.sent
+            recipients = (await db.execute(
+                select(User.id, User.telegram_id)
+                .where(User.is_active == True, User.id > broadcast.last_user_id)
+                .order_by(User.id)
+                .limit(settings.BROADCAST_CHUNK_SIZE)
+            )).all()
+
+        # Отправка идет без открытой транзакции
+        results = await asyncio.gather(*(
+            deliver(row.telegram_id, broadcast.text) for row in recipients
+        ))
+        blocked_ids = [row.id for row, result in zip(recipients, results) if result == "blocked"]
+
+        async with async_session() as db:
+            broadcast = await db.get(Broadcast, broadcast_id)
+            if recipients:
+                if blocked_ids:
+                    await db.execute(
+                        update(User)
+                        .where(User.id.in_(blocked_ids))
+                        .values(is_active=False)
+                        .execution_options(synchronize_session=False)
+                    )
+                broadcast.sent += results.count("sent")
+                broadcast.failed += results.count("failed")
+                broadcast.blocked += len(blocked_ids)
+                broadcast.last_user_id = recipients[-1].id
+            else:
+                broadcast.status = "done"
+                broadcast.finished_at = datetime.utcnow()
+            await db.commit()
+
+        now = time.monotonic()
+        if broadcast.status == "done" or now - last_progress >= settings.BROADCAST_PROGRESS_INTERVAL:
+            rate = (broadcast.sent - sent_at_start) / max(now - started, 1e-6)
+            await _update_progress(bot, broadcast, rate)
+            last_progress = now
+        if broadcast.status == "done":
+            logger.info("Broadcast %s finished: sent=%d blocked=%d failed=%d",
+                        broadcast.id, broadcast.sent, broadcast.blocked, broadcast.failed)
+            return
+
+def start_broadcast(bot: Bot, broadcast_id: int):
+    """Запуск рассылки в фоне"""
+    task = asyncio.create_task(run_broadcast(bot, broadcast_id))
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+
+async def resume_broadcasts(bot: Bot):
+    """Продолжение рассылок, прерванных перезапуском"""
+    async with async_session() as db:
+        broadcast_ids = (await db.scalars(
+            select(Broadcast.id).where(Broadcast.status == "running")
+        )).all()
+    for broadcast_id in broadcast_ids:
+        logger.info("Resuming broadcast %s", broadcast_id)
+        start_broadcast(bot, broadcast_id)
+
+async def stop_broadcasts():
+    """Остановка фоновых рассылок; прогресс уже сохранен в базе"""
+    for task in list(_tasks):
+        task.cancel()
+    await asyncio.gather(*_tasks, return_exceptions=True)
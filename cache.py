@@ -0,0 +1,111 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional
+
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+class TTLCache:
+    """LRU-кэш с ограничением размера, временем жизни и отдачей устаревших данных"""
+
+    def __init__(self, maxsize: int, ttl: float, stale_ttl: float = 0.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.hits = 0
+        self.misses = 0
+        self.stale_hits = 0
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._refreshing: Dict[Hashable, asyncio.Task] = {}
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """Получение свежего значения без загрузки"""
+        entry = self._data.get(key)
+        if entry is None or time.monotonic() - entry[1] >= self.ttl:
+            return None
+        self._data.move_to_end(key)
+        return entry[0]
+
+    def set(self, key: Hashable, value: Any):
+        """Сохранение значения с вытеснением самых старых записей"""
+        self._data[key] = (value, time.monotonic())
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def invalidate(self, key: Hashable):
+        """Удаление значения из кэша"""
+        self._data.pop(key, None)
+        task = self._refreshing.pop(key, None)
+        if task is not None:
+            task.cancel()
+
+    def clear(self):
+        """Полная очистка кэша"""
+        for key in list(self._refreshing):
+            self.invalidate(key)
+        self._data.clear()
+
+    async def _load(self, key: Hashable, loader: Callable[[], Awaitable[Any]]) -> Optional[Any]:
+        """Загрузка значения; None не кэшируется"""
+        value = await loader()
+        if value is not None:
+            self.set(key, value)
+        return value
+
+    def _refresh_in_background(self, key: Hashable, loader: Callable[[], Awaitable[Any]]):
+        """Фоновое обновление устаревшего значения (одно на ключ)"""
+        if key in self._refreshing:
+            return
+
+        async def refresh():
+            try:
+                await self._load(key, loader)
+            except Exception:
+                logger.exception("Failed to refresh cache entry %s", key)
+            finally:
+                self._refreshing.pop(key, None)
+
+        self._refreshing[key] = asyncio.create_task(refresh())
+
+    async def get_or_load(self, key: Hashable, loader: Callable[[], Awaitable[Any]]) -> Optional[Any]:
+        """Получение значения из кэша или через loader"""
+        entry = self._data.get(key)
+        if entry is not None:
+            value, stored_at = entry
+            age = time.monotonic() - stored_at
+            if age < self.ttl:
+                self.hits += 1
+                self._data.move_to_end(key)
+                return value
+            if age < self.ttl + self.stale_ttl:
+                # Отдаем устаревшее значение сразу, обновляем в фоне
+                self.stale_hits += 1
+                self._data.move_to_end(key)
+                self._refresh_in_background(key, loader)
+                return value
+
+        self.misses += 1
+        return await self._load(key, loader)
+
+    def stats(self) -> Dict[str, int]:
+        """Счетчики попаданий и промахов"""
+        return {
+            "size": len(self._data),
+            "hits": self.hits,
+            "stale_hits": self.stale_hits,
+            "misses": self.misses
+        }
+
+# Кэш счетчиков трафика по (Subscription.node, Subscription.vpn_key)
+inbound_cache = TTLCache(
+    maxsize=settings.STATUS_CACHE_SIZE,
+    ttl=settings.STATUS_CACHE_TTL,
+    stale_ttl=settings.STATUS_CACHE_STALE_TTL
+)
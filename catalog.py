@@ -0,0 +1,101 @@
+import asyncio
+import logging
+import time
+from typing import Dict, List, Optional
+
+from sqlalchemy import insert, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+from config import settings
+from database import async_session
+from models import CacheVersion, Tariff
+
+logger = logging.getLogger(__name__)
+
+TARIFFS_VERSION = "tariffs"
+
+async def get_version(db: AsyncSession, name: str) -> int:
+    """Текущая версия кэшируемых данных"""
+    value = await db.scalar(select(CacheVersion.value).where(CacheVersion.name == name))
+    return value or 0
+
+async def bump_version(db: AsyncSession, name: str):
+    """Увеличение версии, чтобы все процессы перечитали данные
+
+    Вызывается в той же транзакции, что и изменение данных.
+    """
+    result = await db.execute(
+        update(CacheVersion)
+        .where(CacheVersion.name == name)
+        .values(value=CacheVersion.value + 1)
+    )
+    if result.rowcount == 0:
+        await db.execute(insert(CacheVersion).values(name=name, value=1))
+
+class TariffCatalog:
+    """Кэш активных тарифов и готовой клавиатуры для /buy"""
+
+    def __init__(self):
+        self.version = -1
+        self.tariffs: Dict[int, Tariff] = {}
+        self.keyboard: Optional[InlineKeyboardMarkup] = None
+        self._checked_at = 0.0
+        self._lock = asyncio.Lock()
+
+    async def load(self):
+        """Загрузка тарифов из базы"""
+        async with async_session() as db:
+            version = await get_version(db, TARIFFS_VERSION)
+            tariffs = (await db.scalars(
+                select(Tariff).where(Tariff.is_active == True).order_by(Tariff.id)
+            )).all()
+
+        self.tariffs = {tariff.id: tariff for tariff in tariffs}
+        self.keyboard = InlineKeyboardMarkup([
+            [
+                InlineKeyboardButton(
+                    f"{tariff.name} - {tariff.price}₽",
+                    callback_data=f"tariff_{tariff.id}"
+                )
+            ]
+            for tariff in tariffs
+        ]) if tariffs else None
+        self.version = version
+        self._checked_at = time.monotonic()
+        logger.info("Tariff catalog loaded: %d tariffs, version %d", len(tariffs), version)
+
+    def invalidate(self):
+        """Принудительная проверка версии при следующем обращении"""
+        self._checked_at = 0.0
+
+    async def _refresh_if_stale(self):
+        """Сверка версии с базой не чаще раза в TARIFF_CATALOG_CHECK_INTERVAL"""
+        if time.monotonic() - self._checked_at < settings.TARIFF_CATALOG_CHECK_INTERVAL:
+            return
+        async with self._lock:
+            if time.monotonic() - self._checked_at < settings.TARIFF_CATALOG_CHECK_INTERVAL:
+                return
+            async with async_session() as db:
+                version = await get_version(db, TARIFFS_VERSION)
+            if version != self.version:
+                await self.load()
+            else:
+                self._checked_at = time.monotonic()
+
+    async def get(self, tariff_id: int) -> Optional[Tariff]:
+        """Активный тариф по id"""
+        await self._refresh_if_stale()
+        return self.tariffs.get(tariff_id)
+
+    async def get_keyboard(self) -> Optional[InlineKeyboardMarkup]:
+        """Клавиатура выбора тарифа (None, если тарифов нет)"""
+        await self._refresh_if_stale()
+        return self.keyboard
+
+    async def active(self) -> List[Tariff]:
+        """Список активных тарифов"""
+        await self._refresh_if_stale()
+        return list(self.tariffs.values())
+
+tariff_catalog = TariffCatalog()
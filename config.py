@@ -4,18 +4,86 @@ from typing import Optional
 class Settings(BaseSettings):
     # Telegram Bot settings
     BOT_TOKEN: str
+    TELEGRAM_API_URL: str = "https://api.telegram.org/bot"
+    BOT_MODE: str = "polling"  # polling или webhook
+    BOT_CONCURRENT_UPDATES: int = 32
+    BOT_WEBHOOK_URL: Optional[str] = None
+    BOT_WEBHOOK_PATH: str = "/telegram/webhook"
+    # Обязателен при BOT_MODE=webhook
+    BOT_WEBHOOK_SECRET: Optional[str] = None
+    BOT_WEBHOOK_MAX_CONNECTIONS: int = 40
+    BOT_WEBHOOK_MAX_BODY_SIZE: int = 1024 * 1024
+    WEBHOOK_HOST: str = "0.0.0.0"
+    WEBHOOK_PORT: int = 8000
+    BOT_PERSISTENCE_FLUSH_INTERVAL: float = 10.0
+    # Адреса всех воркеров бота (для маршрутизации обновлений по чатам) и номер текущего
+    BOT_WORKER_URLS: list[str] = []
+    BOT_WORKER_INDEX: int = 0
+    # Не больше THROTTLE_RATE_LIMIT запросов пользователя за THROTTLE_WINDOW секунд
+    THROTTLE_RATE_LIMIT: int = 5
+    THROTTLE_WINDOW: float = 10.0
     
     # 3x-ui API settings
-    PANEL_URL: str
-    PANEL_USERNAME: str
-    PANEL_PASSWORD: str
+    # Одна панель; для нескольких используйте PANEL_NODES
+    PANEL_URL: Optional[str] = None
+    PANEL_USERNAME: Optional[str] = None
+    PANEL_PASSWORD: Optional[str] = None
+    # Пул панелей: [{"name": "de-1", "url": "...", "username": "...", "password": "...",
+    #                "weight": 1, "max_clients": 5000, "host": "vpn.example.com"}, ...]
+    PANEL_NODES: list[dict] = []
+    # Размещение новых ключей по числу клиентов (clients) или трафику (traffic)
+    PANEL_PLACEMENT: str = "clients"
+    PANEL_HEALTH_INTERVAL: float = 60.0
+    PANEL_HEALTH_TIMEOUT: float = 5.0
+    PANEL_NODE_MAX_FAILURES: int = 2
+    PANEL_POOL_LIMIT: int = 100
+    PANEL_POOL_LIMIT_PER_HOST: int = 20
+    PANEL_KEEPALIVE_TIMEOUT: float = 30.0
+    PANEL_REQUEST_TIMEOUT: float = 15.0
+    # Пакетные операции с панелью (миграция, перевыдача ключей)
+    PANEL_BATCH_CONCURRENCY: int = 20
+    PANEL_BATCH_RETRIES: int = 3
+    PANEL_BATCH_RETRY_BASE_DELAY: float = 1.0
+    # Размер пачки при записи перевыданных ключей в подписки
+    REPROVISION_BATCH_SIZE: int = 1000
     
     # Database settings
     DATABASE_URL: str = "sqlite+aiosqlite:///bot.db"
+    DB_ECHO: bool = False
+    DB_POOL_SIZE: int = 10
+    DB_MAX_OVERFLOW: int = 20
+    DB_POOL_TIMEOUT: float = 30.0
+    DB_POOL_RECYCLE: int = 1800
+    DB_POOL_PRE_PING: bool = True
+    DB_QUERY_CACHE_SIZE: int = 500
+    DB_STATEMENT_CACHE_SIZE: int = 100
     
     # Payment system settings
     PAYMENT_TOKEN: str
     PAYMENT_WEBHOOK_URL: str
+    PAYMENT_API_URL: str = "https://api.qiwi.com/partner/bill/v1"
+    # Вебхуки QIWI: тело больше лимита отклоняется до проверки подписи;
+    # подписи уже обработанных вебхуков помнятся в памяти, и повторы
+    # отвечаются без обращения к базе
+    PAYMENT_WEBHOOK_MAX_BODY_SIZE: int = 64 * 1024
+    PAYMENT_WEBHOOK_NONCE_CACHE_SIZE: int = 100000
+    PAYMENT_WEBHOOK_NONCE_TTL: int = 24 * 3600
+    PAYMENT_POOL_LIMIT: int = 100
+    PAYMENT_REQUEST_TIMEOUT: float = 10.0
+    PAYMENT_MAX_CONCURRENCY: int = 50
+    PAYMENT_MAX_RETRIES: int = 3
+    PAYMENT_RETRY_BASE_DELAY: float = 0.5
+    # Время жизни счета; неоплаченный счет переиспользуется, пока до конца
+    # его жизни остается больше PAYMENT_BILL_MIN_REMAINING секунд
+    PAYMENT_BILL_LIFETIME: int = 3600
+    PAYMENT_BILL_MIN_REMAINING: int = 300
+    # Сверка зависших платежей: счета старше PAYMENT_RECONCILE_MIN_AGE секунд
+    # проверяются в QIWI не быстрее PAYMENT_RECONCILE_RATE запросов в секунду
+    PAYMENT_RECONCILE_INTERVAL: int = 300
+    PAYMENT_RECONCILE_MIN_AGE: int = 600
+    PAYMENT_RECONCILE_BATCH_SIZE: int = 100
+    PAYMENT_RECONCILE_CONCURRENCY: int = 5
+    PAYMENT_RECONCILE_RATE: float = 5.0
     
     # Admin settings
     ADMIN_IDS: list[int]
@@ -23,6 +91,54 @@ class Settings(BaseSettings):
     # Subscription settings
     DEFAULT_SUBSCRIPTION_DAYS: int = 30
     
+    # Status cache settings
+    STATUS_CACHE_SIZE: int = 10000
+    STATUS_CACHE_TTL: float = 60.0
+    STATUS_CACHE_STALE_TTL: float = 300.0
+    TARIFF_CATALOG_CHECK_INTERVAL: float = 30.0
+    # Метрики: /metrics (в режиме polling - на METRICS_PORT) и выборка медленных запросов
+    METRICS_TOKEN: Optional[str] = None
+    METRICS_PORT: Optional[int] = None
+    METRICS_SLOW_REQUEST_THRESHOLD: float = 1.0
+    METRICS_SLOW_QUERY_THRESHOLD: float = 0.1
+    METRICS_SLOW_SAMPLES: int = 100
+    
+    # QR-коды конфигураций: кэш PNG по содержимому и потоки для отрисовки
+    QR_CACHE_SIZE: int = 1000
+    QR_CACHE_TTL: float = 86400.0
+    QR_WORKERS: int = 2
+    
+    # Traffic sync settings
+    TRAFFIC_SYNC_INTERVAL: int = 300
+    TRAFFIC_SYNC_PAGE_SIZE: int = 500
+    TRAFFIC_SYNC_BATCH_SIZE: int = 1000
+    
+    # Expiry sweeper settings
+    EXPIRY_SWEEP_INTERVAL: int = 600
+    EXPIRY_BATCH_SIZE: int = 500
+    EXPIRY_CONCURRENCY: int = 10
+    EXPIRY_DELETE_INBOUNDS: bool = False
+    
+    # Provisioning outbox settings
+    OUTBOX_POLL_INTERVAL: float = 2.0
+    OUTBOX_CONCURRENCY: int = 10
+    OUTBOX_MAX_ATTEMPTS: int = 8
+    OUTBOX_RETRY_BASE_DELAY: float = 5.0
+    OUTBOX_RETRY_MAX_DELAY: float = 600.0
+    OUTBOX_LOCK_TIMEOUT: int = 300
+    
+    # Stats rollup settings
+    STATS_RECONCILE_INTERVAL: int = 86400
+    STATS_RECONCILE_DAYS: int = 30
+    STATS_DAYS_SHOWN: int = 7
+    
+    # Broadcast settings
+    BROADCAST_RATE: float = 30.0
+    BROADCAST_PER_CHAT_INTERVAL: float = 1.0
+    BROADCAST_CONCURRENCY: int = 30
+    BROADCAST_CHUNK_SIZE: int = 100
+    BROADCAST_PROGRESS_INTERVAL: float = 5.0
+    
     class Config:
         env_file = ".env"
 
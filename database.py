@@ -1,27 +1,106 @@
+import functools
+from sqlalchemy import inspect
+from sqlalchemy.dialects import postgresql, sqlite
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 from sqlalchemy.orm import sessionmaker
 from config import settings
 from models import Base
+import metrics
 
-engine = create_async_engine(settings.DATABASE_URL, echo=True)
-async_session = sessionmaker(
-    engine, class_=AsyncSession, expire_on_commit=False
-)
+def _engine_options(url: str) -> dict:
+    """Параметры пула соединений и кэшей запросов"""
+    options = {
+        "echo": settings.DB_ECHO,
+        "pool_pre_ping": settings.DB_POOL_PRE_PING,
+        "query_cache_size": settings.DB_QUERY_CACHE_SIZE
+    }
+    # SQLite работает с одним файлом, настройки размера пула к нему не применяются
+    if not url.startswith("sqlite"):
+        options.update(
+            pool_size=settings.DB_POOL_SIZE,
+            max_overflow=settings.DB_MAX_OVERFLOW,
+            pool_timeout=settings.DB_POOL_TIMEOUT,
+            pool_recycle=settings.DB_POOL_RECYCLE
+        )
+    if url.startswith("postgresql+asyncpg"):
+        options["connect_args"] = {"statement_cache_size": settings.DB_STATEMENT_CACHE_SIZE}
+    return options
+
+_engine = None
+_session_factory = None
+
+def get_engine():
+    """Движок базы данных; создается при первом обращении, а не при импорте"""
+    global _engine
+    if _engine is None:
+        _engine = create_async_engine(settings.DATABASE_URL, **_engine_options(settings.DATABASE_URL))
+        metrics.install_db_listeners(_engine)
+    return _engine
+
+def async_session() -> AsyncSession:
+    """Новая сессия базы данных"""
+    global _session_factory
+    if _session_factory is None:
+        _session_factory = sessionmaker(
+            get_engine(), class_=AsyncSession, expire_on_commit=False
+        )
+    return _session_factory()
+
+def __getattr__(name: str):
+    # database.engine для кода, который обращается к движку напрямую
+    if name == "engine":
+        return get_engine()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+def _add_missing_columns(conn):
+    """Добавление новых колонок в уже существующие таблицы"""
+    inspector = inspect(conn)
+    existing_tables = set(inspector.get_table_names())
+    for table in Base.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            continue
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            column_type = column.type.compile(dialect=conn.dialect)
+            conn.exec_driver_sql(
+                f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'
+            )
+
+def _create_missing_indexes(conn):
+    """Создание индексов, появившихся после создания таблиц"""
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(conn, checkfirst=True)
 
 async def init_db():
     """Инициализация базы данных"""
-    async with engine.begin() as conn:
+    async with get_engine().begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
+        await conn.run_sync(_add_missing_columns)
+        await conn.run_sync(_create_missing_indexes)
 
-async def get_session() -> AsyncSession:
-    """Получение сессии базы данных"""
-    async with async_session() as session:
-        yield session
+def upsert(db: AsyncSession, model):
+    """INSERT с поддержкой ON CONFLICT для текущего диалекта"""
+    if db.bind.dialect.name == "postgresql":
+        return postgresql.insert(model)
+    return sqlite.insert(model)
 
 async def get_db():
-    """Генератор для получения сессии базы данных"""
+    """Сессия базы данных на один запрос (зависимость FastAPI)"""
     async with async_session() as session:
-        try:
-            yield session
-        finally:
-            await session.close() 
\ No newline at end of file
+        yield session
+
+def with_session(handler):
+    """Сессия базы данных на одно обновление для обработчиков бота
+
+    Сессия передается обработчику третьим аргументом и закрывается
+    после его завершения.
+    """
+    @functools.wraps(handler)
+    async def wrapper(update, context, *args, **kwargs):
+        async with async_session() as db:
+            return await handler(update, context, db, *args, **kwargs)
+    return wrapper
+ 
\ No newline at end of file
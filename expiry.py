@@ -0,0 +1,181 @@
+import argparse
+import asyncio
+import logging
+import time
+from datetime import datetime
+from typing import Dict, List, Set, Tuple
+
+from sqlalchemy import and_, or_, select, update
+
+from config import settings
+from database import async_session
+from models import Subscription
+from panel_pool import PanelPool
+import stats
+
+logger = logging.getLogger(__name__)
+
+async def _fetch_due(after_id: int, now: datetime, limit: int) -> List[Tuple[int, str, str, bool]]:
+    """Выборка следующей пачки истекших подписок
+
+    Кроме активных истекших подписок выбираются уже захваченные, ключи
+    которых не удалось отключить (проход упал или панель не ответила).
+    """
+    async with async_session() as session:
+        result = await session.execute(
+            select(Subscription.id, Subscription.vpn_key, Subscription.node, Subscription.is_active)
+            .where(
+                or_(
+                    and_(Subscription.is_active == True, Subscription.end_date <= now),
+                    and_(Subscription.is_active == False, Subscription.panel_disabled == False)
+                ),
+                Subscription.id > after_id
+            )
+            .order_by(Subscription.id)
+            .limit(limit)
+        )
+        return list(result.all())
+
+async def _claim(subscription_ids: List[int], now: datetime) -> Set[int]:
+    """Захват истекших подписок одним UPDATE перед отключением ключей
+
+    Подписка, которую успели продлить, уже не подходит под условие и
+    остается активной. Захваченная подписка помечается panel_disabled=False
+    до отключения ключа, поэтому после падения ее подберет следующий проход.
+    """
+    async with async_session() as session:
+        claimed = set((await session.scalars(
+            update(Subscription)
+            .where(
+                Subscription.id.in_(subscription_ids),
+                Subscription.is_active == True,
+                Subscription.end_date <= now
+            )
+            .values(is_active=False, panel_disabled=False)
+            .returning(Subscription.id)
+            .execution_options(synchronize_session=False)
+        )).all())
+        if claimed:
+            await stats.on_subscriptions_expired(session, len(claimed))
+        await session.commit()
+    return claimed
+
+async def _mark_disabled(subscription_ids: List[int]):
+    """Отметка подписок, ключи которых отключены в панели"""
+    async with async_session() as session:
+        await session.execute(
+            update(Subscription)
+            .where(Subscription.id.in_(subscription_ids), Subscription.is_active == False)
+            .values(panel_disabled=True)
+            .execution_options(synchronize_session=False)
+        )
+        await session.commit()
+
+async def _disable_on_panel(
+    panel_pool: PanelPool,
+    batch: List[Tuple[int, str, str, bool]],
+    semaphore: asyncio.Semaphore
+) -> List[int]:
+    """Отключение ключей в панели, возвращает id успешно обработанных подписок"""
+
+    async def disable(subscription_id: int, vpn_key: str, node: str):
+        async with semaphore:
+            try:
+                panel_api = panel_pool.api(node)
+                if settings.EXPIRY_DELETE_INBOUNDS:
+                    response = await panel_api.delete_inbound(int(vpn_key))
+                else:
+                    response = await panel_api.update_inbound(int(vpn_key), {"enable": False})
+            except Exception:
+                logger.exception("Failed to disable inbound %s", vpn_key)
+                return None
+            if not response.get("success"):
+                logger.warning("Panel refused to disable inbound %s: %s", vpn_key, response.get("msg"))
+                return None
+            return subscription_id
+
+    results = await asyncio.gather(*(disable(sid, key, node) for sid, key, node, _ in batch))
+    return [sid for sid in results if sid is not None]
+
+async def sweep_expired(panel_pool: PanelPool, dry_run: bool = False) -> Dict[str, float]:
+    """Отключение истекших подписок пачками
+
+    Подписка сначала захватывается в базе (см. _claim), и только потом ее
+    ключ отключается в панели, поэтому продление, пришедшее одновременно
+    с проходом, не потеряется. Захваченные подписки, ключи которых не
+    удалось отключить (панель не ответила или проход упал), остаются с
+    panel_disabled=False и отключаются следующим проходом.
+    """
+    started = time.perf_counter()
+    now = datetime.utcnow()
+    semaphore = asyncio.Semaphore(settings.EXPIRY_CONCURRENCY)
+    metrics = {"due": 0, "disabled": 0, "failed": 0, "batches": 0, "panel_time": 0.0}
+
+    after_id = 0
+    while True:
+        batch = await _fetch_due(after_id, now, settings.EXPIRY_BATCH_SIZE)
+        if not batch:
+            break
+        after_id = batch[-1][0]
+        metrics["due"] += len(batch)
+        metrics["batches"] += 1
+        if dry_run:
+            continue
+
+        claimed = await _claim([row[0] for row in batch if row[3]], now)
+        # Новые захваченные и оставшиеся с прошлых проходов
+        pending = [row for row in batch if row[0] in claimed or not row[3]]
+        if not pending:
+            continue
+
+        panel_started = time.perf_counter()
+        disabled_ids = await _disable_on_panel(panel_pool, pending, semaphore)
+        metrics["panel_time"] += time.perf_counter() - panel_started
+
+        if disabled_ids:
+            await _mark_disabled(disabled_ids)
+        metrics["failed"] += len(pending) - len(disabled_ids)
+        metrics["disabled"] += len(disabled_ids)
+
+    metrics["elapsed"] = time.perf_counter() - started
+    logger.info(
+        "Expiry sweep%s: due=%d disabled=%d failed=%d batches=%d panel=%.2fs total=%.2fs",
+        " (dry run)" if dry_run else "",
+        metrics["due"], metrics["disabled"], metrics["failed"], metrics["batches"],
+        metrics["panel_time"], metrics["elapsed"]
+    )
+    return metrics
+
+async def expiry_sweep_job(context):
+    """Периодическая задача для JobQueue бота"""
+    try:
+        await sweep_expired(context.job.data)
+    except Exception:
+        logger.exception("Expiry sweep failed")
+
+async def main(dry_run: bool, once: bool):
+    """Запуск планировщика отдельным процессом"""
+    panel_pool = PanelPool()
+    try:
+        while True:
+            try:
+                await sweep_expired(panel_pool, dry_run=dry_run)
+            except Exception:
+                logger.exception("Expiry sweep failed")
+            if once:
+                break
+            await asyncio.sleep(settings.EXPIRY_SWEEP_INTERVAL)
+    finally:
+        await panel_pool.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Отключение истекших подписок")
+    parser.add_argument("--dry-run", action="store_true", help="только посчитать истекшие подписки")
+    parser.add_argument("--once", action="store_true", help="выполнить один проход и выйти")
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        level=logging.INFO
+    )
+    asyncio.run(main(args.dry_run, args.once))
@@ -0,0 +1,50 @@
+import hashlib
+from datetime import datetime
+from typing import Iterable
+
+from sqlalchemy import select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from models import Payment, WebhookEvent
+
+def event_key(endpoint: str, body: bytes) -> str:
+    """Ключ идемпотентности: одинаковые доставки вебхука дают одинаковый ключ"""
+    return f"{endpoint}:{hashlib.sha256(body).hexdigest()}"
+
+async def is_processed(db: AsyncSession, key: str) -> bool:
+    """Был ли вебхук с таким ключом уже обработан"""
+    return await db.scalar(select(WebhookEvent.id).where(WebhookEvent.key == key)) is not None
+
+async def record_event(db: AsyncSession, key: str, endpoint: str):
+    """Запись обработанного вебхука (в транзакции вызывающего)"""
+    db.add(WebhookEvent(key=key, endpoint=endpoint))
+
+async def remember_event(db: AsyncSession, key: str, endpoint: str):
+    """Запись обработанного вебхука отдельной транзакцией; дубликаты игнорируются"""
+    await record_event(db, key, endpoint)
+    try:
+        await db.commit()
+    except IntegrityError:
+        await db.rollback()
+
+async def claim_payment(
+    db: AsyncSession,
+    payment_id: str,
+    from_statuses: Iterable[str],
+    to_status: str,
+    **values
+) -> bool:
+    """Атомарный перевод платежа в новый статус
+
+    Условный UPDATE выполняется одной командой, поэтому из нескольких
+    одновременных запросов (в том числе из разных воркеров uvicorn)
+    платеж получит только один. Транзакцию фиксирует вызывающий.
+    """
+    result = await db.execute(
+        update(Payment)
+        .where(Payment.payment_id == payment_id, Payment.status.in_(list(from_statuses)))
+        .values(status=to_status, claimed_at=datetime.utcnow(), **values)
+        .execution_options(synchronize_session=False)
+    )
+    return result.rowcount == 1
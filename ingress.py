@@ -0,0 +1,99 @@
+import hashlib
+import hmac
+import json
+from typing import Any, Optional
+
+from fastapi import HTTPException, Request
+
+from cache import TTLCache
+from config import settings
+
+try:
+    # Необязательный быстрый парсер; без него используется стандартный json
+    import orjson
+
+    JSON_PARSER = "orjson"
+
+    def loads(body: bytes) -> Any:
+        return orjson.loads(body)
+except ImportError:
+    JSON_PARSER = "json"
+
+    def loads(body: bytes) -> Any:
+        return json.loads(body)
+
+# Пары (эндпоинт, подпись) уже обработанных вебхуков об оплате
+payment_nonces = TTLCache(
+    maxsize=settings.PAYMENT_WEBHOOK_NONCE_CACHE_SIZE,
+    ttl=settings.PAYMENT_WEBHOOK_NONCE_TTL
+)
+
+async def read_body(request: Request, max_size: int) -> bytes:
+    """Чтение тела запроса не длиннее max_size байт
+
+    Заявленная длина проверяется до чтения, фактическая - по мере
+    поступления данных, так что большое тело не попадает в память целиком.
+    """
+    content_length = request.headers.get("Content-Length")
+    if content_length is not None:
+        if not content_length.isdigit():
+            raise HTTPException(status_code=400, detail="Invalid Content-Length")
+        if int(content_length) > max_size:
+            raise HTTPException(status_code=413, detail="Request body too large")
+
+    chunks = []
+    size = 0
+    async for chunk in request.stream():
+        size += len(chunk)
+        if size > max_size:
+            raise HTTPException(status_code=413, detail="Request body too large")
+        chunks.append(chunk)
+    return b"".join(chunks)
+
+def parse_object(body: bytes) -> dict:
+    """Разбор JSON-объекта из тела запроса"""
+    try:
+        data = loads(body)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid JSON")
+    if not isinstance(data, dict):
+        raise HTTPException(status_code=400, detail="Invalid JSON")
+    return data
+
+def payment_signature(body: bytes) -> str:
+    return hmac.new(settings.PAYMENT_TOKEN.encode(), body, hashlib.sha1).hexdigest()
+
+class PaymentWebhook:
+    """Проверенный вебхук об оплате"""
+
+    __slots__ = ("body", "signature", "data")
+
+    def __init__(self, body: bytes, signature: str, data: dict):
+        self.body = body
+        self.signature = signature
+        self.data = data
+
+    def replayed(self, endpoint: str) -> bool:
+        """Этот же подписанный вебхук уже был обработан этим эндпоинтом"""
+        return payment_nonces.get((endpoint, self.signature)) is not None
+
+    def remember(self, endpoint: str):
+        """Запоминание вебхука после успешной обработки (как в event_key, по эндпоинту)"""
+        payment_nonces.set((endpoint, self.signature), True)
+
+async def payment_webhook(request: Request) -> PaymentWebhook:
+    """Прием вебхука QIWI (зависимость FastAPI)
+
+    Тело ограничено по размеру и проверяется подписью до разбора JSON
+    и до любой работы с базой. Хэш считается прямо в цикле событий:
+    при ограниченном теле это десятки микросекунд, дешевле переключения
+    в поток.
+    """
+    signature: Optional[str] = request.headers.get("X-Payment-Sha1-Hash")
+    if not signature:
+        raise HTTPException(status_code=403, detail="Invalid signature")
+    body = await read_body(request, settings.PAYMENT_WEBHOOK_MAX_BODY_SIZE)
+    # Заголовок может содержать не-ASCII символы, сравниваем байты
+    if not hmac.compare_digest(signature.encode("latin-1"), payment_signature(body).encode()):
+        raise HTTPException(status_code=403, detail="Invalid signature")
+    return PaymentWebhook(body, signature, parse_object(body))
@@ -1 +1,7 @@
- 
\ No newline at end of file
+import asyncio
+
+from database import init_db
+
+if __name__ == "__main__":
+    # Создает недостающие таблицы, колонки и индексы; безопасно запускать повторно
+    asyncio.run(init_db())
@@ -0,0 +1,278 @@
+import contextlib
+import contextvars
+import functools
+import logging
+import os
+import time
+import traceback
+from collections import deque
+from datetime import datetime
+from typing import Any, Deque, Dict, List, Optional, Sequence, Tuple
+
+from sqlalchemy import event
+
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_registry: List[Any] = []
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class Counter:
+    """Счетчик с метками в формате Prometheus"""
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        _registry.append(self)
+
+    def inc(self, *label_values: str, amount: float = 1.0):
+        self._values[label_values] = self._values.get(label_values, 0.0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        for values, value in self._values.items():
+            lines.append(f"{self.name}{_format_labels(self.labels, values)} {value}")
+        return lines
+
+class Histogram:
+    """Гистограмма с метками в формате Prometheus"""
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labels: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS
+    ):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        # Для каждой комбинации меток: накопленные счетчики по корзинам, сумма, количество
+        self._series: Dict[Tuple[str, ...], list] = {}
+        _registry.append(self)
+
+    def observe(self, value: float, *label_values: str):
+        series = self._series.get(label_values)
+        if series is None:
+            series = self._series[label_values] = [[0] * len(self.buckets), 0.0, 0]
+        counts = series[0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+        series[1] += value
+        series[2] += 1
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for values, (counts, total, count) in self._series.items():
+            for bound, bucket_count in zip(self.buckets, counts):
+                labels = _format_labels(self.labels, values, f'le="{bound}"')
+                lines.append(f"{self.name}_bucket{labels} {bucket_count}")
+            labels = _format_labels(self.labels, values, 'le="+Inf"')
+            lines.append(f"{self.name}_bucket{labels} {count}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, values)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, values)} {count}")
+        return lines
+
+REQUEST_DURATION = Histogram(
+    "request_duration_seconds", "Duration of bot handlers and HTTP endpoints", ("kind", "name")
+)
+REQUEST_ERRORS = Counter(
+    "request_errors_total", "Failed bot handlers and HTTP endpoints", ("kind", "name")
+)
+REQUEST_QUERIES = Histogram(
+    "request_db_queries", "SQL queries per handler or HTTP request", ("kind",),
+    buckets=(0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 100)
+)
+OUTBOUND_DURATION = Histogram(
+    "outbound_request_duration_seconds", "Duration of panel and payment API calls", ("service", "operation")
+)
+OUTBOUND_ERRORS = Counter(
+    "outbound_errors_total", "Failed panel and payment API calls", ("service", "operation")
+)
+OUTBOUND_RETRIES = Counter(
+    "outbound_retries_total", "Retried panel and payment API calls", ("service", "operation")
+)
+DB_QUERY_DURATION = Histogram(
+    "db_query_duration_seconds", "Duration of SQL statements", ("statement",)
+)
+
+class RequestStats:
+    """Данные одного обработчика или HTTP-запроса"""
+
+    __slots__ = ("kind", "name", "failed", "queries", "db_time", "slow_queries")
+
+    def __init__(self, kind: str, name: str):
+        self.kind = kind
+        self.name = name
+        self.failed = False
+        self.queries = 0
+        self.db_time = 0.0
+        self.slow_queries: List[Dict[str, Any]] = []
+
+_current: contextvars.ContextVar[Optional[RequestStats]] = contextvars.ContextVar("metrics_request", default=None)
+
+# Последние медленные запросы с деталями (/metrics/slow)
+slow_samples: Deque[Dict[str, Any]] = deque(maxlen=settings.METRICS_SLOW_SAMPLES)
+
+@contextlib.asynccontextmanager
+async def track(kind: str, name: str):
+    """Замер обработчика или HTTP-запроса вместе с его SQL-запросами"""
+    stats = RequestStats(kind, name)
+    token = _current.set(stats)
+    started = time.perf_counter()
+    try:
+        yield stats
+    except Exception:
+        stats.failed = True
+        raise
+    finally:
+        elapsed = time.perf_counter() - started
+        _current.reset(token)
+        REQUEST_DURATION.observe(elapsed, stats.kind, stats.name)
+        REQUEST_QUERIES.observe(stats.queries, stats.kind)
+        if stats.failed:
+            REQUEST_ERRORS.inc(stats.kind, stats.name)
+        if elapsed >= settings.METRICS_SLOW_REQUEST_THRESHOLD:
+            _sample_slow(stats, elapsed)
+
+def _sample_slow(stats: RequestStats, elapsed: float):
+    sample = {
+        "at": datetime.utcnow().isoformat(timespec="seconds"),
+        "kind": stats.kind,
+        "name": stats.name,
+        "elapsed": round(elapsed, 4),
+        "failed": stats.failed,
+        "queries": stats.queries,
+        "db_time": round(stats.db_time, 4),
+        "slow_queries": stats.slow_queries
+    }
+    slow_samples.append(sample)
+    logger.warning(
+        "Slow %s %s: %.2fs, %d queries (%.2fs in DB), %d slow queries",
+        stats.kind, stats.name, elapsed, stats.queries, stats.db_time, len(stats.slow_queries)
+    )
+
+def observe_outbound(service: str, operation: str, elapsed: float, error: bool):
+    OUTBOUND_DURATION.observe(elapsed, service, operation)
+    if error:
+        OUTBOUND_ERRORS.inc(service, operation)
+
+def observe_retry(service: str, operation: str):
+    OUTBOUND_RETRIES.inc(service, operation)
+
+def _project_stack() -> List[str]:
+    """Кадры стека из кода проекта (без библиотек)
+
+    Асинхронный движок выполняет запрос в отдельном greenlet, поэтому код,
+    который его вызвал, находится в стеке родительского greenlet.
+    """
+    import greenlet
+
+    parent = greenlet.getcurrent().parent
+    frames = traceback.extract_stack(parent.gr_frame if parent is not None else None)
+    root = os.path.dirname(os.path.abspath(__file__))
+    return [
+        f"{os.path.relpath(frame.filename, root)}:{frame.lineno} in {frame.name}"
+        for frame in frames
+        if frame.filename.startswith(root) and "site-packages" not in frame.filename
+        and frame.filename != __file__
+    ]
+
+def install_db_listeners(engine):
+    """Учет числа и времени SQL-запросов движка"""
+    sync_engine = engine.sync_engine
+
+    # Время старта хранится в контексте выполнения, а не в соединении:
+    # для упавшего запроса after_cursor_execute не вызывается, и запись
+    # в соединении из пула осталась бы в нем навсегда
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if context is not None:
+            context._metrics_started = time.perf_counter()
+
+    @event.listens_for(sync_engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        started = getattr(context, "_metrics_started", None)
+        if started is None:
+            return
+        elapsed = time.perf_counter() - started
+        DB_QUERY_DURATION.observe(elapsed, statement.split(None, 1)[0].upper() if statement else "")
+        stats = _current.get()
+        if stats is None:
+            return
+        stats.queries += 1
+        stats.db_time += elapsed
+        if elapsed >= settings.METRICS_SLOW_QUERY_THRESHOLD:
+            stats.slow_queries.append({
+                "statement": statement[:500],
+                "elapsed": round(elapsed, 4),
+                "stack": _project_stack()
+            })
+
+def instrument_handler(callback, name: str):
+    """Обертка обработчика бота"""
+    @functools.wraps(callback)
+    async def wrapper(update, context, *args, **kwargs):
+        async with track("handler", name):
+            return await callback(update, context, *args, **kwargs)
+    wrapper.metrics_instrumented = True
+    return wrapper
+
+def instrument_handlers(application):
+    """Замер всех обработчиков приложения, включая вложенные в ConversationHandler"""
+    from telegram.ext import ConversationHandler
+
+    def walk(handler):
+        if isinstance(handler, ConversationHandler):
+            nested = list(handler.entry_points) + list(handler.fallbacks)
+            for state_handlers in handler.states.values():
+                nested.extend(state_handlers)
+            for child in nested:
+                walk(child)
+            return
+        if getattr(handler.callback, "metrics_instrumented", False):
+            return
+        name = getattr(handler.callback, "__name__", type(handler).__name__)
+        handler.callback = instrument_handler(handler.callback, name)
+
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            walk(handler)
+
+def render() -> str:
+    """Все метрики в текстовом формате Prometheus"""
+    lines: List[str] = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+async def start_metrics_server(port: int):
+    """Отдельный HTTP-сервер с /metrics для бота в режиме polling"""
+    from aiohttp import web
+
+    async def handle(request):
+        if settings.METRICS_TOKEN and request.headers.get("Authorization") != f"Bearer {settings.METRICS_TOKEN}":
+            return web.Response(status=403)
+        return web.Response(text=render(), content_type="text/plain", charset="utf-8")
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, settings.WEBHOOK_HOST, port).start()
+    return runner
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, DateTime, Boolean, ForeignKey, Float
+from sqlalchemy import Column, Integer, BigInteger, String, Date, DateTime, Boolean, ForeignKey, Float, Index, LargeBinary
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 from datetime import datetime
@@ -20,27 +20,55 @@ class User(Base):
 
 class Subscription(Base):
     __tablename__ = "subscriptions"
+    __table_args__ = (
+        # /status: активная подписка пользователя
+        Index("ix_subscriptions_user_id_is_active", "user_id", "is_active"),
+        # Планировщик истечения: диапазон по end_date среди активных
+        Index("ix_subscriptions_is_active_end_date", "is_active", "end_date"),
+        # Нагрузка и выборка ключей по узлу панели
+        Index("ix_subscriptions_node_is_active", "node", "is_active"),
+        # Планировщик истечения: подписки, ключи которых еще не отключены
+        Index("ix_subscriptions_is_active_panel_disabled", "is_active", "panel_disabled"),
+    )
     
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer, ForeignKey("users.id"))
-    vpn_key = Column(String)
+    vpn_key = Column(String, index=True)
+    node = Column(String)  # Имя узла панели; NULL - первый узел
+    vpn_config = Column(String)  # vless:// ссылка для импорта в клиент
     start_date = Column(DateTime, default=datetime.utcnow)
     end_date = Column(DateTime)
     is_active = Column(Boolean, default=True)
+    up_traffic = Column(BigInteger, default=0)
+    down_traffic = Column(BigInteger, default=0)
+    traffic_synced_at = Column(DateTime)
+    # Отключение ключа планировщиком истечения: False - подписка снята с
+    # активных, ключ в панели еще не отключен; True - отключен; NULL - не
+    # истекала (или истекла до появления колонки)
+    panel_disabled = Column(Boolean)
     
     user = relationship("User", back_populates="subscriptions")
 
 class Payment(Base):
     __tablename__ = "payments"
+    __table_args__ = (
+        # Выручка и поиск зависших платежей по статусу и дате
+        Index("ix_payments_status_created_at", "status", "created_at"),
+        # Поиск неоплаченного счета пользователя по тарифу
+        Index("ix_payments_user_id_tariff_id_status", "user_id", "tariff_id", "status"),
+    )
     
     id = Column(Integer, primary_key=True)
-    user_id = Column(Integer, ForeignKey("users.id"))
+    user_id = Column(Integer, ForeignKey("users.id"), index=True)
+    tariff_id = Column(Integer, ForeignKey("tariffs.id"))
     amount = Column(Float)
     currency = Column(String)
     payment_id = Column(String, unique=True)
+    pay_url = Column(String)
     status = Column(String)
-    created_at = Column(DateTime, default=datetime.utcnow)
+    created_at = Column(DateTime, default=datetime.utcnow, index=True)
     completed_at = Column(DateTime)
+    claimed_at = Column(DateTime)
     
     user = relationship("User", back_populates="payments")
 
@@ -51,4 +79,82 @@ class Tariff(Base):
     name = Column(String)
     price = Column(Float)
     duration_days = Column(Integer)
-    is_active = Column(Boolean, default=True) 
\ No newline at end of file
+    is_active = Column(Boolean, default=True, index=True)
+
+class CacheVersion(Base):
+    __tablename__ = "cache_versions"
+    
+    name = Column(String, primary_key=True)
+    value = Column(Integer, default=0)
+
+class WebhookEvent(Base):
+    __tablename__ = "webhook_events"
+    
+    id = Column(Integer, primary_key=True)
+    key = Column(String, unique=True)
+    endpoint = Column(String)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+class ProvisioningJob(Base):
+    __tablename__ = "provisioning_jobs"
+    __table_args__ = (
+        # Выборка готовых к выполнению задач воркером
+        Index("ix_provisioning_jobs_status_next_attempt_at", "status", "next_attempt_at"),
+    )
+    
+    id = Column(Integer, primary_key=True)
+    payment_id = Column(Integer, ForeignKey("payments.id"), unique=True)
+    user_id = Column(Integer, ForeignKey("users.id"))
+    status = Column(String, default="pending")  # pending, running, done, dead
+    attempts = Column(Integer, default=0)
+    next_attempt_at = Column(DateTime, default=datetime.utcnow)
+    locked_at = Column(DateTime)
+    last_error = Column(String)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    completed_at = Column(DateTime)
+
+class StatsCounter(Base):
+    __tablename__ = "stats_counters"
+    
+    name = Column(String, primary_key=True)
+    value = Column(Float, default=0)
+
+class DailyStats(Base):
+    __tablename__ = "daily_stats"
+    
+    day = Column(Date, primary_key=True)
+    revenue = Column(Float, default=0)
+    payments = Column(Integer, default=0)
+    new_users = Column(Integer, default=0)
+    new_subscriptions = Column(Integer, default=0)
+    churned = Column(Integer, default=0)
+
+class Broadcast(Base):
+    __tablename__ = "broadcasts"
+    
+    id = Column(Integer, primary_key=True)
+    text = Column(String)
+    status = Column(String, default="running")  # running, done
+    last_user_id = Column(Integer, default=0)
+    sent = Column(Integer, default=0)
+    failed = Column(Integer, default=0)
+    blocked = Column(Integer, default=0)
+    admin_chat_id = Column(BigInteger)
+    progress_message_id = Column(Integer)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    finished_at = Column(DateTime)
+
+class BotState(Base):
+    __tablename__ = "bot_state"
+    
+    kind = Column(String, primary_key=True)  # user_data, chat_data, conversation:<name>
+    key = Column(String, primary_key=True)
+    data = Column(LargeBinary)
+    updated_at = Column(DateTime, default=datetime.utcnow)
+
+class QrCode(Base):
+    __tablename__ = "qr_codes"
+    
+    digest = Column(String, primary_key=True)  # sha256 конфигурации
+    file_id = Column(String)  # file_id загруженного в Telegram изображения
+    created_at = Column(DateTime, default=datetime.utcnow)
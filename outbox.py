@@ -0,0 +1,269 @@
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from typing import TYPE_CHECKING, List, Optional, Set
+
+from sqlalchemy import and_, or_, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from cache import inbound_cache
+from config import settings
+from database import async_session
+from idempotency import claim_payment
+from models import Payment, ProvisioningJob, Subscription, User
+from panel_pool import PanelPool
+from renewal import extend_subscription, get_renewable, purchased_days
+import stats
+
+if TYPE_CHECKING:
+    from telegram import Bot, InlineKeyboardMarkup
+
+logger = logging.getLogger(__name__)
+
+def enqueue_provisioning(db: AsyncSession, payment_id: int, user_id: int):
+    """Постановка задачи на выдачу ключа (в транзакции вызывающего)"""
+    db.add(ProvisioningJob(payment_id=payment_id, user_id=user_id))
+
+# Оплата засчитывается и из этих статусов: вебхук или сверка могли опоздать
+PAYABLE_STATUSES = ("pending", "failed", "expired")
+
+async def complete_payment(db: AsyncSession, payment_id: str) -> bool:
+    """Отметка платежа оплаченным и постановка выдачи ключа в очередь
+
+    Общий путь для вебхука об оплате и сверки зависших платежей.
+    Возвращает False, если платеж уже обработан (или не найден).
+    Транзакцию фиксирует вызывающий.
+    """
+    if not await claim_payment(
+        db, payment_id, PAYABLE_STATUSES, "completed",
+        completed_at=datetime.utcnow()
+    ):
+        return False
+    payment = (await db.execute(
+        select(Payment.id, Payment.user_id, Payment.amount).where(Payment.payment_id == payment_id)
+    )).one()
+    enqueue_provisioning(db, payment.id, payment.user_id)
+    await stats.on_payment_completed(db, payment.amount)
+    return True
+
+async def claim_jobs(limit: int) -> List[int]:
+    """Захват готовых к выполнению задач
+
+    Каждая задача захватывается условным UPDATE, поэтому несколько
+    воркеров могут разбирать одну очередь. Задачи, зависшие у упавшего
+    воркера, возвращаются в работу через OUTBOX_LOCK_TIMEOUT.
+    """
+    now = datetime.utcnow()
+    claimable = or_(
+        and_(ProvisioningJob.status == "pending", ProvisioningJob.next_attempt_at <= now),
+        and_(
+            ProvisioningJob.status == "running",
+            ProvisioningJob.locked_at < now - timedelta(seconds=settings.OUTBOX_LOCK_TIMEOUT)
+        )
+    )
+    async with async_session() as db:
+        candidates = (await db.scalars(
+            select(ProvisioningJob.id)
+            .where(claimable)
+            .order_by(ProvisioningJob.next_attempt_at)
+            .limit(limit)
+        )).all()
+
+        claimed = []
+        for job_id in candidates:
+            result = await db.execute(
+                update(ProvisioningJob)
+                .where(ProvisioningJob.id == job_id, claimable)
+                .values(status="running", locked_at=now)
+                .execution_options(synchronize_session=False)
+            )
+            if result.rowcount == 1:
+                claimed.append(job_id)
+        await db.commit()
+    return claimed
+
+def retry_delay(attempts: int) -> float:
+    """Экспоненциальная задержка перед повтором"""
+    return min(settings.OUTBOX_RETRY_BASE_DELAY * (2 ** (attempts - 1)), settings.OUTBOX_RETRY_MAX_DELAY)
+
+class OutboxWorker:
+    """Воркер, выдающий VPN-ключи по задачам из таблицы provisioning_jobs"""
+
+    def __init__(self, panel_pool: PanelPool, bot: Optional["Bot"] = None):
+        self.panel_pool = panel_pool
+        self.bot = bot
+        self._stopping = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        """Запуск фонового цикла"""
+        self._stopping.clear()
+        self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        """Остановка после завершения текущих задач"""
+        self._stopping.set()
+        if self._task is not None:
+            await self._task
+            self._task = None
+
+    async def run(self):
+        """Цикл разбора очереди
+
+        Одновременно выполняется не больше OUTBOX_CONCURRENCY задач; место
+        завершившейся задачи сразу занимает следующая, поэтому медленная
+        задача не задерживает остальные до конца пачки.
+        """
+        running: Set[asyncio.Task] = set()
+        while not self._stopping.is_set():
+            free = settings.OUTBOX_CONCURRENCY - len(running)
+            if free > 0:
+                try:
+                    job_ids = await claim_jobs(free)
+                except Exception:
+                    logger.exception("Outbox poll failed")
+                    job_ids = []
+                for job_id in job_ids:
+                    task = asyncio.create_task(self._process_logged(job_id))
+                    running.add(task)
+                    task.add_done_callback(running.discard)
+
+            stopping = asyncio.ensure_future(self._stopping.wait())
+            if len(running) >= settings.OUTBOX_CONCURRENCY:
+                # Пул заполнен: ждем, пока освободится место
+                await asyncio.wait({stopping, *running}, return_when=asyncio.FIRST_COMPLETED)
+            else:
+                # Готовых задач больше нет: ждем следующего опроса
+                await asyncio.wait({stopping}, timeout=settings.OUTBOX_POLL_INTERVAL)
+            stopping.cancel()
+
+        if running:
+            await asyncio.gather(*running)
+
+    async def drain_once(self) -> int:
+        """Обработка одной пачки задач, не больше OUTBOX_CONCURRENCY одновременно
+
+        Для разового разбора очереди (бенчмарки); фоновый цикл - run().
+        """
+        job_ids = await claim_jobs(settings.OUTBOX_CONCURRENCY)
+        if job_ids:
+            await asyncio.gather(*(self.process(job_id) for job_id in job_ids))
+        return len(job_ids)
+
+    async def _process_logged(self, job_id: int):
+        try:
+            await self.process(job_id)
+        except Exception:
+            # Задача останется в running и вернется в работу через OUTBOX_LOCK_TIMEOUT
+            logger.exception("Provisioning job %s crashed", job_id)
+
+    async def process(self, job_id: int):
+        """Выдача ключа или продление подписки по одной задаче"""
+        async with async_session() as db:
+            try:
+                job = await db.get(ProvisioningJob, job_id)
+            except Exception:
+                # Задача вернется в работу через OUTBOX_LOCK_TIMEOUT
+                logger.exception("Failed to load provisioning job %s", job_id)
+                return
+            # Любая ошибка ниже проходит через _fail, иначе задача осталась бы
+            # в running и бесконечно перезахватывалась без счета попыток
+            try:
+                user = await db.get(User, job.user_id)
+                if user is None:
+                    await self._fail(db, job, f"User {job.user_id} not found", permanent=True)
+                    return
+                telegram_id = user.telegram_id
+                days = await purchased_days(db, job.payment_id)
+                subscription = await get_renewable(db, user.id)
+                renewed = subscription is not None
+                if renewed:
+                    # У пользователя уже есть ключ: продлеваем его, новый не создаем
+                    end_date = await extend_subscription(db, self.panel_pool, subscription, days)
+                else:
+                    node, inbound = await self.panel_pool.create_inbound(
+                        email=f"user_{telegram_id}",
+                        days=days
+                    )
+                    if not inbound.get("success"):
+                        raise Exception(f"Panel error: {inbound.get('msg')}")
+                    end_date = datetime.utcnow() + timedelta(days=days)
+                    subscription = Subscription(
+                        user_id=user.id,
+                        vpn_key=inbound["obj"]["id"],
+                        node=node,
+                        vpn_config=self.panel_pool.vpn_config(node, inbound["obj"], f"user_{telegram_id}"),
+                        start_date=datetime.utcnow(),
+                        end_date=end_date,
+                        is_active=True
+                    )
+                    db.add(subscription)
+                    await stats.on_subscriptions_started(db)
+                job.status = "done"
+                job.attempts += 1
+                job.completed_at = datetime.utcnow()
+                await db.commit()
+            except Exception as e:
+                # После ошибки базы сессию нужно откатить
+                await db.rollback()
+                await db.refresh(job)
+                await self._fail(db, job, str(e))
+                return
+            inbound_cache.invalidate((subscription.node, subscription.vpn_key))
+
+            # telegram импортируется здесь: сервер платежных вебхуков
+            # использует complete_payment и обходится без него
+            from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+            await self._notify(
+                telegram_id,
+                f"✅ Оплата получена, подписка {'продлена' if renewed else 'активирована'}!\n"
+                f"Действует до: {end_date.strftime('%d.%m.%Y')}\n"
+                "Проверить статус: /status",
+                InlineKeyboardMarkup([[InlineKeyboardButton("🔑 Показать ключ", callback_data="show_key")]])
+            )
+
+    async def _fail(self, db: AsyncSession, job: ProvisioningJob, error: str, permanent: bool = False):
+        """Планирование повтора или перевод задачи в dead letter
+
+        permanent - ошибка, которую повтор не исправит (например, нет пользователя).
+        """
+        job.attempts += 1
+        job.last_error = error[:500]
+        if permanent or job.attempts >= settings.OUTBOX_MAX_ATTEMPTS:
+            job.status = "dead"
+            logger.error("Provisioning job %s is dead after %d attempts: %s", job.id, job.attempts, error)
+        else:
+            job.status = "pending"
+            job.next_attempt_at = datetime.utcnow() + timedelta(seconds=retry_delay(job.attempts))
+            logger.warning("Provisioning job %s failed (attempt %d): %s", job.id, job.attempts, error)
+        await db.commit()
+
+    async def _notify(self, telegram_id: int, text: str, reply_markup: Optional["InlineKeyboardMarkup"] = None):
+        """Уведомление пользователя; ошибка отправки не влияет на задачу"""
+        if self.bot is None:
+            return
+        try:
+            await self.bot.send_message(chat_id=telegram_id, text=text, reply_markup=reply_markup)
+        except Exception:
+            logger.exception("Failed to notify user %s", telegram_id)
+
+async def main():
+    """Запуск воркера отдельным процессом"""
+    from telegram import Bot
+
+    panel_pool = PanelPool()
+    bot = Bot(settings.BOT_TOKEN)
+    worker = OutboxWorker(panel_pool, bot)
+    async with bot:
+        try:
+            await panel_pool.check_health()
+            await worker.run()
+        finally:
+            await panel_pool.close()
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        level=logging.INFO
+    )
+    asyncio.run(main())
@@ -1,20 +1,83 @@
+import asyncio
+import json
+import logging
+import random
+import time
 import aiohttp
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, Awaitable, Callable, Iterable, Tuple
 from config import settings
+import metrics
+
+logger = logging.getLogger(__name__)
+
+class Checkpoint:
+    """Файл с результатами пакетной операции (JSON lines) для продолжения после сбоя"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.done: Dict[str, Any] = {}
+        try:
+            with open(path) as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    record = json.loads(line)
+                    if record.get("ok"):
+                        self.done[record["key"]] = record.get("result")
+        except FileNotFoundError:
+            pass
+        self._file = open(path, "a")
+
+    def record(self, key: str, ok: bool, result: Any = None, error: Optional[str] = None):
+        self._file.write(json.dumps({"key": key, "ok": ok, "result": result, "error": error}) + "\n")
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
 
 class PanelAPI:
-    def __init__(self):
-        self.base_url = settings.PANEL_URL
-        self.username = settings.PANEL_USERNAME
-        self.password = settings.PANEL_PASSWORD
+    def __init__(
+        self,
+        base_url: Optional[str] = None,
+        username: Optional[str] = None,
+        password: Optional[str] = None
+    ):
+        self.base_url = base_url or settings.PANEL_URL
+        self.username = username or settings.PANEL_USERNAME
+        self.password = password or settings.PANEL_PASSWORD
         self._token = None
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._login_lock = asyncio.Lock()
 
-    async def _get_token(self) -> str:
-        """Получение токена авторизации"""
-        if self._token:
-            return self._token
+    async def start(self) -> aiohttp.ClientSession:
+        """Открытие общего пула соединений с панелью"""
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=settings.PANEL_POOL_LIMIT,
+                limit_per_host=settings.PANEL_POOL_LIMIT_PER_HOST,
+                keepalive_timeout=settings.PANEL_KEEPALIVE_TIMEOUT
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=settings.PANEL_REQUEST_TIMEOUT)
+            )
+        return self._session
 
-        async with aiohttp.ClientSession() as session:
+    async def close(self):
+        """Закрытие пула соединений"""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+        self._token = None
+
+    async def _login(self, stale_token: Optional[str] = None) -> str:
+        """Авторизация в панели (одна на все конкурирующие запросы)"""
+        async with self._login_lock:
+            # Пока мы ждали блокировку, токен мог обновить другой запрос
+            if self._token and self._token != stale_token:
+                return self._token
+
+            session = await self.start()
             async with session.post(
                 f"{self.base_url}/api/auth/login",
                 json={
@@ -26,25 +89,45 @@ class PanelAPI:
                 if data.get("success"):
                     self._token = data["token"]
                     return self._token
+                self._token = None
                 raise Exception("Failed to get token")
 
-    async def _make_request(self, method: str, endpoint: str, **kwargs) -> Dict[str, Any]:
+    async def _get_token(self) -> str:
+        """Получение токена авторизации"""
+        if self._token:
+            return self._token
+        return await self._login()
+
+    async def _make_request(self, operation: str, method: str, endpoint: str, **kwargs) -> Dict[str, Any]:
         """Выполнение запроса к API"""
-        token = await self._get_token()
-        headers = {"Authorization": f"Bearer {token}"}
-        
-        async with aiohttp.ClientSession() as session:
-            async with session.request(
-                method,
-                f"{self.base_url}{endpoint}",
-                headers=headers,
-                **kwargs
-            ) as response:
-                return await response.json()
+        started = time.perf_counter()
+        error = True
+        try:
+            session = await self.start()
+            token = await self._get_token()
+
+            for attempt in range(2):
+                headers = {"Authorization": f"Bearer {token}"}
+                async with session.request(
+                    method,
+                    f"{self.base_url}{endpoint}",
+                    headers=headers,
+                    **kwargs
+                ) as response:
+                    # Токен истек: перелогиниваемся один раз и повторяем запрос
+                    if response.status == 401 and attempt == 0:
+                        token = await self._login(stale_token=token)
+                        continue
+                    data = await response.json()
+                    error = response.status >= 500
+                    return data
+        finally:
+            metrics.observe_outbound("panel", operation, time.perf_counter() - started, error)
 
     async def create_inbound(self, email: str, days: int) -> Dict[str, Any]:
         """Создание нового VPN-ключа"""
         return await self._make_request(
+            "create_inbound",
             "POST",
             "/api/inbounds",
             json={
@@ -79,18 +162,137 @@ class PanelAPI:
             }
         )
 
+    async def list_inbounds(self, page: int = 1, page_size: int = 500) -> Dict[str, Any]:
+        """Получение страницы списка VPN-ключей"""
+        return await self._make_request(
+            "list_inbounds",
+            "GET",
+            "/api/inbounds",
+            params={"page": page, "limit": page_size}
+        )
+
     async def get_inbound(self, inbound_id: int) -> Dict[str, Any]:
         """Получение информации о VPN-ключе"""
-        return await self._make_request("GET", f"/api/inbounds/{inbound_id}")
+        return await self._make_request("get_inbound", "GET", f"/api/inbounds/{inbound_id}")
 
     async def delete_inbound(self, inbound_id: int) -> Dict[str, Any]:
         """Удаление VPN-ключа"""
-        return await self._make_request("DELETE", f"/api/inbounds/{inbound_id}")
+        return await self._make_request("delete_inbound", "DELETE", f"/api/inbounds/{inbound_id}")
 
     async def update_inbound(self, inbound_id: int, data: Dict[str, Any]) -> Dict[str, Any]:
         """Обновление VPN-ключа"""
         return await self._make_request(
+            "update_inbound",
             "PUT",
             f"/api/inbounds/{inbound_id}",
             json=data
-        ) 
\ No newline at end of file
+        )
+
+    async def _run_batch(
+        self,
+        name: str,
+        items: Iterable[Tuple[str, Callable[[], Awaitable[Dict[str, Any]]]]],
+        concurrency: Optional[int] = None,
+        checkpoint: Optional[str] = None
+    ) -> Dict[str, Any]:
+        """Выполнение операций с ограничением параллелизма и повторами
+
+        items - пары (ключ, функция запроса). Элементы, уже успешно
+        выполненные по файлу checkpoint, пропускаются. Возвращает
+        успешные результаты, ошибки по ключам и время выполнения.
+        """
+        report: Dict[str, Any] = {"ok": {}, "failed": {}, "skipped": 0, "elapsed": 0.0}
+        progress = Checkpoint(checkpoint) if checkpoint else None
+        if progress is not None:
+            report["ok"].update(progress.done)
+        iterator = iter(items)
+        started = time.perf_counter()
+
+        async def run(key: str, request: Callable[[], Awaitable[Dict[str, Any]]]):
+            for attempt in range(settings.PANEL_BATCH_RETRIES + 1):
+                try:
+                    response = await request()
+                    if response.get("success"):
+                        return response.get("obj")
+                    error = f"Panel error: {response.get('msg')}"
+                except Exception as e:
+                    error = f"{type(e).__name__}: {e}"
+                if attempt < settings.PANEL_BATCH_RETRIES:
+                    delay = settings.PANEL_BATCH_RETRY_BASE_DELAY * (2 ** attempt)
+                    await asyncio.sleep(random.uniform(0, delay))
+            raise RuntimeError(error)
+
+        async def worker():
+            # Итератор общий: задачи не создаются заранее для всех элементов
+            for key, request in iterator:
+                key = str(key)
+                if progress is not None and key in progress.done:
+                    report["skipped"] += 1
+                    continue
+                try:
+                    result = await run(key, request)
+                except RuntimeError as e:
+                    report["failed"][key] = str(e)
+                    if progress is not None:
+                        progress.record(key, False, error=str(e))
+                    continue
+                report["ok"][key] = result
+                if progress is not None:
+                    progress.record(key, True, result=result)
+
+        try:
+            await asyncio.gather(*(
+                worker() for _ in range(concurrency or settings.PANEL_BATCH_CONCURRENCY)
+            ))
+        finally:
+            if progress is not None:
+                progress.close()
+        report["elapsed"] = time.perf_counter() - started
+        logger.info(
+            "Panel batch %s: ok=%d failed=%d skipped=%d in %.2fs",
+            name, len(report["ok"]), len(report["failed"]),
+            report["skipped"], report["elapsed"]
+        )
+        return report
+
+    async def create_inbounds(
+        self,
+        specs: Iterable[Tuple[str, str, int]],
+        concurrency: Optional[int] = None,
+        checkpoint: Optional[str] = None
+    ) -> Dict[str, Any]:
+        """Пакетное создание VPN-ключей по тройкам (ключ, email, дни)"""
+        return await self._run_batch(
+            "create_inbounds",
+            ((key, lambda email=email, days=days: self.create_inbound(email, days))
+             for key, email, days in specs),
+            concurrency, checkpoint
+        )
+
+    async def delete_inbounds(
+        self,
+        inbound_ids: Iterable[int],
+        concurrency: Optional[int] = None,
+        checkpoint: Optional[str] = None
+    ) -> Dict[str, Any]:
+        """Пакетное удаление VPN-ключей"""
+        return await self._run_batch(
+            "delete_inbounds",
+            ((inbound_id, lambda inbound_id=inbound_id: self.delete_inbound(inbound_id))
+             for inbound_id in inbound_ids),
+            concurrency, checkpoint
+        )
+
+    async def update_inbounds(
+        self,
+        updates: Iterable[Tuple[int, Dict[str, Any]]],
+        concurrency: Optional[int] = None,
+        checkpoint: Optional[str] = None
+    ) -> Dict[str, Any]:
+        """Пакетное обновление VPN-ключей по парам (id, данные)"""
+        return await self._run_batch(
+            "update_inbounds",
+            ((inbound_id, lambda inbound_id=inbound_id, data=data: self.update_inbound(inbound_id, data))
+             for inbound_id, data in updates),
+            concurrency, checkpoint
+        )
@@ -0,0 +1,239 @@
+import asyncio
+import logging
+import time
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+from urllib.parse import urlparse
+
+from sqlalchemy import func, or_, select
+
+from config import settings
+from database import async_session
+from models import Subscription
+from panel_api import PanelAPI
+from utils import generate_vpn_config
+
+logger = logging.getLogger(__name__)
+
+# Имя узла, если настроена одна панель через PANEL_URL
+DEFAULT_NODE = "default"
+
+class PanelNode:
+    """Одна панель 3x-ui со своим клиентом и данными о нагрузке"""
+
+    def __init__(
+        self,
+        name: str,
+        api: PanelAPI,
+        weight: float = 1.0,
+        max_clients: Optional[int] = None,
+        host: Optional[str] = None
+    ):
+        self.name = name
+        self.api = api
+        # Адрес VPN-сервера для клиентских конфигураций
+        self.host = host or urlparse(api.base_url).hostname
+        self.weight = weight
+        self.max_clients = max_clients
+        self.healthy = True
+        self.failures = 0
+        self.latency: Optional[float] = None
+        self.clients = 0
+        self.traffic = 0
+        self.checked_at: Optional[datetime] = None
+
+    def load(self) -> float:
+        """Нагрузка с учетом веса узла (PANEL_PLACEMENT: clients или traffic)"""
+        value = self.traffic if settings.PANEL_PLACEMENT == "traffic" else self.clients
+        return value / self.weight
+
+    def has_capacity(self) -> bool:
+        return self.max_clients is None or self.clients < self.max_clients
+
+class PanelPool:
+    """Пул панелей: размещение новых ключей и доступ к ключам по узлу
+
+    Подписки, созданные до настройки PANEL_NODES (node = NULL), считаются
+    размещенными на первом узле списка.
+    """
+
+    def __init__(self, nodes: Optional[List[Dict[str, Any]]] = None):
+        configs = nodes if nodes is not None else settings.PANEL_NODES
+        if not configs:
+            configs = [{
+                "name": DEFAULT_NODE,
+                "url": settings.PANEL_URL,
+                "username": settings.PANEL_USERNAME,
+                "password": settings.PANEL_PASSWORD
+            }]
+        self.nodes: Dict[str, PanelNode] = {}
+        for config in configs:
+            self.nodes[config["name"]] = PanelNode(
+                config["name"],
+                PanelAPI(config["url"], config.get("username"), config.get("password")),
+                weight=float(config.get("weight", 1)),
+                max_clients=config.get("max_clients"),
+                host=config.get("host")
+            )
+        self.default = next(iter(self.nodes))
+
+    async def start(self):
+        for node in self.nodes.values():
+            await node.api.start()
+
+    async def close(self):
+        for node in self.nodes.values():
+            await node.api.close()
+
+    def node(self, name: Optional[str]) -> PanelNode:
+        """Узел подписки по значению Subscription.node"""
+        return self.nodes[name or self.default]
+
+    def api(self, name: Optional[str]) -> PanelAPI:
+        return self.node(name).api
+
+    def node_filter(self, name: str):
+        """Условие выборки подписок узла"""
+        if name == self.default:
+            return or_(Subscription.node == name, Subscription.node.is_(None))
+        return Subscription.node == name
+
+    def _mark(self, node: PanelNode, ok: bool):
+        """Учет результата запроса; узел выводится после PANEL_NODE_MAX_FAILURES ошибок подряд"""
+        if ok:
+            if not node.healthy:
+                logger.info("Panel node %s is back", node.name)
+            node.failures = 0
+            node.healthy = True
+            return
+        node.failures += 1
+        if node.healthy and node.failures >= settings.PANEL_NODE_MAX_FAILURES:
+            logger.warning("Panel node %s marked unhealthy", node.name)
+            node.healthy = False
+
+    async def _ping(self, node: PanelNode):
+        started = time.perf_counter()
+        try:
+            response = await asyncio.wait_for(
+                node.api.list_inbounds(page=1, page_size=1),
+                settings.PANEL_HEALTH_TIMEOUT
+            )
+            ok = bool(response.get("success"))
+        except Exception:
+            logger.debug("Health check of panel node %s failed", node.name, exc_info=True)
+            ok = False
+        node.latency = time.perf_counter() - started
+        self._mark(node, ok)
+
+    async def refresh_load(self):
+        """Число активных ключей и трафик по узлам (одним запросом к базе)"""
+        async with async_session() as db:
+            rows = (await db.execute(
+                select(
+                    Subscription.node,
+                    func.count(Subscription.id),
+                    func.sum(Subscription.up_traffic + Subscription.down_traffic)
+                )
+                .where(Subscription.is_active == True)
+                .group_by(Subscription.node)
+            )).all()
+        load = {name: [0, 0] for name in self.nodes}
+        for name, clients, traffic in rows:
+            name = name or self.default
+            if name in load:
+                load[name][0] += clients
+                load[name][1] += traffic or 0
+        for name, (clients, traffic) in load.items():
+            self.nodes[name].clients = clients
+            self.nodes[name].traffic = traffic
+
+    async def check_health(self):
+        """Проверка всех узлов и обновление данных о нагрузке"""
+        await asyncio.gather(*(self._ping(node) for node in self.nodes.values()))
+        await self.refresh_load()
+        now = datetime.utcnow()
+        for node in self.nodes.values():
+            node.checked_at = now
+
+    def pick_node(self, exclude: Iterable[str] = ()) -> PanelNode:
+        """Наименее загруженный доступный узел"""
+        exclude = set(exclude)
+        candidates = [node for node in self.nodes.values() if node.name not in exclude]
+        available = [node for node in candidates if node.healthy and node.has_capacity()]
+        # Если доступных узлов нет, пробуем все оставшиеся: проверка могла устареть
+        return min(available or candidates, key=lambda node: node.load())
+
+    async def create_inbound(self, email: str, days: int) -> Tuple[str, Dict[str, Any]]:
+        """Создание ключа на наименее загруженном узле
+
+        Если узел не отвечает, ключ создается на следующем. Возвращает имя
+        узла и ответ панели.
+        """
+        tried = set()
+        while True:
+            node = self.pick_node(exclude=tried)
+            # Ключ учитывается до ответа, чтобы параллельные запросы не ушли на один узел
+            node.clients += 1
+            try:
+                response = await node.api.create_inbound(email, days)
+            except Exception:
+                node.clients -= 1
+                self._mark(node, False)
+                tried.add(node.name)
+                if len(tried) == len(self.nodes):
+                    raise
+                logger.warning("Panel node %s failed, trying another node", node.name, exc_info=True)
+                continue
+            self._mark(node, True)
+            if not response.get("success"):
+                node.clients -= 1
+            return node.name, response
+
+    async def get_inbound(self, name: Optional[str], inbound_id: int) -> Dict[str, Any]:
+        """Чтение ключа с его узла с учетом ошибок в состоянии узла"""
+        node = self.node(name)
+        try:
+            response = await node.api.get_inbound(inbound_id)
+        except Exception:
+            self._mark(node, False)
+            raise
+        self._mark(node, True)
+        return response
+
+    async def update_inbound(self, name: Optional[str], inbound_id: int, data: Dict[str, Any]) -> Dict[str, Any]:
+        """Изменение ключа на его узле"""
+        node = self.node(name)
+        try:
+            response = await node.api.update_inbound(inbound_id, data)
+        except Exception:
+            self._mark(node, False)
+            raise
+        self._mark(node, True)
+        return response
+
+    def vpn_config(self, name: Optional[str], inbound: Dict[str, Any], email: str) -> Optional[str]:
+        """Клиентская конфигурация ключа по данным панели"""
+        if not inbound.get("port"):
+            return None
+        return generate_vpn_config(self.node(name).host, inbound["port"], email)
+
+    def status(self) -> List[Dict[str, Any]]:
+        """Кэшированное состояние узлов"""
+        return [
+            {
+                "name": node.name,
+                "healthy": node.healthy,
+                "clients": node.clients,
+                "traffic": node.traffic,
+                "latency": node.latency,
+                "checked_at": node.checked_at
+            }
+            for node in self.nodes.values()
+        ]
+
+async def panel_health_job(context):
+    """Периодическая проверка узлов для JobQueue бота"""
+    try:
+        await context.job.data.check_health()
+    except Exception:
+        logger.exception("Panel health check failed")
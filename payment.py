@@ -1,27 +1,116 @@
+import asyncio
+import random
+import time
 import aiohttp
 from typing import Optional, Dict, Any
 from datetime import datetime, timedelta
 from config import settings
+import metrics
+
+# Коды ответа, при которых запрос имеет смысл повторить
+RETRY_STATUSES = {429, 500, 502, 503, 504}
 
 class PaymentSystem:
     def __init__(self):
         self.token = settings.PAYMENT_TOKEN
         self.webhook_url = settings.PAYMENT_WEBHOOK_URL
-        self.base_url = "https://api.qiwi.com/partner/bill/v1"
+        self.base_url = settings.PAYMENT_API_URL
+        self.headers = {
+            "Authorization": f"Bearer {self.token}",
+            "Accept": "application/json"
+        }
+        self.stats: Dict[str, Dict[str, float]] = {}
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._semaphore = asyncio.Semaphore(settings.PAYMENT_MAX_CONCURRENCY)
+
+    async def start(self) -> aiohttp.ClientSession:
+        """Открытие общего пула соединений с платежной системой"""
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=settings.PAYMENT_POOL_LIMIT),
+                headers=self.headers,
+                timeout=aiohttp.ClientTimeout(total=settings.PAYMENT_REQUEST_TIMEOUT)
+            )
+        return self._session
+
+    async def close(self):
+        """Закрытие пула соединений"""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    def _stat(self, name: str) -> Dict[str, float]:
+        return self.stats.setdefault(
+            name,
+            {"count": 0, "errors": 0, "total_time": 0.0, "max_time": 0.0, "retries": 0, "backoff_time": 0.0}
+        )
+
+    def _record(self, name: str, elapsed: float, error: bool):
+        """Учет задержки и ошибок по эндпоинту"""
+        stat = self._stat(name)
+        stat["count"] += 1
+        stat["total_time"] += elapsed
+        stat["max_time"] = max(stat["max_time"], elapsed)
+        if error:
+            stat["errors"] += 1
+        metrics.observe_outbound("payment", name, elapsed, error)
+
+    async def _request(
+        self,
+        name: str,
+        method: str,
+        endpoint: str,
+        retry: bool = True,
+        **kwargs
+    ) -> Dict[str, Any]:
+        """Запрос к API с ограничением параллелизма и повторами
+
+        retry=False для неидемпотентных запросов: запрос, оборвавшийся по
+        таймауту или ответивший 5xx, мог уже выполниться, и повтор создал
+        бы дубликат. Такие запросы повторяются, только если API их точно
+        не выполнил: ответ 429 или соединение не установлено.
+        """
+        session = await self.start()
+        attempt = 0
+        max_retries = settings.PAYMENT_MAX_RETRIES
+        while True:
+            started = time.perf_counter()
+            try:
+                async with self._semaphore:
+                    async with session.request(
+                        method,
+                        f"{self.base_url}{endpoint}",
+                        **kwargs
+                    ) as response:
+                        retryable = response.status in RETRY_STATUSES if retry else response.status == 429
+                        if retryable and attempt < max_retries:
+                            self._record(name, time.perf_counter() - started, error=True)
+                        else:
+                            data = await response.json(content_type=None)
+                            self._record(name, time.perf_counter() - started, error=response.status >= 400)
+                            return data
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                self._record(name, time.perf_counter() - started, error=True)
+                if attempt >= max_retries or not (retry or isinstance(e, aiohttp.ClientConnectorError)):
+                    raise
+
+            # Экспоненциальная задержка со случайным разбросом (full jitter)
+            delay = random.uniform(0, settings.PAYMENT_RETRY_BASE_DELAY * (2 ** attempt))
+            await asyncio.sleep(delay)
+            attempt += 1
+            stat = self._stat(name)
+            stat["retries"] += 1
+            stat["backoff_time"] += delay
+            metrics.observe_retry("payment", name)
 
     async def create_payment(self, amount: float, currency: str, payment_id: str) -> Dict[str, Any]:
         """Создание платежа"""
-        headers = {
-            "Authorization": f"Bearer {self.token}",
-            "Content-Type": "application/json"
-        }
-        
         data = {
             "amount": {
                 "currency": currency,
                 "value": str(amount)
             },
-            "expirationDateTime": (datetime.now() + timedelta(hours=1)).isoformat(),
+            "expirationDateTime": (datetime.now() + timedelta(seconds=settings.PAYMENT_BILL_LIFETIME)).isoformat(),
             "customer": {
                 "phone": None,
                 "email": None,
@@ -32,36 +121,14 @@ class PaymentSystem:
             "failUrl": f"{self.webhook_url}/fail"
         }
 
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
-                f"{self.base_url}/bills",
-                headers=headers,
-                json=data
-            ) as response:
-                return await response.json()
+        # Повтор POST /bills после таймаута или 5xx мог бы выставить второй
+        # счет; повторяются только 429 и неустановленное соединение
+        return await self._request("create_payment", "POST", "/bills", retry=False, json=data)
 
     async def check_payment(self, payment_id: str) -> Dict[str, Any]:
         """Проверка статуса платежа"""
-        headers = {
-            "Authorization": f"Bearer {self.token}"
-        }
-
-        async with aiohttp.ClientSession() as session:
-            async with session.get(
-                f"{self.base_url}/bills/{payment_id}",
-                headers=headers
-            ) as response:
-                return await response.json()
+        return await self._request("check_payment", "GET", f"/bills/{payment_id}")
 
     async def cancel_payment(self, payment_id: str) -> Dict[str, Any]:
         """Отмена платежа"""
-        headers = {
-            "Authorization": f"Bearer {self.token}"
-        }
-
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
-                f"{self.base_url}/bills/{payment_id}/reject",
-                headers=headers
-            ) as response:
-                return await response.json() 
\ No newline at end of file
+        return await self._request("cancel_payment", "POST", f"/bills/{payment_id}/reject")
\ No newline at end of file
@@ -0,0 +1,150 @@
+import argparse
+import asyncio
+import logging
+import time
+from datetime import datetime, timedelta
+from typing import Dict, List, Tuple
+
+from sqlalchemy import and_, or_, select
+
+from config import settings
+from database import async_session
+from idempotency import claim_payment
+from models import Payment
+from outbox import complete_payment
+from payment import PaymentSystem
+from throttle import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+# Статусы счета QIWI, после которых оплаты уже не будет
+CLOSED_BILL_STATUSES = ("REJECTED", "EXPIRED")
+
+async def _fetch_pending(cursor: Tuple[datetime, int], cutoff: datetime, limit: int) -> List[Payment]:
+    """Следующая пачка зависших платежей (индекс status, created_at)"""
+    created_at, payment_id = cursor
+    async with async_session() as db:
+        return (await db.scalars(
+            select(Payment)
+            .where(
+                Payment.status == "pending",
+                Payment.created_at < cutoff,
+                or_(
+                    Payment.created_at > created_at,
+                    and_(Payment.created_at == created_at, Payment.id > payment_id)
+                )
+            )
+            .order_by(Payment.created_at, Payment.id)
+            .limit(limit)
+        )).all()
+
+async def _close(payment_id: str) -> bool:
+    """Перевод неоплаченного счета в expired"""
+    async with async_session() as db:
+        closed = await claim_payment(db, payment_id, ("pending",), "expired")
+        await db.commit()
+    return closed
+
+async def reconcile_payment(payment_system: PaymentSystem, payment: Payment, now: datetime) -> str:
+    """Сверка одного платежа с QIWI, возвращает исход"""
+    bill = await payment_system.check_payment(payment.payment_id)
+    status = (bill.get("status") or {}).get("value")
+
+    if status == "PAID":
+        # Тот же путь, что и у вебхука: платеж получит только один из них
+        async with async_session() as db:
+            completed = await complete_payment(db, payment.payment_id)
+            await db.commit()
+        if completed:
+            logger.warning("Payment %s was paid but its webhook was lost", payment.payment_id)
+        return "paid" if completed else "already_processed"
+
+    if status in CLOSED_BILL_STATUSES:
+        return "expired" if await _close(payment.payment_id) else "already_processed"
+
+    if payment.created_at < now - timedelta(seconds=settings.PAYMENT_BILL_LIFETIME):
+        # Счет брошен: отменяем его в QIWI, чтобы его нельзя было оплатить
+        await payment_system.cancel_payment(payment.payment_id)
+        return "cancelled" if await _close(payment.payment_id) else "already_processed"
+
+    return "waiting"
+
+async def reconcile_payments(payment_system: PaymentSystem) -> Dict[str, float]:
+    """Проверка всех зависших платежей с ограничением параллелизма и скорости"""
+    started = time.perf_counter()
+    now = datetime.utcnow()
+    cutoff = now - timedelta(seconds=settings.PAYMENT_RECONCILE_MIN_AGE)
+    semaphore = asyncio.Semaphore(settings.PAYMENT_RECONCILE_CONCURRENCY)
+    budget = TokenBucket(settings.PAYMENT_RECONCILE_RATE)
+    outcomes: Dict[str, int] = {}
+    latencies: List[float] = []
+
+    async def reconcile(payment: Payment):
+        async with semaphore:
+            await budget.acquire()
+            request_started = time.perf_counter()
+            try:
+                outcome = await reconcile_payment(payment_system, payment, now)
+            except Exception:
+                logger.exception("Failed to reconcile payment %s", payment.payment_id)
+                outcome = "error"
+            latencies.append(time.perf_counter() - request_started)
+            outcomes[outcome] = outcomes.get(outcome, 0) + 1
+
+    cursor = (datetime.min, 0)
+    while True:
+        batch = await _fetch_pending(cursor, cutoff, settings.PAYMENT_RECONCILE_BATCH_SIZE)
+        if not batch:
+            break
+        cursor = (batch[-1].created_at, batch[-1].id)
+        await asyncio.gather(*(reconcile(payment) for payment in batch))
+
+    latencies.sort()
+    metrics: Dict[str, float] = {
+        "checked": len(latencies),
+        **outcomes,
+        "p50": latencies[len(latencies) // 2] if latencies else 0.0,
+        "p95": latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] if latencies else 0.0,
+        "max": latencies[-1] if latencies else 0.0,
+        "elapsed": time.perf_counter() - started
+    }
+    logger.info(
+        "Payment reconcile: checked=%d %s p50=%.2fs p95=%.2fs max=%.2fs total=%.2fs",
+        metrics["checked"],
+        " ".join(f"{name}={count}" for name, count in sorted(outcomes.items())),
+        metrics["p50"], metrics["p95"], metrics["max"], metrics["elapsed"]
+    )
+    return metrics
+
+async def payment_reconcile_job(context):
+    """Периодическая задача для JobQueue бота"""
+    try:
+        await reconcile_payments(context.job.data)
+    except Exception:
+        logger.exception("Payment reconcile failed")
+
+async def main(once: bool):
+    """Запуск сверки отдельным процессом"""
+    payment_system = PaymentSystem()
+    try:
+        while True:
+            try:
+                await reconcile_payments(payment_system)
+            except Exception:
+                logger.exception("Payment reconcile failed")
+            if once:
+                break
+            await asyncio.sleep(settings.PAYMENT_RECONCILE_INTERVAL)
+    finally:
+        await payment_system.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Сверка зависших платежей с QIWI")
+    parser.add_argument("--once", action="store_true", help="выполнить один проход и выйти")
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        level=logging.INFO
+    )
+    asyncio.run(main(args.once))
@@ -0,0 +1,174 @@
+import asyncio
+import json
+import logging
+import pickle
+from datetime import datetime
+from typing import Dict, Optional, Tuple
+
+from sqlalchemy import and_, delete, or_, select
+from telegram import Update
+from telegram.ext import BasePersistence, PersistenceInput
+
+from config import settings
+from database import async_session, upsert
+from models import BotState
+
+logger = logging.getLogger(__name__)
+
+def worker_count() -> int:
+    return max(len(settings.BOT_WORKER_URLS), 1)
+
+def worker_for_chat(chat_id: int) -> int:
+    """Номер воркера, который обслуживает чат
+
+    Все обновления одного чата попадают к одному воркеру, поэтому его
+    состояние диалога меняет только один процесс.
+    """
+    return chat_id % worker_count()
+
+def worker_for_update(update: Update) -> int:
+    if update.effective_chat is not None:
+        return worker_for_chat(update.effective_chat.id)
+    if update.effective_user is not None:
+        return worker_for_chat(update.effective_user.id)
+    return settings.BOT_WORKER_INDEX
+
+def owns_chat(chat_id: int) -> bool:
+    return worker_for_chat(chat_id) == settings.BOT_WORKER_INDEX
+
+def is_primary_worker() -> bool:
+    """Воркер, который выполняет общие фоновые задачи (сверки, истечение, рассылки)"""
+    return settings.BOT_WORKER_INDEX == 0
+
+class SqlPersistence(BasePersistence):
+    """Хранение состояния диалогов, user_data и chat_data в основной базе
+
+    Приложение само вызывает update_* раз в update_interval секунд; здесь
+    изменения дополнительно копятся в памяти и пишутся одной транзакцией.
+    Каждый воркер загружает только свои чаты (см. worker_for_chat).
+    bot_data и callback_data не сохраняются: они общие для всех воркеров.
+    """
+
+    def __init__(self):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=True, user_data=True, callback_data=False),
+            update_interval=settings.BOT_PERSISTENCE_FLUSH_INTERVAL
+        )
+        self._pending: Dict[Tuple[str, str], Optional[bytes]] = {}
+        self._write_task: Optional[asyncio.Task] = None
+        self._write_lock = asyncio.Lock()
+
+    async def _load(self, kind: str) -> Dict[str, bytes]:
+        async with async_session() as db:
+            rows = (await db.execute(
+                select(BotState.key, BotState.data).where(BotState.kind == kind)
+            )).all()
+        return {row.key: row.data for row in rows}
+
+    def _stage(self, kind: str, key: str, data: Optional[bytes]):
+        """Запись откладывается и объединяется с остальными изменениями"""
+        self._pending[(kind, key)] = data
+        if self._write_task is None or self._write_task.done():
+            self._write_task = asyncio.create_task(self._write_soon())
+
+    async def _write_soon(self):
+        # Application вызывает update_* пачкой; даем ей закончиться
+        await asyncio.sleep(0.1)
+        await self._write_pending()
+
+    async def _write_pending(self):
+        async with self._write_lock:
+            pending, self._pending = self._pending, {}
+            if not pending:
+                return
+            deleted = [key for key, data in pending.items() if data is None]
+            rows = [
+                {"kind": kind, "key": key, "data": data, "updated_at": datetime.utcnow()}
+                for (kind, key), data in pending.items() if data is not None
+            ]
+            try:
+                async with async_session() as db:
+                    if deleted:
+                        await db.execute(delete(BotState).where(or_(*(
+                            and_(BotState.kind == kind, BotState.key == key) for kind, key in deleted
+                        ))))
+                    if rows:
+                        stmt = upsert(db, BotState)
+                        await db.execute(
+                            stmt.on_conflict_do_update(
+                                index_elements=[BotState.kind, BotState.key],
+                                set_={"data": stmt.excluded.data, "updated_at": stmt.excluded.updated_at}
+                            ),
+                            rows
+                        )
+                    await db.commit()
+            except Exception:
+                # Не теряем изменения: более новые значения имеют приоритет
+                for key, data in pending.items():
+                    self._pending.setdefault(key, data)
+                raise
+
+    async def get_user_data(self) -> Dict[int, dict]:
+        rows = await self._load("user_data")
+        return {int(key): pickle.loads(data) for key, data in rows.items() if owns_chat(int(key))}
+
+    async def get_chat_data(self) -> Dict[int, dict]:
+        rows = await self._load("chat_data")
+        return {int(key): pickle.loads(data) for key, data in rows.items() if owns_chat(int(key))}
+
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name: str) -> dict:
+        rows = await self._load(f"conversation:{name}")
+        conversations = {}
+        for key, data in rows.items():
+            conversation_key = tuple(json.loads(key))
+            # Первый элемент ключа - id чата (per_chat=True по умолчанию)
+            if conversation_key and not owns_chat(conversation_key[0]):
+                continue
+            conversations[conversation_key] = pickle.loads(data)
+        return conversations
+
+    async def update_conversation(self, name: str, key, new_state):
+        self._stage(
+            f"conversation:{name}",
+            json.dumps(list(key)),
+            None if new_state is None else pickle.dumps(new_state)
+        )
+
+    async def update_user_data(self, user_id: int, data: dict):
+        self._stage("user_data", str(user_id), pickle.dumps(data))
+
+    async def update_chat_data(self, chat_id: int, data: dict):
+        self._stage("chat_data", str(chat_id), pickle.dumps(data))
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_user_data(self, user_id: int):
+        self._stage("user_data", str(user_id), None)
+
+    async def drop_chat_data(self, chat_id: int):
+        self._stage("chat_data", str(chat_id), None)
+
+    async def refresh_user_data(self, user_id: int, user_data: dict):
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    async def flush(self):
+        """Запись всех накопленных изменений (при остановке)"""
+        if self._write_task is not None:
+            await asyncio.gather(self._write_task, return_exceptions=True)
+        await self._write_pending()
@@ -0,0 +1,59 @@
+import asyncio
+import hashlib
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from telegram import Bot, Message
+from telegram.error import BadRequest
+
+from cache import TTLCache
+from config import settings
+from database import upsert
+from models import QrCode
+from utils import generate_qr_code
+
+logger = logging.getLogger(__name__)
+
+# Отрисовка QR-кода занимает CPU, поэтому идет в отдельных потоках
+_executor = ThreadPoolExecutor(max_workers=settings.QR_WORKERS, thread_name_prefix="qr")
+
+# PNG по sha256 конфигурации: одинаковая конфигурация рисуется один раз
+qr_cache = TTLCache(maxsize=settings.QR_CACHE_SIZE, ttl=settings.QR_CACHE_TTL)
+
+def config_digest(config: str) -> str:
+    return hashlib.sha256(config.encode()).hexdigest()
+
+async def render_qr(config: str) -> bytes:
+    """PNG с QR-кодом конфигурации (из кэша или отрисованный в пуле потоков)"""
+    loop = asyncio.get_running_loop()
+    return await qr_cache.get_or_load(
+        config_digest(config),
+        lambda: loop.run_in_executor(_executor, generate_qr_code, config)
+    )
+
+async def send_qr(bot: Bot, db: AsyncSession, chat_id: int, config: str) -> Message:
+    """Отправка QR-кода конфигурации
+
+    После первой загрузки file_id изображения сохраняется в базе, и
+    следующие отправки не требуют ни отрисовки, ни повторной загрузки.
+    """
+    digest = config_digest(config)
+    file_id: Optional[str] = await db.scalar(select(QrCode.file_id).where(QrCode.digest == digest))
+    if file_id:
+        try:
+            return await bot.send_photo(chat_id=chat_id, photo=file_id, caption=config)
+        except BadRequest:
+            # file_id может стать недействительным (например, после смены токена бота)
+            logger.warning("Stored QR file_id for %s is not valid, uploading again", digest)
+
+    message = await bot.send_photo(chat_id=chat_id, photo=await render_qr(config), caption=config)
+    stmt = upsert(db, QrCode).values(digest=digest, file_id=message.photo[-1].file_id)
+    await db.execute(stmt.on_conflict_do_update(
+        index_elements=[QrCode.digest],
+        set_={"file_id": stmt.excluded.file_id}
+    ))
+    await db.commit()
+    return message
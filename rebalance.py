@@ -0,0 +1,118 @@
+import argparse
+import asyncio
+import logging
+import math
+from datetime import datetime
+from typing import List, Tuple
+
+from sqlalchemy import select
+
+from config import settings
+from database import async_session
+from models import Subscription, User
+from panel_pool import PanelNode, PanelPool
+from reprovision import store_keys
+
+logger = logging.getLogger(__name__)
+
+def excess_clients(panel_pool: PanelPool, source: PanelNode) -> int:
+    """Сколько ключей нужно перенести, чтобы нагрузка узла сравнялась со средней"""
+    total_clients = sum(node.clients for node in panel_pool.nodes.values())
+    total_weight = sum(node.weight for node in panel_pool.nodes.values())
+    fair_share = total_clients * source.weight / total_weight
+    return max(0, math.floor(source.clients - fair_share))
+
+async def _fetch_movable(panel_pool: PanelPool, source: str, limit: int) -> List[Tuple[str, str, int]]:
+    """Подписки узла в виде (id:старый ключ, email, оставшиеся дни)"""
+    now = datetime.utcnow()
+    async with async_session() as db:
+        rows = (await db.execute(
+            select(Subscription.id, Subscription.vpn_key, Subscription.end_date, User.telegram_id)
+            .join(User, Subscription.user_id == User.id)
+            .where(Subscription.is_active == True, panel_pool.node_filter(source))
+            .order_by(Subscription.id)
+            .limit(limit)
+        )).all()
+    return [
+        (
+            f"{row.id}:{row.vpn_key}",
+            f"user_{row.telegram_id}",
+            max(1, math.ceil((row.end_date - now).total_seconds() / 86400))
+        )
+        for row in rows
+    ]
+
+async def rebalance(
+    panel_pool: PanelPool,
+    source: str,
+    target: str = None,
+    count: int = None,
+    checkpoint: str = None,
+    concurrency: int = None
+) -> dict:
+    """Перенос ключей с перегруженного узла
+
+    Ключ сначала создается на целевом узле, затем подписка переключается
+    на него в базе и только после этого старый ключ удаляется. Прогресс
+    обоих шагов пишется в checkpoint, повторный запуск продолжает работу.
+    """
+    await panel_pool.check_health()
+    source_node = panel_pool.node(source)
+    target_node = panel_pool.node(target) if target else panel_pool.pick_node(exclude={source})
+    if count is None:
+        count = excess_clients(panel_pool, source_node)
+    checkpoint = checkpoint or f"rebalance.{source}.{target_node.name}.jsonl"
+
+    specs = await _fetch_movable(panel_pool, source, count)
+    logger.info("Moving %d keys from %s to %s", len(specs), source, target_node.name)
+    created = await target_node.api.create_inbounds(specs, concurrency=concurrency, checkpoint=checkpoint)
+
+    moved = {key.split(":", 1)[0]: obj for key, obj in created["ok"].items()}
+    stored = await store_keys(moved, target_node.name)
+
+    old_keys = [int(key.split(":", 1)[1]) for key in created["ok"]]
+    deleted = await source_node.api.delete_inbounds(
+        old_keys, concurrency=concurrency, checkpoint=f"{checkpoint}.delete"
+    )
+    return {
+        "source": source,
+        "target": target_node.name,
+        "selected": len(specs),
+        "created": created,
+        "stored": stored,
+        "deleted": deleted
+    }
+
+async def main(args):
+    panel_pool = PanelPool()
+    try:
+        report = await rebalance(
+            panel_pool, args.source, args.target, args.count, args.checkpoint, args.concurrency
+        )
+        await panel_pool.refresh_load()
+    finally:
+        await panel_pool.close()
+
+    created, deleted = report["created"], report["deleted"]
+    print(f"{report['source']} -> {report['target']}: selected {report['selected']}")
+    print(f"Created: {len(created['ok'])}, failed: {len(created['failed'])} ({created['elapsed']:.2f}s)")
+    print(f"Subscriptions switched: {report['stored']}")
+    print(f"Old keys deleted: {len(deleted['ok'])}, failed: {len(deleted['failed'])}")
+    for node in panel_pool.status():
+        print(f"  {node['name']}: {node['clients']} clients, {'up' if node['healthy'] else 'DOWN'}")
+    return 1 if created["failed"] or deleted["failed"] else 0
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Перенос ключей с перегруженного узла панели")
+    parser.add_argument("--from", dest="source", required=True, help="узел, с которого переносятся ключи")
+    parser.add_argument("--to", dest="target", help="целевой узел (по умолчанию наименее загруженный)")
+    parser.add_argument("--count", type=int, help="сколько ключей перенести (по умолчанию до средней нагрузки)")
+    parser.add_argument("--checkpoint", help="файл прогресса")
+    parser.add_argument("--concurrency", type=int, default=settings.PANEL_BATCH_CONCURRENCY)
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        level=logging.INFO
+    )
+    raise SystemExit(asyncio.run(main(args)))
@@ -0,0 +1,95 @@
+from datetime import datetime, timedelta
+from typing import Optional
+
+from sqlalchemy import select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from config import settings
+from models import Payment, Subscription, Tariff
+from panel_pool import PanelPool
+
+async def purchased_days(db: AsyncSession, payment_id: int) -> int:
+    """Длительность купленного тарифа; для старых платежей без тарифа - по умолчанию"""
+    days = await db.scalar(
+        select(Tariff.duration_days)
+        .join(Payment, Payment.tariff_id == Tariff.id)
+        .where(Payment.id == payment_id)
+    )
+    return days or settings.DEFAULT_SUBSCRIPTION_DAYS
+
+async def get_renewable(db: AsyncSession, user_id: int) -> Optional[Subscription]:
+    """Активная подписка пользователя, которую можно продлить"""
+    return await db.scalar(
+        select(Subscription)
+        .where(Subscription.user_id == user_id, Subscription.is_active == True)
+        .order_by(Subscription.end_date.desc())
+        .limit(1)
+    )
+
+def lifetime_ms(end_date: datetime) -> int:
+    """expiryTime для панели: как и при создании ключа, срок от текущего момента"""
+    return max(int((end_date - datetime.utcnow()).total_seconds() * 1000), 0)
+
+async def _push_end_date(panel_pool: PanelPool, node: str, vpn_key: int, end_date: datetime):
+    """Срок ключа в панели; ключ заново включается"""
+    response = await panel_pool.update_inbound(
+        node, vpn_key, {"expiryTime": lifetime_ms(end_date), "enable": True}
+    )
+    if not response.get("success"):
+        raise Exception(f"Panel error: {response.get('msg')}")
+
+async def extend_subscription(
+    db: AsyncSession,
+    panel_pool: PanelPool,
+    subscription: Subscription,
+    days: int
+) -> datetime:
+    """Продление подписки на days дней без выдачи нового ключа
+
+    Срок считается от конца текущей подписки (или от текущего момента,
+    если она уже истекла, но еще не отключена). Запрос к панели идет до
+    записи в базу, вне транзакции: иначе блокировка записи SQLite
+    держалась бы все время запроса. Затем новая дата записывается
+    условным UPDATE по старой дате и активности; транзакцию фиксирует
+    вызывающий вместе с отметкой о выполнении задачи.
+
+    Если подписку за это время забрал планировщик истечения или продлила
+    другая задача, UPDATE ничего не меняет. Тогда в панель возвращается
+    дата, которая действительно записана в базе, а для снятой подписки
+    ключ снова помечается неотключенным, чтобы планировщик отключил его
+    следующим проходом. Продление завершается ошибкой и при повторе идет
+    от нового состояния.
+    """
+    previous_end = subscription.end_date
+    new_end = max(previous_end, datetime.utcnow()) + timedelta(days=days)
+    subscription_id, node, vpn_key = subscription.id, subscription.node, int(subscription.vpn_key)
+    await _push_end_date(panel_pool, node, vpn_key, new_end)
+
+    result = await db.execute(
+        update(Subscription)
+        .where(
+            Subscription.id == subscription_id,
+            Subscription.is_active == True,
+            Subscription.end_date == previous_end
+        )
+        .values(end_date=new_end)
+        .execution_options(synchronize_session=False)
+    )
+    if result.rowcount == 1:
+        return new_end
+
+    await db.rollback()
+    current = (await db.execute(
+        select(Subscription.is_active, Subscription.end_date).where(Subscription.id == subscription_id)
+    )).one()
+    if current.is_active:
+        await _push_end_date(panel_pool, node, vpn_key, current.end_date)
+    else:
+        await db.execute(
+            update(Subscription)
+            .where(Subscription.id == subscription_id, Subscription.is_active == False)
+            .values(panel_disabled=False)
+            .execution_options(synchronize_session=False)
+        )
+        await db.commit()
+    raise Exception("Subscription was renewed or expired concurrently")
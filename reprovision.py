@@ -0,0 +1,126 @@
+import argparse
+import asyncio
+import logging
+import math
+from datetime import datetime
+from typing import List, Tuple
+
+from sqlalchemy import bindparam, select
+
+from config import settings
+from database import async_session
+from models import Subscription, User
+from panel_api import PanelAPI
+from panel_pool import PanelPool
+
+logger = logging.getLogger(__name__)
+
+subscriptions = Subscription.__table__
+update_vpn_key = (
+    subscriptions.update()
+    .where(subscriptions.c.id == bindparam("b_id"))
+    # Конфигурация старого ключа больше не действует, бот соберет новую
+    .values(vpn_key=bindparam("b_vpn_key"), node=bindparam("b_node"), vpn_config=None)
+)
+
+async def _fetch_active(where=None) -> List[Tuple[str, str, int]]:
+    """Активные подписки в виде (id подписки, email, оставшиеся дни)"""
+    now = datetime.utcnow()
+    query = (
+        select(Subscription.id, Subscription.end_date, User.telegram_id)
+        .join(User, Subscription.user_id == User.id)
+        .where(Subscription.is_active == True)
+        .order_by(Subscription.id)
+    )
+    if where is not None:
+        query = query.where(where)
+    async with async_session() as db:
+        rows = (await db.execute(query)).all()
+    return [
+        (
+            str(row.id),
+            f"user_{row.telegram_id}",
+            max(1, math.ceil((row.end_date - now).total_seconds() / 86400))
+        )
+        for row in rows
+    ]
+
+async def store_keys(created: dict, node: str) -> int:
+    """Запись новых ключей и их узла в подписки"""
+    rows = [
+        {"b_id": int(subscription_id), "b_vpn_key": str(obj["id"]), "b_node": node}
+        for subscription_id, obj in created.items()
+        if obj and "id" in obj
+    ]
+    batch_size = settings.REPROVISION_BATCH_SIZE
+    async with async_session() as db:
+        for i in range(0, len(rows), batch_size):
+            await db.execute(update_vpn_key, rows[i:i + batch_size])
+        await db.commit()
+    return len(rows)
+
+async def reprovision(
+    panel_api: PanelAPI,
+    node: str,
+    checkpoint: str,
+    concurrency: int,
+    update_db: bool,
+    where=None
+) -> dict:
+    """Перевыдача ключей активных подписок на панели panel_api (узел node)"""
+    specs = await _fetch_active(where)
+    logger.info("Reprovisioning %d active subscriptions on %s", len(specs), panel_api.base_url)
+    report = await panel_api.create_inbounds(specs, concurrency=concurrency, checkpoint=checkpoint)
+    if update_db:
+        # Успешные результаты из checkpoint тоже записываются: повтор безопасен
+        report["stored"] = await store_keys(report["ok"], node)
+    return report
+
+async def main(args):
+    panel_pool = PanelPool()
+    if args.url:
+        panel_api = PanelAPI(args.url, args.username, args.password)
+    else:
+        panel_api = panel_pool.api(args.node)
+    # Без --from ключи выдаются заново всем активным подпискам (сброс панели)
+    where = panel_pool.node_filter(args.source) if args.source else None
+    try:
+        report = await reprovision(
+            panel_api, args.node or panel_pool.default, args.checkpoint,
+            args.concurrency, not args.no_update_db, where
+        )
+    finally:
+        await panel_api.close()
+        await panel_pool.close()
+
+    processed = len(report["ok"]) - report["skipped"] + len(report["failed"])
+    print(f"Created: {len(report['ok'])} (from checkpoint: {report['skipped']})")
+    print(f"Failed: {len(report['failed'])}")
+    if "stored" in report:
+        print(f"Subscriptions updated: {report['stored']}")
+    print(f"Elapsed: {report['elapsed']:.2f}s, {processed / max(report['elapsed'], 1e-6):.1f} keys/s")
+    for key, error in list(report["failed"].items())[:20]:
+        print(f"  subscription {key}: {error}")
+    if report["failed"]:
+        print("Rerun with the same --checkpoint to retry failed keys")
+    return 1 if report["failed"] else 0
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Перевыдача ключей активных подписок на панели")
+    parser.add_argument("--node", help="целевой узел из PANEL_NODES (по умолчанию первый)")
+    parser.add_argument("--from", dest="source", help="только подписки с этого узла")
+    parser.add_argument("--url", help="адрес целевой панели, если ее нет в настройках")
+    parser.add_argument("--username", help="логин целевой панели")
+    parser.add_argument("--password", help="пароль целевой панели")
+    parser.add_argument("--checkpoint", default="reprovision.checkpoint.jsonl",
+                        help="файл прогресса; при повторном запуске готовые ключи пропускаются")
+    parser.add_argument("--concurrency", type=int, default=settings.PANEL_BATCH_CONCURRENCY)
+    parser.add_argument("--no-update-db", action="store_true",
+                        help="не записывать новые ключи в подписки")
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        level=logging.INFO
+    )
+    raise SystemExit(asyncio.run(main(args)))
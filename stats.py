@@ -0,0 +1,159 @@
+import asyncio
+import logging
+from datetime import date, datetime, timedelta
+from typing import Dict, List
+
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from config import settings
+from database import async_session, upsert
+from models import DailyStats, Payment, StatsCounter, Subscription, User
+
+logger = logging.getLogger(__name__)
+
+COUNTERS = ("users", "active_subscriptions", "payments", "revenue", "traffic")
+DAILY_FIELDS = ("revenue", "payments", "new_users", "new_subscriptions", "churned")
+
+async def _add_counters(db: AsyncSession, **deltas):
+    """Атомарное увеличение счетчиков"""
+    for name, delta in deltas.items():
+        stmt = upsert(db, StatsCounter).values(name=name, value=delta)
+        await db.execute(stmt.on_conflict_do_update(
+            index_elements=[StatsCounter.name],
+            set_={"value": StatsCounter.value + delta}
+        ))
+
+async def _add_daily(db: AsyncSession, day: date, **deltas):
+    """Атомарное увеличение дневного бакета"""
+    stmt = upsert(db, DailyStats).values(
+        day=day, **{field: deltas.get(field, 0) for field in DAILY_FIELDS}
+    )
+    await db.execute(stmt.on_conflict_do_update(
+        index_elements=[DailyStats.day],
+        set_={field: getattr(DailyStats, field) + delta for field, delta in deltas.items()}
+    ))
+
+# Все функции ниже пишут в транзакции вызывающего, вместе с самим изменением
+
+async def on_user_registered(db: AsyncSession):
+    await _add_counters(db, users=1)
+    await _add_daily(db, datetime.utcnow().date(), new_users=1)
+
+async def on_payment_created(db: AsyncSession):
+    await _add_counters(db, payments=1)
+    await _add_daily(db, datetime.utcnow().date(), payments=1)
+
+async def on_payment_completed(db: AsyncSession, amount: float):
+    await _add_counters(db, revenue=amount)
+    await _add_daily(db, datetime.utcnow().date(), revenue=amount)
+
+async def on_subscriptions_started(db: AsyncSession, count: int = 1):
+    await _add_counters(db, active_subscriptions=count)
+    await _add_daily(db, datetime.utcnow().date(), new_subscriptions=count)
+
+async def on_subscriptions_expired(db: AsyncSession, count: int):
+    await _add_counters(db, active_subscriptions=-count)
+    await _add_daily(db, datetime.utcnow().date(), churned=count)
+
+async def set_counter(db: AsyncSession, name: str, value: float):
+    """Запись абсолютного значения счетчика"""
+    stmt = upsert(db, StatsCounter).values(name=name, value=value)
+    await db.execute(stmt.on_conflict_do_update(
+        index_elements=[StatsCounter.name],
+        set_={"value": value}
+    ))
+
+async def get_counters(db: AsyncSession) -> Dict[str, float]:
+    """Все счетчики одним запросом"""
+    rows = (await db.execute(select(StatsCounter.name, StatsCounter.value))).all()
+    counters = {name: 0 for name in COUNTERS}
+    counters.update({row.name: row.value for row in rows})
+    return counters
+
+async def get_daily(db: AsyncSession, days: int) -> List[DailyStats]:
+    """Дневные бакеты за последние days дней"""
+    since = datetime.utcnow().date() - timedelta(days=days - 1)
+    return (await db.scalars(
+        select(DailyStats).where(DailyStats.day >= since).order_by(DailyStats.day)
+    )).all()
+
+def _as_date(value) -> date:
+    """func.date() возвращает строку в SQLite и date в PostgreSQL"""
+    return value if isinstance(value, date) else date.fromisoformat(str(value)[:10])
+
+async def _daily_from_raw(db: AsyncSession, since: date) -> Dict[date, Dict[str, float]]:
+    """Пересчет дневных бакетов по исходным таблицам"""
+    since_dt = datetime.combine(since, datetime.min.time())
+    queries = {
+        "revenue": select(func.date(Payment.completed_at), func.sum(Payment.amount))
+            .where(Payment.status == "completed", Payment.completed_at >= since_dt)
+            .group_by(func.date(Payment.completed_at)),
+        "payments": select(func.date(Payment.created_at), func.count(Payment.id))
+            .where(Payment.created_at >= since_dt)
+            .group_by(func.date(Payment.created_at)),
+        "new_users": select(func.date(User.created_at), func.count(User.id))
+            .where(User.created_at >= since_dt)
+            .group_by(func.date(User.created_at)),
+        "new_subscriptions": select(func.date(Subscription.start_date), func.count(Subscription.id))
+            .where(Subscription.start_date >= since_dt)
+            .group_by(func.date(Subscription.start_date)),
+        "churned": select(func.date(Subscription.end_date), func.count(Subscription.id))
+            .where(Subscription.is_active == False, Subscription.end_date >= since_dt)
+            .group_by(func.date(Subscription.end_date)),
+    }
+    daily: Dict[date, Dict[str, float]] = {}
+    for field, query in queries.items():
+        for day, value in (await db.execute(query)).all():
+            daily.setdefault(_as_date(day), {name: 0 for name in DAILY_FIELDS})[field] = value or 0
+    return daily
+
+async def reconcile_stats() -> Dict[str, float]:
+    """Пересчет счетчиков по исходным таблицам с отчетом о расхождениях"""
+    async with async_session() as db:
+        raw = {
+            "users": await db.scalar(select(func.count(User.id))),
+            "active_subscriptions": await db.scalar(
+                select(func.count(Subscription.id)).where(Subscription.is_active == True)
+            ),
+            "payments": await db.scalar(select(func.count(Payment.id))),
+            "revenue": await db.scalar(
+                select(func.sum(Payment.amount)).where(Payment.status == "completed")
+            ) or 0,
+        }
+        counters = await get_counters(db)
+        drift = {name: raw[name] - counters[name] for name in raw if raw[name] != counters[name]}
+        for name, value in raw.items():
+            await set_counter(db, name, value)
+
+        since = datetime.utcnow().date() - timedelta(days=settings.STATS_RECONCILE_DAYS - 1)
+        daily = await _daily_from_raw(db, since)
+        for bucket in await get_daily(db, settings.STATS_RECONCILE_DAYS):
+            expected = daily.get(bucket.day, {name: 0 for name in DAILY_FIELDS})
+            for field in DAILY_FIELDS:
+                if getattr(bucket, field) != expected[field]:
+                    drift[f"{bucket.day}:{field}"] = expected[field] - getattr(bucket, field)
+        for day, values in daily.items():
+            stmt = upsert(db, DailyStats).values(day=day, **values)
+            await db.execute(stmt.on_conflict_do_update(index_elements=[DailyStats.day], set_=values))
+        await db.commit()
+
+    if drift:
+        logger.warning("Stats drift corrected: %s", drift)
+    else:
+        logger.info("Stats reconciled, no drift")
+    return drift
+
+async def reconcile_stats_job(context):
+    """Периодическая сверка для JobQueue бота"""
+    try:
+        await reconcile_stats()
+    except Exception:
+        logger.exception("Stats reconcile failed")
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        level=logging.INFO
+    )
+    asyncio.run(reconcile_stats())
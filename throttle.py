@@ -0,0 +1,132 @@
+import asyncio
+import functools
+import logging
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Hashable, Optional
+
+from telegram import Update
+
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+class TokenBucket:
+    """Ограничитель скорости: rate токенов в секунду, запас не больше capacity"""
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float):
+        """Пауза для всех отправителей (после RetryAfter)"""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    async def acquire(self):
+        """Ожидание свободного токена"""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+class SlidingWindowLimiter:
+    """Не больше limit запросов от одного ключа за последние window секунд"""
+
+    def __init__(self, limit: int, window: float):
+        self.limit = limit
+        self.window = window
+        self._hits: Dict[Hashable, Deque[float]] = {}
+
+    def hit(self, key: Hashable) -> bool:
+        """Учет запроса; False, если лимит уже исчерпан"""
+        now = time.monotonic()
+        hits = self._hits.setdefault(key, deque())
+        while hits and now - hits[0] >= self.window:
+            hits.popleft()
+        # Не даем словарю расти бесконечно
+        if len(self._hits) > 10000:
+            self._hits = {k: v for k, v in self._hits.items() if v and now - v[-1] < self.window}
+            self._hits[key] = hits
+        if len(hits) >= self.limit:
+            return False
+        hits.append(now)
+        return True
+
+class Coalescer:
+    """Одинаковые одновременные запросы выполняются один раз"""
+
+    def __init__(self):
+        self._inflight: Dict[Hashable, asyncio.Future] = {}
+
+    def get(self, key: Hashable) -> Optional[asyncio.Future]:
+        """Уже идущий запрос с этим ключом"""
+        return self._inflight.get(key)
+
+    async def run(self, key: Hashable, factory: Callable[[], Awaitable[Any]]) -> Any:
+        """Результат уже идущего запроса с тем же ключом или нового"""
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(factory())
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        # Отмена одного из ожидающих не прерывает общий запрос
+        return await asyncio.shield(task)
+
+# Общие на процесс; чаты закреплены за воркерами, поэтому этого достаточно
+user_limiter = SlidingWindowLimiter(settings.THROTTLE_RATE_LIMIT, settings.THROTTLE_WINDOW)
+coalescer = Coalescer()
+
+def _request_key(update: Update) -> str:
+    if update.callback_query is not None:
+        return update.callback_query.data or ""
+    if update.effective_message is not None:
+        return update.effective_message.text or ""
+    return ""
+
+REJECT_TEXT = "Слишком много запросов, попробуйте через несколько секунд."
+
+async def _reject(update: Update):
+    if update.callback_query is not None:
+        await update.callback_query.answer(REJECT_TEXT)
+    elif update.effective_message is not None:
+        await update.effective_message.reply_text(REJECT_TEXT)
+
+def throttled(handler):
+    """Ограничение частоты и склейка повторов для обработчиков бота
+
+    Повтор, пришедший пока такой же запрос пользователя еще выполняется,
+    получает его результат и не считается в лимите. Сверх лимита
+    обработчик не вызывается и возвращает None (состояние диалога не
+    меняется).
+    """
+    @functools.wraps(handler)
+    async def wrapper(update: Update, context, *args, **kwargs):
+        user = update.effective_user
+        if user is None:
+            return await handler(update, context, *args, **kwargs)
+        
+        key = (handler.__qualname__, user.id, _request_key(update))
+        inflight = coalescer.get(key)
+        if inflight is not None:
+            if update.callback_query is not None:
+                await update.callback_query.answer()
+            return await asyncio.shield(inflight)
+        
+        if not user_limiter.hit(user.id):
+            logger.info("Rate limit hit by %s in %s", user.id, handler.__qualname__)
+            await _reject(update)
+            return None
+        return await coalescer.run(key, lambda: handler(update, context, *args, **kwargs))
+    return wrapper
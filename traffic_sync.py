@@ -0,0 +1,125 @@
+import asyncio
+import logging
+from datetime import datetime
+from typing import Dict, List
+
+from sqlalchemy import bindparam, func, select
+
+from config import settings
+from database import async_session
+from models import Subscription
+from panel_api import PanelAPI
+from panel_pool import PanelPool
+import stats
+
+logger = logging.getLogger(__name__)
+
+subscriptions = Subscription.__table__
+update_traffic = (
+    subscriptions.update()
+    .where(
+        subscriptions.c.vpn_key == bindparam("b_vpn_key"),
+        # Номера ключей уникальны только в пределах одной панели
+        func.coalesce(subscriptions.c.node, bindparam("b_default")) == bindparam("b_node")
+    )
+    .values(
+        up_traffic=bindparam("b_up"),
+        down_traffic=bindparam("b_down"),
+        traffic_synced_at=bindparam("b_synced_at")
+    )
+)
+
+async def fetch_traffic(panel_api: PanelAPI) -> Dict[str, dict]:
+    """Постраничная загрузка счетчиков трафика всех ключей"""
+    page_size = settings.TRAFFIC_SYNC_PAGE_SIZE
+    traffic: Dict[str, dict] = {}
+    page = 1
+    while True:
+        response = await panel_api.list_inbounds(page=page, page_size=page_size)
+        if not response.get("success"):
+            raise Exception(f"Failed to list inbounds (page {page})")
+
+        items = response.get("obj") or []
+        new_items = 0
+        for item in items:
+            key = str(item["id"])
+            if key not in traffic:
+                new_items += 1
+            traffic[key] = {"up": item.get("up", 0), "down": item.get("down", 0)}
+
+        # Последняя страница, либо панель игнорирует пагинацию
+        if len(items) < page_size or new_items == 0:
+            return traffic
+        page += 1
+
+async def store_traffic(traffic: Dict[str, dict], node: str, default_node: str) -> int:
+    """Пакетная запись счетчиков трафика ключей одного узла в базу"""
+    synced_at = datetime.utcnow()
+    rows: List[dict] = [
+        {
+            "b_vpn_key": key,
+            "b_node": node,
+            "b_default": default_node,
+            "b_up": counters["up"],
+            "b_down": counters["down"],
+            "b_synced_at": synced_at
+        }
+        for key, counters in traffic.items()
+    ]
+
+    batch_size = settings.TRAFFIC_SYNC_BATCH_SIZE
+    async with async_session() as session:
+        for i in range(0, len(rows), batch_size):
+            await session.execute(update_traffic, rows[i:i + batch_size])
+        total_traffic = await session.scalar(
+            select(func.sum(Subscription.up_traffic + Subscription.down_traffic))
+            .where(Subscription.is_active == True)
+        )
+        await stats.set_counter(session, "traffic", total_traffic or 0)
+        await session.commit()
+    return len(rows)
+
+async def sync_traffic(panel_pool: PanelPool) -> int:
+    """Синхронизация трафика со всех узлов в базу"""
+    started = datetime.utcnow()
+    count = 0
+    for name, node in panel_pool.nodes.items():
+        # Недоступный узел не мешает синхронизации остальных
+        try:
+            traffic = await fetch_traffic(node.api)
+        except Exception:
+            logger.exception("Traffic sync failed for panel node %s", name)
+            continue
+        count += await store_traffic(traffic, name, panel_pool.default)
+    logger.info(
+        "Traffic synced for %d inbounds in %.2fs",
+        count, (datetime.utcnow() - started).total_seconds()
+    )
+    return count
+
+async def traffic_sync_job(context):
+    """Периодическая задача для JobQueue бота"""
+    try:
+        await sync_traffic(context.job.data)
+    except Exception:
+        logger.exception("Traffic sync failed")
+
+async def run_forever():
+    """Запуск синхронизации отдельным процессом"""
+    panel_pool = PanelPool()
+    try:
+        while True:
+            try:
+                await sync_traffic(panel_pool)
+            except Exception:
+                logger.exception("Traffic sync failed")
+            await asyncio.sleep(settings.TRAFFIC_SYNC_INTERVAL)
+    finally:
+        await panel_pool.close()
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        level=logging.INFO
+    )
+    asyncio.run(run_forever())
@@ -19,10 +19,18 @@ def generate_vpn_config(
     
     return config
 
-def generate_qr_code(config: str) -> str:
-    """Генерация QR-кода для конфигурации"""
-    # TODO: Реализовать генерацию QR-кода
-    return config
+def generate_qr_code(config: str) -> bytes:
+    """Генерация QR-кода для конфигурации (PNG)
+
+    Функция блокирующая; в боте вызывается через пул потоков (см. qr.py).
+    """
+    import io
+    import qrcode
+
+    image = qrcode.make(config, box_size=8, border=2)
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG")
+    return buffer.getvalue()
 
 def format_traffic(bytes_value: int) -> str:
     """Форматирование трафика в читаемый вид"""
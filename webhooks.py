@@ -1,106 +1,208 @@
-from fastapi import FastAPI, Request
-from datetime import datetime, timedelta
+from fastapi import Depends, FastAPI, HTTPException, Request, Response
 import hmac
-import hashlib
-import json
+
+from aiohttp import ClientSession, ClientTimeout
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from config import settings
+import metrics
 from database import get_db
-from models import Payment, Subscription, User
-from panel_api import PanelAPI
+from ingress import PaymentWebhook, parse_object, payment_webhook, read_body
+from idempotency import claim_payment, event_key, is_processed, record_event, remember_event
+from outbox import complete_payment
+from models import Payment
 
-app = FastAPI()
-panel_api = PanelAPI()
+# Приложение бота, если он работает в режиме вебхука
+telegram_application = None
+# Сессия для пересылки обновлений другим воркерам бота
+worker_session = None
 
-def verify_signature(request: Request, body: bytes) -> bool:
-    """Проверка подписи вебхука"""
-    signature = request.headers.get("X-Payment-Sha1-Hash")
-    if not signature:
-        return False
-    
-    expected_signature = hmac.new(
-        settings.PAYMENT_TOKEN.encode(),
-        body,
-        hashlib.sha1
-    ).hexdigest()
-    
-    return hmac.compare_digest(signature, expected_signature)
+FORWARDED_HEADER = "X-Bot-Worker-Forwarded"
+
+async def on_startup():
+    """Запуск бота в режиме вебхука"""
+    global telegram_application, worker_session
+    if settings.BOT_MODE == "webhook":
+        # Без секрета любой, кто знает адрес, мог бы слать боту обновления
+        if not settings.BOT_WEBHOOK_SECRET:
+            raise RuntimeError("BOT_WEBHOOK_SECRET is required in webhook mode")
+        from bot import start_webhook_application
+        from persistence import worker_count
+        telegram_application = await start_webhook_application()
+        if worker_count() > 1:
+            worker_session = ClientSession(timeout=ClientTimeout(total=10))
+
+async def on_shutdown():
+    """Остановка бота"""
+    if worker_session is not None:
+        await worker_session.close()
+    if telegram_application is not None:
+        from bot import stop_webhook_application
+        await stop_webhook_application(telegram_application)
+
+async def track_requests(request: Request, call_next):
+    """Замер длительности и числа SQL-запросов каждого эндпоинта"""
+    if request.url.path.startswith("/metrics"):
+        return await call_next(request)
+    async with metrics.track("http", "unmatched") as stats:
+        response = await call_next(request)
+        route = request.scope.get("route")
+        if route is not None:
+            stats.name = f"{request.method} {route.path}"
+        stats.failed = response.status_code >= 500
+        return response
+
+def _metrics_allowed(request: Request) -> bool:
+    if not settings.METRICS_TOKEN:
+        return True
+    authorization = request.headers.get("Authorization", "")
+    return hmac.compare_digest(authorization, f"Bearer {settings.METRICS_TOKEN}")
 
-@app.post("/webhook/payment/success")
-async def payment_success(request: Request):
+async def metrics_endpoint(request: Request):
+    """Метрики в формате Prometheus (только этого процесса)"""
+    if not _metrics_allowed(request):
+        return Response(status_code=403)
+    return Response(metrics.render(), media_type="text/plain; version=0.0.4")
+
+async def slow_requests(request: Request):
+    """Последние медленные запросы с SQL и стеками"""
+    if not _metrics_allowed(request):
+        return Response(status_code=403)
+    return list(metrics.slow_samples)
+
+async def telegram_webhook(request: Request):
+    """Прием обновлений от Telegram"""
+    if telegram_application is None:
+        return Response(status_code=404)
+    
+    # Секрет обязателен в режиме вебхука (см. on_startup)
+    secret = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+    if not hmac.compare_digest(secret.encode("latin-1"), settings.BOT_WEBHOOK_SECRET.encode()):
+        return Response(status_code=403)
+    
+    from persistence import worker_for_update
+    from telegram import Update
+
+    body = await read_body(request, settings.BOT_WEBHOOK_MAX_BODY_SIZE)
+    update = Update.de_json(parse_object(body), telegram_application.bot)
+    
+    # Чат закреплен за одним воркером; чужие обновления пересылаются владельцу
+    owner = worker_for_update(update)
+    if owner != settings.BOT_WORKER_INDEX and FORWARDED_HEADER not in request.headers:
+        headers = {
+            "Content-Type": "application/json",
+            FORWARDED_HEADER: "1",
+            "X-Telegram-Bot-Api-Secret-Token": settings.BOT_WEBHOOK_SECRET
+        }
+        url = settings.BOT_WORKER_URLS[owner].rstrip("/") + settings.BOT_WEBHOOK_PATH
+        async with worker_session.post(url, data=body, headers=headers) as response:
+            # Ошибка владельца возвращается Telegram, и он повторит доставку
+            return Response(status_code=response.status)
+    
+    # Обработка идет в очереди приложения, Telegram получает ответ сразу
+    await telegram_application.update_queue.put(update)
+    return Response(status_code=200)
+
+async def payment_success(
+    webhook: PaymentWebhook = Depends(payment_webhook),
+    db: AsyncSession = Depends(get_db)
+):
     """Обработчик успешного платежа"""
-    body = await request.body()
-    if not verify_signature(request, body):
-        return {"status": "error", "message": "Invalid signature"}
-    
-    data = json.loads(body)
-    payment_id = data.get("billId")
-    
-    if not payment_id:
-        return {"status": "error", "message": "No payment ID"}
+    # Повтор недавно обработанного вебхука отвечается без базы
+    if webhook.replayed("payment_success"):
+        return {"status": "success", "message": "Payment already processed"}
     
-    db = next(get_db())
-    payment = await db.query(Payment).filter(Payment.payment_id == payment_id).first()
+    # Повторная доставка уже обработанного вебхука
+    key = event_key("payment_success", webhook.body)
+    if await is_processed(db, key):
+        webhook.remember("payment_success")
+        return {"status": "success", "message": "Payment already processed"}
     
-    if not payment:
-        return {"status": "error", "message": "Payment not found"}
+    payment_id = webhook.data.get("billId")
     
-    if payment.status == "completed":
+    if not payment_id:
+        raise HTTPException(status_code=400, detail="No payment ID")
+    
+    # Атомарно помечаем платеж оплаченным и ставим выдачу ключа в очередь:
+    # дальше пойдет только один из дубликатов
+    if not await complete_payment(db, payment_id):
+        await db.rollback()
+        current_status = await db.scalar(
+            select(Payment.status).where(Payment.payment_id == payment_id)
+        )
+        if current_status is None:
+            raise HTTPException(status_code=404, detail="Payment not found")
+        await remember_event(db, key, "payment_success")
+        webhook.remember("payment_success")
         return {"status": "success", "message": "Payment already processed"}
     
-    # Обновляем статус платежа
-    payment.status = "completed"
-    payment.completed_at = datetime.utcnow()
-    
-    # Создаем подписку
-    user = await db.query(User).filter(User.id == payment.user_id).first()
-    if not user:
-        return {"status": "error", "message": "User not found"}
-    
-    # Создаем VPN-ключ
-    inbound = await panel_api.create_inbound(
-        email=f"user_{user.telegram_id}",
-        days=30  # TODO: Получать из тарифа
-    )
-    
-    if not inbound.get("success"):
-        return {"status": "error", "message": "Failed to create VPN key"}
-    
-    subscription = Subscription(
-        user_id=user.id,
-        vpn_key=inbound["obj"]["id"],
-        start_date=datetime.utcnow(),
-        end_date=datetime.utcnow() + timedelta(days=30),  # TODO: Получать из тарифа
-        is_active=True
-    )
-    
-    db.add(subscription)
+    await record_event(db, key, "payment_success")
     await db.commit()
+    webhook.remember("payment_success")
     
     return {"status": "success", "message": "Payment processed"}
 
-@app.post("/webhook/payment/fail")
-async def payment_fail(request: Request):
+async def payment_fail(
+    webhook: PaymentWebhook = Depends(payment_webhook),
+    db: AsyncSession = Depends(get_db)
+):
     """Обработчик неуспешного платежа"""
-    body = await request.body()
-    if not verify_signature(request, body):
-        return {"status": "error", "message": "Invalid signature"}
-    
-    data = json.loads(body)
-    payment_id = data.get("billId")
-    
-    if not payment_id:
-        return {"status": "error", "message": "No payment ID"}
-    
-    db = next(get_db())
-    payment = await db.query(Payment).filter(Payment.payment_id == payment_id).first()
+    if webhook.replayed("payment_fail"):
+        return {"status": "success", "message": "Payment marked as failed"}
     
-    if not payment:
-        return {"status": "error", "message": "Payment not found"}
+    key = event_key("payment_fail", webhook.body)
+    if await is_processed(db, key):
+        webhook.remember("payment_fail")
+        return {"status": "success", "message": "Payment marked as failed"}
     
-    # Обновляем статус платежа
-    payment.status = "failed"
+    payment_id = webhook.data.get("billId")
     
-    await db.commit()
-    
-    return {"status": "success", "message": "Payment marked as failed"} 
\ No newline at end of file
+    if not payment_id:
+        raise HTTPException(status_code=400, detail="No payment ID")
+    
+    # Помечаем платеж неуспешным, только если он еще не обработан
+    if await claim_payment(db, payment_id, ("pending",), "failed"):
+        await db.commit()
+    else:
+        await db.rollback()
+        current_status = await db.scalar(
+            select(Payment.status).where(Payment.payment_id == payment_id)
+        )
+        if current_status is None:
+            raise HTTPException(status_code=404, detail="Payment not found")
+        if current_status != "failed":
+            return {"status": "success", "message": "Payment already processed"}
+    
+    await remember_event(db, key, "payment_fail")
+    webhook.remember("payment_fail")
+    
+    return {"status": "success", "message": "Payment marked as failed"}
+
+def create_app() -> FastAPI:
+    """Создание ASGI-приложения (uvicorn webhooks:create_app --factory)
+
+    telegram и бот импортируются только в режиме вебхука бота, движок
+    базы создается при первом запросе.
+    """
+    application = FastAPI()
+    application.add_event_handler("startup", on_startup)
+    application.add_event_handler("shutdown", on_shutdown)
+    application.middleware("http")(track_requests)
+    application.add_api_route("/metrics", metrics_endpoint, methods=["GET"])
+    application.add_api_route("/metrics/slow", slow_requests, methods=["GET"])
+    application.add_api_route(settings.BOT_WEBHOOK_PATH, telegram_webhook, methods=["POST"])
+    application.add_api_route("/webhook/payment/success", payment_success, methods=["POST"])
+    application.add_api_route("/webhook/payment/fail", payment_fail, methods=["POST"])
+    return application
+
+_app = None
+
+def __getattr__(name: str):
+    # webhooks:app для uvicorn и бенчмарков; создается один раз
+    global _app
+    if name == "app":
+        if _app is None:
+            _app = create_app()
+        return _app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")